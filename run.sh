@@ -6,6 +6,8 @@ bbox_areas=("200" "300" "400" "500")
 keep_matching_bboxes=("false" "true")
 minimum_confidence_threshold=("0.2" "0.25" "0.3" "0.35" "0.4")
 registration_strategies=("2d" "3d")
+# model precision of the inference, add "bf16" / "fp16" / "int8" (after quantize.py) to compare speed and accuracy
+precisions=("fp32")
 
 rooms=("LivingArea" "Office" "SmallRoom" "Kitchen")
 perspectives=("null" "2d" "3d")
@@ -15,8 +17,8 @@ runs=5
 rm -r "data/results/"*
 
 # annotate.py --bbox_area "200"
-for bbox_area in "${bbox_areas[@]}"; do
-  echo -e "\n#######################################\nBBOX AREA CHANGED TO $bbox_area\n#######################################\n"
+for precision in "${precisions[@]}"; do for bbox_area in "${bbox_areas[@]}"; do
+  echo -e "\n#######################################\nPRECISION $precision, BBOX AREA CHANGED TO $bbox_area\n#######################################\n"
   for keep_matching_bbox in "${keep_matching_bboxes[@]}"; do
     echo -e "\n#######################################\nKEEP MATCHING BBOXES CHANGED TO $keep_matching_bbox\n#######################################\n"
     for registration_strategy in "${registration_strategies[@]}"; do
@@ -24,7 +26,7 @@ for bbox_area in "${bbox_areas[@]}"; do
       for minimum_confidence in "${minimum_confidence_threshold[@]}"; do
         minimum_confidence_formatted=$(echo $minimum_confidence | sed 's/\.//g')
         echo -e "\n#######################################\nMINIMUM CONFIDENCE CHANGED TO $minimum_confidence_formatted\n#######################################\n"
-        inference_key="area-${bbox_area}_matching-${keep_matching_bbox}_strategy-${registration_strategy}_confidence-${minimum_confidence_formatted}"
+        inference_key="area-${bbox_area}_matching-${keep_matching_bbox}_strategy-${registration_strategy}_confidence-${minimum_confidence_formatted}_precision-${precision}"
         for room in "${rooms[@]}"; do
           if [ ! -d "data/GH30_${room}/predictions" ]; then
             mkdir -p "data/GH30_${room}/predictions"
@@ -39,7 +41,7 @@ for bbox_area in "${bbox_areas[@]}"; do
                 rm -r "data/GH30_${room}/predictions/"*
 
                 create_inference_metadata.py --room "$room" --perspective "$perspective" --depth "$depth" --registration_strategy "$registration_strategy"
-                inference.py --room "$room" --filter_predictions_with_area_under "$bbox_area" --keep_matching_bboxes_only "$keep_matching_bbox" --minimum_confidence_threshold "$minimum_confidence" 
+                inference.py --room "$room" --filter_predictions_with_area_under "$bbox_area" --keep_matching_bboxes_only "$keep_matching_bbox" --minimum_confidence_threshold "$minimum_confidence" --precision "$precision"
 
                 # Copy the predictions to a new folder
                 config_file="data/GH30_${room}/predictions/metadata_configurations.yaml"
@@ -68,4 +70,4 @@ for bbox_area in "${bbox_areas[@]}"; do
       done
     done
   done
-done
\ No newline at end of file
+done; done
\ No newline at end of file
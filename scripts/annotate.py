@@ -10,22 +10,23 @@ to the model image size and saved in the ground_truth folder of the image folder
 """
 import os
 from os import path
+import time
 import logging
-import copy
-import open3d as o3d
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-import matplotlib.pyplot as plt
-import cv2
-import torch
 import shutil
 
 from src.annotation.projection \
-    import Intrinsic, Extrinsic, project_to_2d, frustum_culling
+    import Intrinsic, SceneProjector, project_object_bboxes
 from src.annotation import utils
+from src.annotation.annotation_index import AnnotationIndex
+from src.annotation.pointcloud_store import load_point_cloud
+from src.annotation.poses import ScenePoses
+from src.annotation.target_accumulator import TargetAccumulator
 from src.globals \
     import DATASET_FOLDER, IMAGE_FOLDER, ROOM, SCENE, PLANE, PCD_PATH, ANNO_PATH, \
         CAMERA_INFO_JSON_PATH, GT_COLOR, MODEL_IMAGE_SIZE, FOV_X, FOV_Y, BBOX_AREA
-from src.inference.geometry import remove_bboxes_with_area_less_than
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -33,16 +34,25 @@ logger = logging.getLogger(__name__)
 def main(
     log_level: str = "INFO",
     room: str = "ALL",
-    bbox_area: int=BBOX_AREA):
+    bbox_area: int=BBOX_AREA,
+    workers: int = 1):
     """
     main function for annotation pipeline
 
+    The plane folders are grouped into shards of one scene of one room. Shards are independent:
+    the "already annotated on image" bookkeeping and the ground truth images only span the
+    planes of one scene. With workers > 1 the shards run on a process pool; their target boxes
+    are merged in shard order, so all_target_bboxes.pt is the same as with one worker.
+
     Args:
         log_level (str): logging level
         room (str): room to process, default is all rooms
+        workers (int): number of processes, 1 annotates sequentially in this process
     """
     logger.setLevel(getattr(logging, log_level.upper()))
     logger.warning("logger set to %s", logger.level)
+    # torch is imported here, so that --help does not load it
+    import torch
 
     for folder in sorted(os.listdir("data")):
         if "GH30" in folder:
@@ -54,19 +64,49 @@ def main(
                     os.remove(f"./data/{folder}/all_target_bboxes.pt")
                     logger.info("Removed all_target_bboxes.pt in %s", f"./data/{folder}")
 
-    # intrinsic matrix
-    intrinsics = Intrinsic()
-    intrinsics.from_json("./" + DATASET_FOLDER + CAMERA_INFO_JSON_PATH)
+    shards = find_shards(room)
+    logger.info("annotating %s scenes with %s worker(s)", len(shards), workers)
+    start_time = time.perf_counter()
+    if workers > 1:
+        # debug windows are only opened when annotating in this process
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = {executor.submit(annotate_shard, shard, bbox_area, log_level, False): i \
+                for i, shard in enumerate(shards)}
+            results = [None] * len(shards)
+            for done, future in enumerate(as_completed(futures), start=1):
+                results[futures[future]] = future.result()
+                _log_shard(results[futures[future]], done, len(shards))
+    else:
+        results = []
+        for i, shard in enumerate(shards):
+            results.append(annotate_shard(shard, bbox_area, log_level, \
+                logger.level == logging.DEBUG))
+            _log_shard(results[-1], i + 1, len(shards))
+
+    # merge the shards of every room in shard order
+    all_target_bboxes = {}
+    for result in results:
+        all_target_bboxes.setdefault(result["folder"], TargetAccumulator()).merge(result["targets"])
+    for folder, targets in all_target_bboxes.items():
+        if len(targets) == 0:
+            continue
+        torch.save(targets.to_targets(), f"./data/GH30_{folder}/all_target_bboxes.pt")
+        logger.info("all_target_bboxes.pt saved in %s", \
+            f"./data/GH30_{folder}/all_target_bboxes.pt")
+    logger.info("annotated %s scenes, %s images, %s boxes in %.1f s", len(results), \
+        sum(result["images"] for result in results), sum(result["boxes"] for result in results), \
+            time.perf_counter() - start_time)
 
-    # create mesh for showing the origin
-    mesh_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(size=1, origin=[0, 0, 0])
-    tfs_temp = "BigRoom"
-    scene_buffer = None
-    # traverse dataset by scene
+
+def find_shards(room: str = "ALL") -> list:
+    """ Returns the annotated plane folders grouped by room and scene, in the order of the
+    sequential walk over DATASET_FOLDER.
+    """
+    shards = []
     for folder in sorted(os.listdir(DATASET_FOLDER)):
         if "Store" in folder or "readme" in folder or "camera_info" in folder:
             continue
-        all_target_bboxes = []
         for root, dirnames, files in sorted(os.walk(os.path.join(DATASET_FOLDER, folder))):
             if not 'planes/' in root:
                 continue
@@ -74,156 +114,171 @@ def main(
                 continue
             if not room == "ALL" and not room in root:
                 continue
+            scene = root.split("/")[3]
+            if len(shards) == 0 or shards[-1]["folder"] != folder or shards[-1]["scene"] != scene:
+                shards.append({"folder": folder, "scene": scene, "roots": []})
+            shards[-1]["roots"].append(root)
+    return shards
+
+
+def annotate_shard(shard: dict, bbox_area: int = BBOX_AREA, log_level: str = "INFO", \
+                   debug_views: bool = False) -> dict:
+    """ Annotates the planes of one scene of one room.
+
+    Returns:
+        dict with folder, scene, the target boxes per image (TargetAccumulator) and counts and
+        time for the report
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    # open3d and matplotlib are imported here, so that --help does not load them
+    import matplotlib.pyplot as plt
+    from src.inference.geometry import remove_bboxes_with_area_less_than
+    if debug_views:
+        import open3d as o3d
+        # create mesh for showing the origin
+        mesh_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(size=1, origin=[0, 0, 0])
+    start_time = time.perf_counter()
+
+    # intrinsic matrix
+    intrinsics = Intrinsic()
+    intrinsics.from_json("./" + DATASET_FOLDER + CAMERA_INFO_JSON_PATH)
 
-            logger.info("Processing folder: %s", root)
-            logger.debug("Files: %s", files)
-            target_bboxes = []
-            tfs = root.split("/")
-            img_path = "data/GH30_"+tfs[2]+"/"+tfs[3]+"/"
-            logger.debug("Image path: %s", img_path)
-            try:
-                transformations = utils.load_transformations(f"{img_path}{tfs[3]}_transformations.yaml")
-            except FileNotFoundError:
-                logger.warning("No transformation file found in %s", img_path)
+    print("\n##################################################################\n")
+    logger.info("New scene: %s", shard["scene"])
+    scene_annotation_buffer = {}
+    targets = TargetAccumulator()
+    num_images = 0
+    num_boxes = 0
+    for root in shard["roots"]:
+        logger.info("Processing folder: %s", root)
+        tfs = root.split("/")
+        img_path = "data/GH30_"+tfs[2]+"/"+tfs[3]+"/"
+        logger.debug("Image path: %s", img_path)
+        try:
+            poses = ScenePoses.load(f"{img_path}{tfs[3]}_transformations.yaml")
+        except FileNotFoundError:
+            logger.warning("No transformation file found in %s", img_path)
+            continue
+        # load pcd file, memory mapped from the point cloud cache after the first run
+        logger.debug("loading pointcloud from %s", "./"+root+"/"+PCD_PATH)
+        base_cloud = load_point_cloud(f"./{root}/{PCD_PATH}")
+
+        # ground truth
+        logger.debug("loading ground truth from %s", "./"+root+"/"+ANNO_PATH)
+        annotation = AnnotationIndex.load(f"./{root}/{ANNO_PATH}")
+
+        if debug_views:
+            bboxes = utils.extract_3d_bboxes(base_cloud, annotation.to_dict(), result=False)
+            o3d.visualization.draw_geometries([base_cloud.to_open3d(), *bboxes])
+
+        # the cloud is kept as one read only array, every view transforms it into the same
+        # buffer and projects only the visible points and the annotated objects
+        projector = SceneProjector(base_cloud.points, intrinsics, base_cloud.colors)
+
+        # bboxes of all objects in all views at once, (views, objects, 4), -1 if not visible
+        view_extrinsics = poses.extrinsic_matrices
+        object_bboxes = project_object_bboxes(projector.points, annotation.indices, \
+            annotation.object_labels(), view_extrinsics, intrinsics, FOV_X, FOV_Y, \
+                len(annotation))
+
+        # iterate over images in each scene
+        for view, (key, file_name) in enumerate(zip(poses.ids.tolist(), poses.file_names.tolist())):
+            logger.info("Processing image: %s", key)
+            skip_loop = True
+            if img_path+file_name not in targets:
+                logger.info("Creating new dict entry for image %s", key)
+                targets.add_image(img_path+file_name)
+            projector.set_view(view_extrinsics[view])
+            # the skip decision and the bboxes keep the baseline culling, which is symmetric in z.
+            # Points behind the camera are only left out of the image by the depth test of
+            # draw_image, they would be drawn mirrored otherwise
+            visible_indices = np.flatnonzero(projector.frustum_mask(FOV_X, FOV_Y))
+            if len(visible_indices) == 0:
+                logger.warning("No points in frustum for plane %s, skipping", tfs[5])
                 continue
-            # load pcd file
-            logger.debug("loading pointcloud from %s", "./"+root+"/"+PCD_PATH)
-            base_pcd = o3d.io.read_point_cloud(f"./{root}/{PCD_PATH}")
-
-            # ground truth
-            logger.debug("loading ground truth from %s", "./"+root+"/"+ANNO_PATH)
-            if scene_buffer != tfs[3]:
-                scene_buffer = tfs[3]
-                print("\n##################################################################\n")
-                logger.info("New scene: %s", scene_buffer)
-                scene_annotation_buffer = {}
-
-            _, base_anno_dict = utils.annotate_pcd(base_pcd, f"./{root}/{ANNO_PATH}", GT_COLOR)
-
-            if logger.level == logging.DEBUG:
-                bboxes = utils.extract_3d_bboxes(base_pcd, base_anno_dict, result=False)
-                o3d.visualization.draw_geometries([base_pcd, *bboxes])
-
-            # iterate over images in each scene
-            for key, value in transformations.items():
-                logger.info("Processing image: %s", key)
-                dict_entry_missing = True
-                skip_loop = True
-                for image_bboxes in all_target_bboxes:
-                    if image_bboxes['image'] == img_path+value['file_name']:
-                        dict_entry_missing = False
-                        break
-                if dict_entry_missing:
-                    logger.info("Creating new dict entry for image %s", key)
-                    all_target_bboxes.append(dict(
-                        image=img_path+value['file_name'],
-                        boxes=torch.as_tensor([], dtype=torch.float32),
-                        labels=torch.zeros((0,), dtype=torch.int32)
-                    ))
-                extrinsics = Extrinsic()
-                extrinsics.from_dict(value)
-                pcd = copy.deepcopy(base_pcd)
-                pcd.transform(extrinsics.homogenous_matrix())
-                base_gt_pcd = copy.deepcopy(pcd)
-                points_pos = np.asarray(pcd.points)
-                points_color = np.asarray(pcd.colors)
-                try:
-                    pcd = pcd.select_by_index(frustum_culling(points_pos, FOV_X, FOV_Y))
-                except ValueError:
-                    logger.warning("No points in frustum for plane %s, skipping", tfs[5])
-                    continue
-                if logger.level == logging.DEBUG:
-                    o3d.visualization.draw_geometries([pcd, mesh_frame])
-                points_pos = np.asarray(pcd.points)
-                points_color = np.asarray(pcd.colors)
-
-                u_coords, v_coords = project_to_2d(
-                    points_pos, intrinsics.homogenous_matrix(), intrinsics.distortion_coeffs(), \
-                        intrinsics.width, intrinsics.height)
-                final_image = utils.draw_image((u_coords, v_coords), points_color, intrinsics)
-
-                # iterate over ground truth objects and extract bboxes for visible objects
-                # img_bboxes = []
-                img_resized_bboxes = []
-                anno_dict = copy.deepcopy(base_anno_dict)
-                for anno_key, anno_value in base_anno_dict.items():
-                    logger.info("Annotating object: %s", anno_key)
-                    if key in scene_annotation_buffer:
-                        if anno_key in scene_annotation_buffer[key]:
-                            logger.info("Object %s already annotated on image %s", anno_key, key)
-                            continue
-                    gt_pcd = base_gt_pcd.select_by_index(anno_value)
-                    if logger.level == logging.DEBUG:
-                        o3d.visualization.draw_geometries([gt_pcd])
-                    gt_points_pos = np.asarray(gt_pcd.points)
-                    gt_points_color = np.asarray(gt_pcd.colors)
-                    try:
-                        gt_pcd = gt_pcd.select_by_index(frustum_culling(gt_points_pos, FOV_X, FOV_Y))
-                    except ValueError:
-                        logger.warning("Object %s not found in frustum, continuing with next object",\
-                            anno_key)
+            if debug_views:
+                o3d.visualization.draw_geometries(
+                    [projector.to_point_cloud(visible_indices), mesh_frame])
+
+            u_coords, v_coords = projector.project(visible_indices)
+            final_image = utils.draw_image((u_coords, v_coords), \
+                projector.colors[visible_indices], intrinsics, \
+                    depth=projector.camera_points[visible_indices, 2])
+
+            # iterate over ground truth objects and extract bboxes for visible objects
+            img_resized_bboxes = []
+            for anno_label, (anno_key, anno_value) in enumerate(annotation.items()):
+                logger.info("Annotating object: %s", anno_key)
+                if key in scene_annotation_buffer:
+                    if anno_key in scene_annotation_buffer[key]:
+                        logger.info("Object %s already annotated on image %s", anno_key, key)
                         continue
+                if debug_views:
+                    o3d.visualization.draw_geometries([projector.to_point_cloud(anno_value)])
+                bbox = object_bboxes[view, anno_label]
+                if bbox[0] < 0:
+                    logger.warning("Object %s not found in frustum, continuing with next object",\
+                        anno_key)
+                    continue
+                # the resize is monotonic, so resizing the corners equals resizing all points
+                resized_u, resized_v = utils.resize_coordinates(bbox[[0, 2]], bbox[[1, 3]], \
+                    (MODEL_IMAGE_SIZE, MODEL_IMAGE_SIZE))
 
-                    gt_points_pos = np.asarray(gt_pcd.points)
-                    gt_points_color = np.asarray(gt_pcd.colors)
+                img_resized_bboxes.append(utils.extract_bboxes(resized_u, resized_v))
 
-                    gt_u, gt_v = project_to_2d(gt_points_pos, intrinsics.homogenous_matrix(), \
-                        intrinsics.distortion_coeffs(), intrinsics.width, intrinsics.height)
+                if not key in scene_annotation_buffer:
+                    scene_annotation_buffer[key] = []
+                scene_annotation_buffer[key].append(anno_key)
+                skip_loop = False
+                logger.info("Object %s annotated on image %s", anno_key, key)
 
-                    resized_u, resized_v = utils.resize_coordinates(gt_u, gt_v, \
-                        (MODEL_IMAGE_SIZE, MODEL_IMAGE_SIZE))
+            if skip_loop:
+                logger.info("Skipping annotation for image %s", file_name)
+                continue
+            img_resized_bboxes = remove_bboxes_with_area_less_than(
+                np.asarray(img_resized_bboxes), bbox_area)
+            targets.add_boxes(img_path+file_name, img_resized_bboxes)
+            num_images += 1
+            num_boxes += len(img_resized_bboxes)
 
-                    img_resized_bboxes.append(utils.extract_bboxes(resized_u, resized_v))
-                    # img_bboxes.append(utils.extract_bboxes(gt_u, gt_v))
+            new_img_bboxes = np.zeros_like(img_resized_bboxes).astype(np.int32)
+            new_img_bboxes[:, 2] = img_resized_bboxes[:, 2] / MODEL_IMAGE_SIZE * intrinsics.width
+            new_img_bboxes[:, 0] = img_resized_bboxes[:, 0] / MODEL_IMAGE_SIZE * intrinsics.width
+            new_img_bboxes[:, 3] = img_resized_bboxes[:, 3] / MODEL_IMAGE_SIZE * intrinsics.height
+            new_img_bboxes[:, 1] = img_resized_bboxes[:, 1] / MODEL_IMAGE_SIZE * intrinsics.height
 
-                    if not key in scene_annotation_buffer:
-                        scene_annotation_buffer[key] = []
-                    scene_annotation_buffer[key].append(anno_key)
-                    skip_loop = False
-                    logger.info("Object %s annotated on image %s", anno_key, key)
+            final_image = utils.draw_2d_bboxes_on_img(final_image, new_img_bboxes)
+            if not path.exists(f"{img_path}ground_truth"):
+                os.makedirs(f"{img_path}ground_truth")
+            if not path.exists(f"{img_path}ground_truth/{file_name}"):
+                original_image = utils.draw_2d_bboxes_on_img(
+                    f"{img_path}{file_name}", new_img_bboxes)
+            else:
+                original_image = utils.draw_2d_bboxes_on_img(
+                    f"{img_path}ground_truth/{file_name}", new_img_bboxes)
+            plt.imsave(f"{img_path}ground_truth/{file_name}", original_image)
 
-                if skip_loop:
-                    logger.info("Skipping annotation for image %s", value['file_name'])
-                    continue
-                img_resized_bboxes = remove_bboxes_with_area_less_than(
-                    np.asarray(img_resized_bboxes), bbox_area)
-
-                for all_img_bboxes in all_target_bboxes:
-                    if all_img_bboxes['image'] == img_path+value['file_name']:
-                        all_img_bboxes['boxes'] = torch.cat((all_img_bboxes['boxes'], \
-                            torch.as_tensor(img_resized_bboxes, dtype=torch.float32)))
-                        all_img_bboxes['labels'] = torch.cat((all_img_bboxes['labels'], \
-                            torch.zeros((len(img_resized_bboxes),), dtype=torch.int32)))
-
-                # img_bboxes = np.asarray(img_bboxes)
-                new_img_bboxes = np.zeros_like(img_resized_bboxes).astype(np.int32)
-                new_img_bboxes[:, 2] = img_resized_bboxes[:, 2] / MODEL_IMAGE_SIZE * intrinsics.width
-                new_img_bboxes[:, 0] = img_resized_bboxes[:, 0] / MODEL_IMAGE_SIZE * intrinsics.width
-                new_img_bboxes[:, 3] = img_resized_bboxes[:, 3] / MODEL_IMAGE_SIZE * intrinsics.height
-                new_img_bboxes[:, 1] = img_resized_bboxes[:, 1] / MODEL_IMAGE_SIZE * intrinsics.height
-
-                final_image = utils.draw_2d_bboxes_on_img(final_image, new_img_bboxes)
-                if not path.exists(f"{img_path}ground_truth"):
-                    os.makedirs(f"{img_path}ground_truth")
-                if not path.exists(f"{img_path}ground_truth/{value['file_name']}"):
-                    original_image = utils.draw_2d_bboxes_on_img(
-                        f"{img_path}{value['file_name']}", new_img_bboxes)
-                else:
-                    original_image = utils.draw_2d_bboxes_on_img(
-                        f"{img_path}ground_truth/{value['file_name']}", new_img_bboxes)
-                plt.imsave(f"{img_path}ground_truth/{value['file_name']}", original_image)
-
-                plt.imsave(
-                    f"{img_path}ground_truth/image_{tfs[4]}{tfs[5]}_{key}.png", \
-                        final_image)
-                logger.info("image_%s saved as image_%s.png", \
-                    key, f"{tfs[4]}{tfs[5]}_{key.__str__()}")
-
-        if len(all_target_bboxes) == 0:
-            continue
-        torch.save(all_target_bboxes, f"./data/GH30_{folder}/all_target_bboxes.pt")
-        logger.info("all_target_bboxes.pt saved in %s", \
-            f"./data/GH30_{folder}/all_target_bboxes.pt")
+            plt.imsave(
+                f"{img_path}ground_truth/image_{tfs[4]}{tfs[5]}_{key}.png", \
+                    final_image)
+            logger.info("image_%s saved as image_%s.png", \
+                key, f"{tfs[4]}{tfs[5]}_{key.__str__()}")
+
+    return {
+        "folder": shard["folder"],
+        "scene": shard["scene"],
+        "targets": targets,
+        "planes": len(shard["roots"]),
+        "images": num_images,
+        "boxes": num_boxes,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def _log_shard(result: dict, done: int, total: int):
+    logger.info("[%s/%s] %s %s: %s planes, %s annotated images, %s boxes in %.1f s", done, \
+        total, result["folder"], result["scene"], result["planes"], result["images"], \
+            result["boxes"], result["seconds"])
 
 
 if __name__ == "__main__":
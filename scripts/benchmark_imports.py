@@ -0,0 +1,142 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Checks the import time of the command line scripts against a budget.
+
+Every script is started with `python -X importtime <script> --help` in a fresh interpreter, which
+imports everything on module level but does not run the pipeline. The import time is the sum of
+the cumulative times of the top level imports reported by -X importtime. Heavy dependencies
+(torch, kornia, pytorch3d, open3d, cv2, matplotlib, shapely, ...) are imported in the functions
+that use them, so a script that exceeds its budget most likely gained a module level import of
+one of them; the slowest imports are logged to find it.
+
+The budgets are read from import_budgets.yaml, which ships conservative static budgets.
+`benchmark_imports.py --record true` measures every script on the machine that runs the check and
+replaces them with the import time times `headroom`.
+"""
+import os
+import sys
+import time
+import logging
+import subprocess
+import yaml
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+SCRIPTS = (
+    "scripts/inference.py",
+    "scripts/evaluate.py",
+    "scripts/annotate.py",
+    "scripts/create_inference_metadata.py",
+)
+# seconds of module level imports until --help returns, without the interpreter's own imports
+BUDGET_FILE = "import_budgets.yaml"
+
+def main(
+    scripts: list = None,
+    repetitions: int = 3,
+    record: bool = False,
+    headroom: float = 1.5,
+    budget_file: str = BUDGET_FILE,
+    budget_scale: float = 1.0,
+    show_slowest: int = 10,
+    save_path: str = None,
+    log_level: str = "INFO"
+):
+    """
+    measures the import time of the scripts. With --record true the measured times times headroom
+    are written to budget_file as budgets, otherwise the run exits with an error if a script is
+    over its recorded budget times budget_scale.
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    scripts = scripts if scripts is not None else list(SCRIPTS)
+    budgets = {}
+    if not record:
+        if os.path.isfile(budget_file):
+            with open(budget_file, "r", encoding="utf-8") as file:
+                budgets = yaml.safe_load(file)["budgets"]
+        else:
+            logger.warning("%s not found, the import times are only reported", budget_file)
+
+    interpreter_modules = {module for module, _ in _run_importtime(["-c", "pass"])[0]}
+    results = {}
+    for script in scripts:
+        runs = [measure_import_time(script, interpreter_modules) for _ in range(repetitions)]
+        best = min(runs, key=lambda run: run["import_seconds"])
+        budget = budgets.get(script)
+        results[script] = {
+            "import_seconds": best["import_seconds"],
+            "wall_seconds": best["wall_seconds"],
+            "budget_seconds": budget * budget_scale if budget is not None else None,
+            "slowest": best["slowest"][:show_slowest],
+        }
+        logger.info("%s: %.3f s (budget %s s)", script, best["import_seconds"], \
+            results[script]["budget_seconds"])
+        for module, seconds in results[script]["slowest"]:
+            logger.debug("    %-40s %.3f s", module, seconds)
+
+    if save_path is not None:
+        with open(save_path, "w", encoding="utf-8") as file:
+            yaml.safe_dump(results, file)
+    if record:
+        with open(budget_file, "w", encoding="utf-8") as file:
+            yaml.safe_dump({
+                "headroom": headroom,
+                "python": sys.version.split()[0],
+                "measured": {script: result["import_seconds"] for script, result in results.items()},
+                "budgets": {script: round(result["import_seconds"] * headroom, 3) \
+                    for script, result in results.items()},
+            }, file)
+        logger.info("recorded import budgets in %s", budget_file)
+        return
+
+    over_budget = [script for script, result in results.items() \
+        if result["budget_seconds"] is not None \
+            and result["import_seconds"] > result["budget_seconds"]]
+    for script in over_budget:
+        logger.error("%s is over its import budget, slowest imports: %s", script, \
+            ", ".join(f"{module} {seconds:.2f} s" for module, seconds in results[script]["slowest"]))
+    if len(over_budget) > 0:
+        sys.exit(1)
+
+def measure_import_time(script: str, interpreter_modules=frozenset()) -> dict:
+    """ Runs script --help with -X importtime and returns the import time of its top level
+    imports and the slowest top level imports as (module, seconds). Modules in
+    interpreter_modules are imported by every interpreter on startup and are not counted.
+    """
+    top_level, wall_seconds = _run_importtime([script, "--help"])
+    top_level = [(module, seconds) for module, seconds in top_level \
+        if module not in interpreter_modules]
+    return {
+        "import_seconds": sum(seconds for _, seconds in top_level),
+        "wall_seconds": wall_seconds,
+        "slowest": sorted(top_level, key=lambda item: item[1], reverse=True),
+    }
+
+def parse_importtime(stderr: str) -> list:
+    """ Returns (module, cumulative seconds) of the top level imports of a -X importtime log. """
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        # nested imports are indented by two spaces per level
+        if module.startswith("  "):
+            continue
+        top_level.append((module.strip(), int(cumulative) / 1e6))
+    return top_level
+
+def _run_importtime(arguments: list):
+    start_time = time.perf_counter()
+    output = subprocess.run([sys.executable, "-X", "importtime", *arguments], \
+        capture_output=True, text=True, cwd=os.getcwd(), check=False)
+    wall_seconds = time.perf_counter() - start_time
+    if output.returncode != 0:
+        raise RuntimeError(f"{' '.join(arguments)} failed:\n{output.stderr[-2000:]}")
+    return parse_importtime(output.stderr), wall_seconds
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
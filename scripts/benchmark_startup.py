@@ -0,0 +1,86 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Compares the time until all networks are ready between the torch.hub/checkpoint startup and a
+model bundle. Every measurement runs in a fresh interpreter, so imports and file reads are
+included; the first run of each mode is reported separately as cold start (page cache and
+torch.hub cache as left by earlier runs).
+"""
+import os
+import sys
+import json
+import logging
+import statistics
+import subprocess
+import yaml
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+LOAD_SNIPPET = """
+import json, sys, time
+start_time = time.perf_counter()
+import torch
+import_seconds = time.perf_counter() - start_time
+mode, config_file, weights, bundle, device = sys.argv[1:6]
+if mode == "bundle":
+    from src.inference.model_bundle import load_model_bundle
+    load_model_bundle(bundle, device=device)
+else:
+    import yaml
+    from easydict import EasyDict
+    from src.inference.model import Model
+    from src.inference.correspondence_extractor import CorrespondenceExtractor
+    with open(config_file, "r", encoding="utf-8") as stream:
+        configs = EasyDict(yaml.safe_load(stream))
+    Model(configs, load_weights_from=weights).to(device)
+    CorrespondenceExtractor(device=device)
+    torch.hub.load("isl-org/ZoeDepth", "ZoeD_NK", pretrained=True).eval().to(device)
+if device == "cuda":
+    torch.cuda.synchronize()
+print(json.dumps({"import": import_seconds, "total": time.perf_counter() - start_time}))
+"""
+
+def main(
+    config_file: str = "config.yml",
+    load_weights_from: str = "./cyws-3d.ckpt",
+    model_bundle: str = "./cyws-3d.bundle.pt",
+    device: str = "cpu",
+    repetitions: int = 3,
+    save_path: str = "startup_benchmark.yaml",
+    log_level: str = "INFO"
+):
+    """
+    measures the startup of both modes repetitions times and writes the results to save_path.
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    if not os.path.isfile(model_bundle):
+        raise FileNotFoundError(f"{model_bundle} not found, run create_model_bundle.py first")
+
+    results = {}
+    for mode in ("legacy", "bundle"):
+        runs = [_measure(mode, config_file, load_weights_from, model_bundle, device) \
+            for _ in range(repetitions)]
+        warm = [run["total"] for run in runs[1:]]
+        results[mode] = {
+            "cold_seconds": runs[0]["total"],
+            "warm_seconds": statistics.median(warm) if len(warm) > 0 else None,
+            "import_seconds": statistics.median(run["import"] for run in runs),
+        }
+        logger.info("%s: cold %.2f s, warm %s s", mode, results[mode]["cold_seconds"], \
+            results[mode]["warm_seconds"])
+    results["device"] = device
+    results["repetitions"] = repetitions
+    with open(save_path, "w", encoding="utf-8") as file:
+        yaml.safe_dump(results, file)
+    logger.info("saved results to %s", save_path)
+
+def _measure(mode, config_file, load_weights_from, model_bundle, device) -> dict:
+    output = subprocess.run([sys.executable, "-c", LOAD_SNIPPET, mode, config_file, \
+        load_weights_from, model_bundle, device], check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
@@ -0,0 +1,39 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Converts the legacy batch_image*_predicted_bboxes.pt files into the columnar prediction store
+(see src/evaluation/prediction_store.py). The .pt files are kept unless --remove is set.
+"""
+import os
+import logging
+from src.evaluation.prediction_store import convert_pt_to_columnar
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def main(
+    path: str = "data/results",
+    remove: bool = False,
+    log_level: str = "INFO"
+):
+    """
+    converts all prediction .pt files found below path.
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    converted = 0
+    for root, _, files in sorted(os.walk(path)):
+        for file in sorted(files):
+            if not (file.startswith("batch_image") and file.endswith("_predicted_bboxes.pt")):
+                continue
+            pt_path = os.path.join(root, file)
+            store_path = convert_pt_to_columnar(pt_path)
+            logger.debug("converted %s to %s", pt_path, store_path)
+            if remove:
+                os.remove(pt_path)
+            converted += 1
+    logger.info("converted %s prediction files below %s", converted, path)
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
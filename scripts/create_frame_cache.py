@@ -0,0 +1,49 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Decodes the RGB and depth frames of the rooms once and packs them into a frame cache
+(see src/inference/frame_cache.py), which inference.py reads instead of the PNG files.
+"""
+import os
+import logging
+from src.inference.frame_cache import build_frame_cache, find_frames, find_rc3d_frames, \
+    find_kc3d_frames, RC3D_PARTS
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def main(
+    room: str = None,
+    path: str = None,
+    dataset: str = "gh30",
+    log_level: str = "INFO"
+):
+    """
+    builds the frame cache of a room (data/GH30_<room>) or of the dataset at path, a GH30 room or
+    scene directory (dataset gh30), an RC3D root with part1..4 (rc3d) or a KC3D root with
+    data_split.pkl (kc3d). Without arguments the caches of all GH30 rooms are built.
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    logging.getLogger("src.inference.frame_cache").setLevel(getattr(logging, log_level.upper()))
+    find = {"gh30": find_frames, "rc3d": find_rc3d_frames, "kc3d": find_kc3d_frames}[dataset]
+    if dataset != "gh30":
+        assert path is not None, f"the {dataset} dataset needs its path"
+    if dataset == "rc3d":
+        # rc3d.SubDataset opens the cache of its part
+        roots = [os.path.join(path, part) for part in RC3D_PARTS]
+    elif path is not None:
+        roots = [path]
+    elif room is not None:
+        roots = [f"data/GH30_{room}"]
+    else:
+        roots = sorted(os.path.join("data", d) for d in os.listdir("data") \
+            if d.startswith("GH30_") and os.path.isdir(os.path.join("data", d)))
+    for root in roots:
+        rgb_paths, depth_paths = find(root)
+        logger.info("%s: %s rgb frames, %s depth maps", root, len(rgb_paths), len(depth_paths))
+        build_frame_cache(root, rgb_paths, depth_paths)
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
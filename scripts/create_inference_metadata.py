@@ -31,8 +31,8 @@ import yaml
 import logging
 import numpy as np
 from PIL import Image
-from src.annotation import utils
-from src.annotation.projection import Intrinsic, Extrinsic
+from src.annotation.projection import Intrinsic
+from src.annotation.poses import ScenePoses
 from src.globals \
     import DATASET_FOLDER, IMAGE_FOLDER, ROOM, SCENE, PLANE, PCD_PATH, ANNO_PATH, \
         CAMERA_INFO_JSON_PATH, GT_COLOR
@@ -104,16 +104,12 @@ def main(
                 logger.debug("Skipping %s", root)
                 continue
             logger.debug(f"root: {root}")
-            transformations = utils.load_transformations(
-                f"{root}/{root.split('/')[-1]}_transformations.yaml")
-            logger.debug(f"transformations: {transformations}")
-            for key, value in transformations.items():
-                logger.debug("dict value %s", value)
-                extrinsics = Extrinsic()
-                extrinsics.from_dict(value)
-                logger.debug(f"extrinsics: {extrinsics}")
-                np.save(f"{root}/{value['file_name'][:-4]}_position.npy", extrinsics.position)
-                np.save(f"{root}/{value['file_name'][:-4]}_rotation.npy", extrinsics.rotation)
+            poses = ScenePoses.load(f"{root}/{root.split('/')[-1]}_transformations.yaml")
+            logger.debug("loaded %s poses", len(poses))
+            for file_name, position, rotation in zip(poses.file_names.tolist(), poses.translations, \
+                    poses.rotations):
+                np.save(f"{root}/{file_name[:-4]}_position.npy", position)
+                np.save(f"{root}/{file_name[:-4]}_rotation.npy", rotation)
             intrinsics = Intrinsic()
             intrinsics.from_json(f"data/ObChange/{CAMERA_INFO_JSON_PATH}")
             np.save(f"data/ObChange/{CAMERA_INFO_JSON_PATH[:-5]}.npy", intrinsics.matrix())
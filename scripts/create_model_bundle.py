@@ -0,0 +1,46 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Writes cyws3d, ZoeDepth and SuperPoint/SuperGlue into one model bundle (see
+src/inference/model_bundle.py). This is the only step that needs network access, it also fills
+the torch.hub cache with the ZoeDepth code. Afterwards inference.py --model_bundle starts offline.
+"""
+import logging
+import torch
+from src.inference.model import Model
+from src.inference.utils import get_easy_dict_from_yaml_file
+from src.inference.correspondence_extractor import CorrespondenceExtractor
+from src.inference.model_bundle import create_model_bundle, load_model_bundle, \
+    ZOEDEPTH_MODEL, ZOEDEPTH_REPO
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def main(
+    config_file: str = "config.yml",
+    load_weights_from: str = "./cyws-3d.ckpt",
+    save_path: str = "./cyws-3d.bundle.pt",
+    verify: bool = True,
+    log_level: str = "INFO"
+):
+    """
+    creates the model bundle and checks that it loads with the stored hashes.
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    logging.getLogger("src.inference.model_bundle").setLevel(getattr(logging, log_level.upper()))
+    configs = get_easy_dict_from_yaml_file(config_file)
+    model = Model(configs, load_weights_from=load_weights_from)
+    depth_predictor = torch.hub.load(ZOEDEPTH_REPO, ZOEDEPTH_MODEL, pretrained=True).eval()
+    correspondence_extractor = CorrespondenceExtractor()
+
+    hashes = create_model_bundle(save_path, model, depth_predictor, correspondence_extractor)
+    for name, sha256 in hashes.items():
+        logger.info("%s: %s", name, sha256)
+    if verify:
+        load_model_bundle(save_path, verify=True)
+        logger.info("verified %s", save_path)
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
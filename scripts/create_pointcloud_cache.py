@@ -0,0 +1,36 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Converts the plane clouds of the ObChange dataset once into the point cloud cache
+(see src/annotation/pointcloud_store.py), which annotate.py and viewer.py load memory mapped.
+"""
+import os
+import logging
+from src.annotation.pointcloud_store import build_point_cloud_cache, CACHE_ROOT
+from src.globals import DATASET_FOLDER, PCD_PATH
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def main(
+    room: str = "ALL",
+    voxel_sizes: list = (),
+    cache_root: str = CACHE_ROOT,
+    log_level: str = "INFO"
+):
+    """
+    caches the merged plane clouds of a room (default: all rooms), with optional voxel
+    downsampled levels of detail, e.g. --voxel_sizes [0.02,0.05].
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    logging.getLogger("src.annotation.pointcloud_store").setLevel(getattr(logging, log_level.upper()))
+    for root, _, files in sorted(os.walk(DATASET_FOLDER)):
+        if PCD_PATH not in files or (room != "ALL" and room not in root):
+            continue
+        manifest = build_point_cloud_cache(os.path.join(root, PCD_PATH), voxel_sizes, cache_root)
+        logger.info("%s: %s points, levels %s", root, manifest["num_points"], manifest["levels"])
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
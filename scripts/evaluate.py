@@ -7,13 +7,9 @@ Insert Module Description Here
 import os
 import yaml
 import logging
-import torch
 import json
 from pprint import pprint
-import matplotlib.pyplot as plt
 import numpy as np
-from torchmetrics.detection.mean_ap import MeanAveragePrecision
-from src.evaluation import eval_utils, eval_plotter
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -30,6 +26,12 @@ def main(
     """
     logger.setLevel(getattr(logging, log_level.upper()))
     logger.warning("logger set to %s", logger.level)
+    # torch, torchmetrics and matplotlib are imported here, so that --help does not load them
+    import torch
+    import matplotlib.pyplot as plt
+    from torchmetrics.detection.mean_ap import MeanAveragePrecision
+    from src.evaluation import eval_utils, eval_plotter
+    from src.evaluation.prediction_store import load_predictions
 
     # if room is None:
     #     raise ValueError("Please provide a room to evaluate")
@@ -64,14 +66,16 @@ def main(
         logger.info("processing config folder: %s", config_folder)
         all_preds = []
         all_targets = []
+        configuration_paths = []
         for folder in sorted(os.listdir(f"{path}/{config_folder}")):
             if ".DS" in folder:
                 continue
             if all(term in folder for term in search_terms):
                 logger.info("processing folder: %s", folder)
                 try:
-                    preds = torch.load(
-                        f"{path}/{config_folder}/{folder}/predictions/batch_image2_predicted_bboxes.pt")
+                    preds = load_predictions(
+                        f"{path}/{config_folder}/{folder}/predictions/batch_image2_predicted_bboxes",
+                        columns=("boxes", "scores", "labels"))
                     targets = torch.load(f"{path}/{config_folder}/{folder}/all_target_bboxes.pt")
                 except FileNotFoundError:
                     logger.warning("File not found")
@@ -91,6 +95,8 @@ def main(
                 f"{path}/{config_folder}/{folder}/input_metadata.yaml")
             all_preds.extend(preds)
             all_targets.extend(sorted_targets)
+            configuration_paths.append(
+                f"{path}/{config_folder}/{folder}/predictions/metadata_configurations.yaml")
 
         metric = MeanAveragePrecision(box_format='xyxy', iou_type='bbox', extended_summary=True, \
             iou_thresholds=iou_thresholds, rec_thresholds=rec_thresholds, \
@@ -121,7 +127,9 @@ def main(
                     "mAP": float(mAP["map"]),
                     "mAP_50": float(mAP["map_50"]),
                     "precision": float(mAP["precision"][0, 2, 0, 2]),
-                    "recall": float(mAP["recall"][0, 0, 2])
+                    "recall": float(mAP["recall"][0, 0, 2]),
+                    # precision mode and speed of the inference, to compare fp32/bf16/fp16 runs
+                    **eval_utils.summarise_inference_runs(configuration_paths)
                 }
             }, file)
             logger.info("mAP written to file")
@@ -153,6 +161,13 @@ def main(
         # plt.tight_layout()
         # plt.savefig(f"data/results/precision_recall_curve.png")
 
+    # accuracy against speed of the precision modes of run.sh (fp32 / bf16 / fp16 / int8)
+    with open("data/results/metrics.yaml", "r", encoding="utf-8") as file:
+        metrics = yaml.safe_load(file) or {}
+    with open("data/results/precision_report.yaml", "w", encoding="utf-8") as file:
+        yaml.dump(eval_utils.precision_report(metrics), file)
+    logger.info("precision report written to data/results/precision_report.yaml")
+
 if __name__ == "__main__":
     from jsonargparse import CLI
 
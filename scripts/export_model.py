@@ -0,0 +1,36 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Exports the encoder and decoder of the change detection model as TorchScript and ONNX
+(see src/inference/export.py). The registration between them runs eagerly with the tensors from
+compute_registration_tensors.
+"""
+import logging
+from src.inference.model import Model
+from src.inference.export import export_model
+from src.inference.utils import get_easy_dict_from_yaml_file
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def main(
+    config_file: str = "config.yml",
+    load_weights_from: str = "./cyws-3d.ckpt",
+    save_dir: str = "./export",
+    batch_size: int = 1,
+    formats: list = ("torchscript", "onnx"),
+    log_level: str = "INFO"
+):
+    """
+    writes encoder.ts/decoder.ts and encoder.onnx/decoder.onnx to save_dir.
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    logging.getLogger("src.inference.export").setLevel(getattr(logging, log_level.upper()))
+    configs = get_easy_dict_from_yaml_file(config_file)
+    model = Model(configs, load_weights_from=load_weights_from).eval()
+    export_model(model, save_dir, batch_size=batch_size, formats=tuple(formats))
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
@@ -11,25 +11,6 @@ import yaml
 import logging
 from importlib.metadata import version
 from easydict import EasyDict
-try:
-    from src.inference.model import Model
-    from src.inference.utils import create_batch_from_metadata, fill_in_the_missing_information, \
-        prepare_batch_for_model, visualise_predictions, plot_correspondences, \
-            undo_imagenet_normalization
-    from src.inference.correspondence_extractor import CorrespondenceExtractor
-except ImportError:
-    from model import Model
-    from utils import create_batch_from_metadata, fill_in_the_missing_information, \
-        prepare_batch_for_model, visualise_predictions, plot_correspondences, \
-            undo_imagenet_normalization
-    from correspondence_extractor import CorrespondenceExtractor
-import torch
-try:
-    from src.inference.geometry import remove_bboxes_with_area_less_than, \
-        suppress_overlapping_bboxes, keep_matching_bboxes, filter_low_confidence_bboxes
-except ImportError:
-    from geometry import remove_bboxes_with_area_less_than, suppress_overlapping_bboxes, \
-        keep_matching_bboxes, filter_low_confidence_bboxes
 from src.globals import BBOX_AREA, CONFIDENCE_THRESHOLD, MAX_PREDICTIONS
 
 # check required version of cyws3d-pipeline (defined in setup.py)
@@ -49,13 +30,77 @@ def main(
     keep_matching_bboxes_only: bool = False,
     max_predictions_to_display: int = MAX_PREDICTIONS,
     minimum_confidence_threshold: float = CONFIDENCE_THRESHOLD,
+    visualise: bool = True,
+    visualisation_workers: int = 2,
+    visualisation_queue_size: int = 16,
+    resume: bool = False,
+    use_frame_cache: bool = True,
+    loader_workers: int = 4,
+    precision: str = "fp32",
+    compile_model: bool = False,
+    compile_cache_dir: str = ".cache/inductor",
+    model_bundle: str = None,
     log_level: str = "INFO"
 ):
     """ 
     runs the inference with cyws3d.
+
+    Prediction images are drawn and saved on background threads (see VisualisationWriter);
+    pass --visualise false to skip them entirely.
+
+    Predictions are flushed to disk after every batch. With --resume true, image pairs that were
+    already predicted by an interrupted run are skipped.
+
+    The input frames are decoded on loader_workers threads (0 reads them sequentially).
+    Frames are read from the frame cache of the room if it was built with create_frame_cache.py.
+
+    precision selects the model precision: fp32, bf16 or fp16 (autocast of the backbone, unet and
+    fusion blocks), or int8 for the cpu model built by quantize.py. It is stored with the
+    prediction time in metadata_configurations.yaml.
+
+    With --compile_model true the static shape parts of the model are compiled with torch.compile
+    (artifacts cached in compile_cache_dir) and warmed up before the first batch is timed.
+
+    With --model_bundle <path> all networks are loaded from a bundle written by
+    create_model_bundle.py instead of torch.hub and the checkpoint, which needs no network access.
     """
     if room is None:
         raise ValueError("Please provide the room name as command line argument")
+
+    # torch and the model stack are imported here, not at module level, so that --help and
+    # argument errors return without loading them
+    try:
+        from src.inference.model import Model
+        from src.inference.quantization import load_quantized_model, quantized_model_path
+        from src.inference.model_bundle import load_model_bundle
+        from src.inference.utils import create_batch_from_metadata, fill_in_the_missing_information, \
+            undo_imagenet_normalization
+        from src.inference.batch_assembler import BatchAssembler
+        from src.inference.visualisation import VisualisationWriter
+        from src.inference.frame_cache import FrameCache
+        from src.inference.packed_frames import resident_bytes
+        from src.inference.correspondence_extractor import CorrespondenceExtractor
+    except ImportError:
+        from model import Model
+        from quantization import load_quantized_model, quantized_model_path
+        from model_bundle import load_model_bundle
+        from utils import create_batch_from_metadata, fill_in_the_missing_information, \
+            undo_imagenet_normalization
+        from batch_assembler import BatchAssembler
+        from visualisation import VisualisationWriter
+        from frame_cache import FrameCache
+        from packed_frames import resident_bytes
+        from correspondence_extractor import CorrespondenceExtractor
+    import torch
+    try:
+        from src.inference.geometry import remove_bboxes_with_area_less_than, \
+            suppress_overlapping_bboxes, keep_matching_bboxes, filter_low_confidence_bboxes
+        from src.evaluation.prediction_store import PredictionWriter
+    except ImportError:
+        from geometry import remove_bboxes_with_area_less_than, suppress_overlapping_bboxes, \
+            keep_matching_bboxes, filter_low_confidence_bboxes
+        from prediction_store import PredictionWriter
+
     input_metadata = f"data/GH30_{room}/input_metadata.yaml"
 
     save_path = os.path.join(
@@ -74,29 +119,73 @@ def main(
                 filter_predictions_with_area_under, keep_matching_bboxes_only,
                 max_predictions_to_display, minimum_confidence_threshold)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device("cuda" if torch.cuda.is_available() and precision != "int8" else "cpu")
     torch.cuda.empty_cache()
 
     configs = get_easy_dict_from_yaml_file(config_file)
-    model = Model(configs, load_weights_from=load_weights_from).to(device)
-    correspondence_extractor = CorrespondenceExtractor(device=device)
-    depth_predictor = torch.hub.load(
-        "isl-org/ZoeDepth", "ZoeD_NK", pretrained=True).eval().to(device)
+    start_time = time.perf_counter()
+    if model_bundle is not None and precision != "int8":
+        networks = load_model_bundle(model_bundle, device=device, precision=precision)
+        model = networks["model"]
+        correspondence_extractor = networks["correspondence_extractor"]
+        depth_predictor = networks["depth_predictor"]
+    else:
+        if precision == "int8":
+            model = load_quantized_model(quantized_model_path(load_weights_from), configs)
+        else:
+            model = Model(configs, load_weights_from=load_weights_from, \
+                precision=precision).to(device)
+        correspondence_extractor = CorrespondenceExtractor(device=device)
+        depth_predictor = torch.hub.load(
+            "isl-org/ZoeDepth", "ZoeD_NK", pretrained=True).eval().to(device)
+    logger.info("loaded the networks in %.2f s", time.perf_counter() - start_time)
 
-    image1_predictions = []
-    image2_predictions = []
+    image1_predictions = PredictionWriter(
+        f"{save_path}/batch_image1_predicted_bboxes", resume=resume)
+    image2_predictions = PredictionWriter(
+        f"{save_path}/batch_image2_predicted_bboxes", resume=resume)
 
     batch_metadata = get_easy_dict_from_yaml_file(input_metadata)
-    full_batch = create_batch_from_metadata(batch_metadata, "cpu")
+    pair_indices = get_pending_pair_indices(
+        batch_metadata["batch"], image1_predictions, image2_predictions)
+    if len(pair_indices) < len(batch_metadata["batch"]):
+        logger.info("Resuming: skipping %s already predicted image pairs", \
+            len(batch_metadata["batch"]) - len(pair_indices))
+    frame_cache = FrameCache.open(f"data/GH30_{room}") if use_frame_cache else None
+    if use_frame_cache and frame_cache is None:
+        logger.info("No frame cache for %s, run create_frame_cache.py to skip decoding", room)
+    full_batch = create_batch_from_metadata(
+        {"batch": [batch_metadata["batch"][i] for i in pair_indices]}, "cpu", frame_cache,
+        num_workers=loader_workers, packed=True)
+    logger.info("Resident input frames: %.1f MB", resident_bytes(full_batch) / 2**20)
+    if frame_cache is not None:
+        logger.info("Frame cache: %s hits, %s misses", frame_cache.hits, frame_cache.misses)
     batch_size = configs.batch_size
     if len(full_batch["image1"]) % batch_size != 0:
         number_of_batches = len(full_batch["image1"]) // batch_size + 1
     else:
         number_of_batches = len(full_batch["image1"]) // batch_size
 
+    if compile_model and precision != "int8":
+        start_time = time.time()
+        model.compile_stages(cache_dir=compile_cache_dir)
+        # the last batch may be smaller and is compiled for its own shape
+        model.warmup(batch_sizes=sorted({batch_size, len(full_batch["image1"]) % batch_size} - {0}))
+        logger.info("Time taken to compile and warm up the model: %.2f seconds", \
+            time.time() - start_time)
+
     logger.info("Batch size: %s", batch_size)
     logger.info("Number of batches: %s", number_of_batches)
-    img_cntr = 0
+    visualisation_writer = VisualisationWriter(
+        num_workers=visualisation_workers,
+        max_queue_size=visualisation_queue_size,
+        enabled=visualise)
+    batch_assembler = BatchAssembler(batch_size, device=device)
+    full_batch = batch_assembler.pin(full_batch)
+    def get_host_batch(n):
+        return {key: value[n*batch_size:(n+1)*batch_size] for key, value in full_batch.items()}
+    next_batch = batch_assembler.to_device(get_host_batch(0)) if number_of_batches > 0 else None
+    predict_seconds, predicted_pairs = 0.0, 0
     for n in range(number_of_batches):
         torch.cuda.empty_cache()
         try:
@@ -105,11 +194,10 @@ def main(
             logger.debug("GPU not available")
         logger.info("Processing batch %s", n)
 
-        batch = {key: value[n*batch_size:(n+1)*batch_size]\
-             for key, value in full_batch.items()}
-        for key in batch.keys():
-            batch[key] = [item.to(device) if isinstance(item, torch.Tensor) else item \
-                for item in batch[key]]
+        batch = batch_assembler.wait(next_batch)
+        if n + 1 < number_of_batches:
+            # copy the next batch while this one is processed
+            next_batch = batch_assembler.to_device(get_host_batch(n + 1))
 
         start_time = time.time()
         batch = fill_in_the_missing_information(
@@ -117,19 +205,27 @@ def main(
         logger.info("Time taken to fill in the missing information: %.2f seconds", \
             time.time() - start_time)
         start_time = time.time()
-        batch = prepare_batch_for_model(batch, device=device)
+        batch = batch_assembler.assemble(batch)
         logger.info("Time taken to prepare the batch for the model: %.2f seconds", \
             time.time() - start_time)
         start_time = time.time()
         batch_image1_predicted_bboxes, batch_image2_predicted_bboxes = model.predict(batch)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        predict_seconds += time.time() - start_time
+        predicted_pairs += len(batch_image1_predicted_bboxes)
         logger.info("Time taken to predict: %.2f seconds", time.time() - start_time)
 
         for i, (image1_bboxes, image2_bboxes) in enumerate(zip(batch_image1_predicted_bboxes,
                                                                 batch_image2_predicted_bboxes)):
+            img_cntr = pair_indices[n*batch_size + i]
+            pair = batch_metadata["batch"][img_cntr]
             logger.info("Processing image pair %s", img_cntr)
-            # plot_correspondences(batch["image1"][i].cpu(), batch["image2"][i].cpu(),
-            #                     batch["points1"][i].cpu(), batch["points2"][i].cpu(),
-            #                     save_path=f"{save_path}/correspondences_{img_cntr}.png")
+            # visualisation_writer.submit_correspondences(
+            #     undo_imagenet_normalization(batch["image1"][i].cpu()),
+            #     undo_imagenet_normalization(batch["image2"][i].cpu()),
+            #     batch["points1"][i], batch["points2"][i],
+            #     save_path=f"{save_path}/correspondences_{img_cntr}.png")
             image1_bboxes, image2_bboxes = \
                 image1_bboxes[0].cpu().numpy(), image2_bboxes[0].cpu().numpy()
             image1_bboxes = remove_bboxes_with_area_less_than(
@@ -160,41 +256,47 @@ def main(
                 image1_bboxes, scores1, minimum_confidence_threshold)
             image2_bboxes, scores2 = filter_low_confidence_bboxes(
                 image2_bboxes, scores2, minimum_confidence_threshold)
-            visualise_predictions(undo_imagenet_normalization(batch["image1"][i].cpu()),
-                                    undo_imagenet_normalization(batch["image2"][i].cpu()),
-                                    image1_bboxes[:max_predictions_to_display],
-                                    image2_bboxes[:max_predictions_to_display],
-                                        scores1[:max_predictions_to_display],
-                                        scores2[:max_predictions_to_display],
-                                            save_path=f"{save_path}/prediction_{img_cntr}.png")
-
-            image1_predictions.append(dict(
-                image=f"prediction_{img_cntr}", 
-                boxes=torch.round(torch.as_tensor(
-                    image1_bboxes[:max_predictions_to_display], dtype=torch.float32)),
-                scores=torch.as_tensor(scores1[:max_predictions_to_display], dtype=torch.float32),
-                labels=torch.zeros(
-                    len(image1_bboxes[:max_predictions_to_display]), dtype=torch.int32))
-                )
-            image2_predictions.append(dict(
-                image=f"prediction_{img_cntr}", 
-                boxes=torch.round(torch.as_tensor(
-                    image2_bboxes[:max_predictions_to_display], dtype=torch.float32)),
-                scores=torch.as_tensor(scores2[:max_predictions_to_display], dtype=torch.float32),
-                labels=torch.zeros(
-                    len(image2_bboxes[:max_predictions_to_display]), dtype=torch.int32))
-                )
-            img_cntr += 1
+            # a no-op with --visualise false
+            visualisation_writer.submit_predictions(
+                undo_imagenet_normalization(batch["image1"][i].cpu()),
+                undo_imagenet_normalization(batch["image2"][i].cpu()),
+                image1_bboxes[:max_predictions_to_display],
+                image2_bboxes[:max_predictions_to_display],
+                scores1[:max_predictions_to_display],
+                scores2[:max_predictions_to_display],
+                save_path=f"{save_path}/prediction_{img_cntr}.png")
+
+            image1_predictions.append(
+                f"prediction_{img_cntr}",
+                torch.round(torch.as_tensor(
+                    image1_bboxes[:max_predictions_to_display], dtype=torch.float32)).numpy(),
+                scores1[:max_predictions_to_display],
+                index=img_cntr, key=get_pair_key(pair))
+            image2_predictions.append(
+                f"prediction_{img_cntr}",
+                torch.round(torch.as_tensor(
+                    image2_bboxes[:max_predictions_to_display], dtype=torch.float32)).numpy(),
+                scores2[:max_predictions_to_display],
+                index=img_cntr, key=get_pair_key(pair))
+
+        # append the predictions of this batch, so a crash does not lose them
+        image1_predictions.flush()
+        image2_predictions.flush()
 
+    visualisation_writer.close()
     # save the batches for calculating mAP
-    torch.save(image1_predictions, f'{save_path}/batch_image1_predicted_bboxes.pt')
-    torch.save(image2_predictions, f'{save_path}/batch_image2_predicted_bboxes.pt')
+    image1_predictions.close()
+    image2_predictions.close()
     # Save configuration parameters to a YAML file
     configurations = {
         "filter_predictions_with_area_under": filter_predictions_with_area_under,
         "keep_matching_bboxes_only": keep_matching_bboxes_only,
         "max_predictions_to_display": max_predictions_to_display,
-        "minimum_confidence_threshold": minimum_confidence_threshold
+        "minimum_confidence_threshold": minimum_confidence_threshold,
+        "precision": precision,
+        "compile_model": compile_model,
+        "predict_seconds": predict_seconds,
+        "predicted_pairs": predicted_pairs
     }
     existing_configurations = {}
     existing_file_path = os.path.join(save_path, "metadata_configurations.yaml")
@@ -205,6 +307,27 @@ def main(
     with open(existing_file_path, "w") as file:
         yaml.dump(existing_configurations, file)
 
+def get_pair_key(pair):
+    """
+    Identifies an image pair of the input metadata for resuming.
+    """
+    return f"{pair['image1']}|{pair['image2']}"
+
+def get_pending_pair_indices(pairs, image1_predictions, image2_predictions):
+    """
+    Returns the indices of the image pairs that have no stored predictions for both images yet.
+    A stored prediction only counts if it was made for the same image pair at that index.
+    """
+    completed1 = image1_predictions.completed()
+    completed2 = image2_predictions.completed()
+    pending = []
+    for i, pair in enumerate(pairs):
+        key = get_pair_key(pair)
+        if completed1.get(i) == key and completed2.get(i) == key:
+            continue
+        pending.append(i)
+    return pending
+
 def get_easy_dict_from_yaml_file(path_to_yaml_file):
     """
     Reads a yaml and returns it as an easy dict.
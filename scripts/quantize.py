@@ -0,0 +1,56 @@
+#! usr/bin/env python3.9
+# Copyright (c) 2024 TU Wien
+"""
+Builds the int8 cpu model (see src/inference/quantization.py) from the fp32 checkpoint. The unet
+encoder, the unet decoder and the fusion block are calibrated on the image pairs of the rooms'
+input metadata. The result is saved next to the checkpoint and used by inference.py --precision
+int8.
+"""
+import os
+import logging
+from src.inference.model import Model
+from src.inference.utils import get_easy_dict_from_yaml_file
+from src.inference.quantization import quantize_model, quantized_model_path, save_quantized_model
+from src.inference.utils import create_batch_from_metadata, prepare_batch_for_model
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+def main(
+    config_file: str = "config.yml",
+    load_weights_from: str = "./cyws-3d.ckpt",
+    rooms: list = ("LivingArea", "Office", "SmallRoom", "Kitchen"),
+    num_calibration_pairs: int = 32,
+    log_level: str = "INFO"
+):
+    """
+    quantizes the model and saves it as <checkpoint>.int8.pt.
+    """
+    logger.setLevel(getattr(logging, log_level.upper()))
+    configs = get_easy_dict_from_yaml_file(config_file)
+    model = Model(configs, load_weights_from=load_weights_from)
+
+    pairs = []
+    for room in rooms:
+        input_metadata = f"data/GH30_{room}/input_metadata.yaml"
+        if not os.path.exists(input_metadata):
+            logger.warning("%s not found, run create_inference_metadata.py first", input_metadata)
+            continue
+        pairs.extend(get_easy_dict_from_yaml_file(input_metadata)["batch"])
+    if len(pairs) == 0:
+        raise ValueError("no image pairs found for calibration")
+    # spread the calibration pairs over all rooms
+    step = max(len(pairs) // num_calibration_pairs, 1)
+    pairs = [{"image1": pair["image1"], "image2": pair["image2"], \
+        "registration_strategy": pair["registration_strategy"]} \
+        for pair in pairs[::step][:num_calibration_pairs]]
+    batch = prepare_batch_for_model(create_batch_from_metadata({"batch": pairs}, "cpu"))
+    logger.info("calibrating on %s image pairs", len(batch["image1"]))
+
+    model = quantize_model(model, batch["image1"], batch["image2"], batch_size=configs.batch_size)
+    save_quantized_model(model, quantized_model_path(load_weights_from))
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
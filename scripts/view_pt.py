@@ -8,6 +8,7 @@ import torch
 import numpy as np
 from pprint import pprint
 from pprint import pp
+from src.evaluation.prediction_store import load_predictions
 
 CONFIG_FOLDER = "area-400_matching-false_strategy-3d_confidence-03"
 FOLDER = "GH30_SmallRoom_05-17_perspective-2d_depth-true_01"
@@ -20,7 +21,9 @@ def main(room: str = None):
     target_bboxes = torch.load(f"data/results/{CONFIG_FOLDER}/{FOLDER}/all_target_bboxes.pt")
     pprint(target_bboxes)
     print("\n\npredictions:\n")
-    predicted_bboxes = torch.load(f"data/results/{CONFIG_FOLDER}/{FOLDER}/predictions/batch_image2_predicted_bboxes.pt")
+    predicted_bboxes = load_predictions(
+        f"data/results/{CONFIG_FOLDER}/{FOLDER}/predictions/batch_image2_predicted_bboxes",
+        columns=("image", "boxes", "scores", "labels"))
     pprint(predicted_bboxes)
 
 
@@ -14,5 +14,8 @@ setup(
     license='MIT',
     packages=find_packages(),
     scripts=['scripts/annotate.py', 'scripts/inference.py', 'scripts/run_tests.py', \
-        'scripts/create_inference_metadata.py', 'scripts/evaluate.py', 'scripts/view_pt.py']
+        'scripts/create_inference_metadata.py', 'scripts/evaluate.py', 'scripts/view_pt.py', \
+        'scripts/convert_predictions.py', 'scripts/create_frame_cache.py', 'scripts/quantize.py', \
+        'scripts/export_model.py', 'scripts/create_model_bundle.py', 'scripts/benchmark_startup.py', \
+        'scripts/benchmark_imports.py', 'scripts/create_pointcloud_cache.py']
 )
@@ -0,0 +1,149 @@
+# Copyright (c) 2024 TU Wien
+"""
+Parsed and cached ground truth annotations of a point cloud.
+
+A .anno file has one line per object: the object name, the indices of its points and a last
+token that is not an index. AnnotationIndex parses it once into a flat int32 array of all point
+indices and the offsets of every object in it, and caches that as binary sidecar next to the
+file:
+
+    merged_plane_clouds_ds002_GT.anno
+    merged_plane_clouds_ds002_GT.anno.npz   names, indices, offsets and the stat/sha256 of the .anno
+
+The sidecar is used while the .anno file has the same mtime and size. If only the mtime changed,
+the sha256 decides whether it is still valid.
+"""
+import os
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+CACHE_SUFFIX = ".npz"
+
+
+class AnnotationIndex():
+    ''' Object names and point indices of an annotation
+
+    Args:
+        names: object names in the order of the file
+        indices: flat (M,) int32 array of the point indices of all objects
+        offsets: (O + 1,) int64 array, the indices of object i are indices[offsets[i]:offsets[i + 1]]
+    '''
+    def __init__(self, names: list, indices: np.array, offsets: np.array):
+        assert len(offsets) == len(names) + 1, "offsets must have one entry more than names"
+        self.names = list(names)
+        self.indices = indices
+        self.offsets = offsets
+
+    @classmethod
+    def load(cls, path: str, use_cache: bool = True):
+        """ Returns the index of a .anno file, from its sidecar if that is up to date. """
+        cache_path = path + CACHE_SUFFIX
+        if use_cache and os.path.isfile(cache_path):
+            index = cls._load_cache(path, cache_path)
+            if index is not None:
+                return index
+        index = cls.parse(path)
+        if use_cache:
+            index.save(path, cache_path)
+        return index
+
+    @classmethod
+    def parse(cls, path: str):
+        """ Parses a .anno file. An object that appears twice keeps the indices of its last line. """
+        objects = {}
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                tokens = line.split(maxsplit=1)
+                if len(tokens) == 0:
+                    continue
+                # the last token of a line is not a point index
+                values = tokens[1].rsplit(maxsplit=1) if len(tokens) > 1 else []
+                objects[tokens[0]] = np.fromstring(values[0], dtype=np.int64, sep=" ") \
+                    if len(values) > 1 else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(objects) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(indices) for indices in objects.values()])
+        indices = np.concatenate(list(objects.values())).astype(np.int32) \
+            if len(objects) > 0 else np.zeros(0, dtype=np.int32)
+        return cls(list(objects), indices, offsets)
+
+    def save(self, path: str, cache_path: str = None, sha256: str = None) -> None:
+        """ Writes the sidecar of the .anno file at path. A read only dataset is not an error. """
+        cache_path = cache_path if cache_path is not None else path + CACHE_SUFFIX
+        sha256 = sha256 if sha256 is not None else _sha256(path)
+        stat = os.stat(path)
+        tmp_path = f"{cache_path}.tmp"
+        try:
+            with open(tmp_path, "wb") as file:
+                np.savez(file, format_version=FORMAT_VERSION, names=np.array(self.names, dtype=str),
+                         indices=self.indices, offsets=self.offsets, mtime=stat.st_mtime_ns,
+                         size=stat.st_size, sha256=sha256)
+            os.replace(tmp_path, cache_path)
+        except OSError as error:
+            logger.warning("could not cache %s: %s", path, error)
+
+    def __len__(self):
+        return len(self.names)
+
+    def object_indices(self, i: int) -> np.array:
+        """ Returns the point indices of object i (a view into the flat array). """
+        return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+    def items(self):
+        """ Iterates over (name, point indices) as the dictionary of read_annotation. """
+        for i, name in enumerate(self.names):
+            yield name, self.object_indices(i)
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def object_labels(self) -> np.array:
+        """ (M,) int32 object index of every entry of indices, a point annotated for several
+        objects appears once per object.
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.offsets))
+
+    def labels(self, num_points: int) -> np.array:
+        """ (num_points,) int32 object index of every point, -1 for points without object. A point
+        annotated for several objects belongs to the last one.
+        """
+        labels = np.full(num_points, -1, dtype=np.int32)
+        labels[self.indices] = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.offsets))
+        return labels
+
+    def colorize(self, colors: np.array, colour: np.array) -> np.array:
+        """ Sets the colour of all annotated points in an (N, 3) color array in place. """
+        colors[self.indices] = colour
+        return colors
+
+    @classmethod
+    def _load_cache(cls, path: str, cache_path: str):
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                if int(cache["format_version"]) != FORMAT_VERSION:
+                    return None
+                stat = os.stat(path)
+                touched = int(cache["mtime"]) != stat.st_mtime_ns
+                if touched or int(cache["size"]) != stat.st_size:
+                    if int(cache["size"]) != stat.st_size or str(cache["sha256"]) != _sha256(path):
+                        return None
+                index = cls(cache["names"].tolist(), cache["indices"], cache["offsets"])
+                sha256 = str(cache["sha256"])
+        except (OSError, KeyError, ValueError) as error:
+            logger.warning("ignoring annotation cache %s: %s", cache_path, error)
+            return None
+        if touched:
+            # same content with a new mtime, store the new stat so later loads skip the hash
+            index.save(path, cache_path, sha256)
+        return index
+
+
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
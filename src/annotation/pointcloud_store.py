@@ -0,0 +1,207 @@
+# Copyright (c) 2024 TU Wien
+"""
+Cache of the ObChange plane clouds as memory mapped arrays.
+
+Reading merged_plane_clouds_ds002.pcd with Open3D parses the whole file on every run. The store
+converts every PCD once into plain .npy arrays with a manifest, optionally with voxel downsampled
+levels of detail:
+
+    .cache/pointclouds/ObChange/Office/scene2/planes/2/merged_plane_clouds_ds002/
+        points.npy              (N, 3) float32, or float64 if the source has more precision
+        colors.npy              (N, 3) uint8, or float32 if the colors are not 8 bit values
+        lod_0.05/points.npy     voxel centroids for a voxel size of 0.05
+        lod_0.05/colors.npy
+        manifest.yaml           {format_version, source, mtime, size, num_points, levels}
+
+Loading memory maps the arrays, nothing is parsed. PCD files store float32 coordinates and 8 bit
+colors, so the cached arrays hold the same values Open3D reads. The cache is rebuilt when the
+source file changes (mtime or size) or a requested level is missing.
+"""
+import os
+import shutil
+import logging
+import yaml
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+# anchored to the repository, so that scripts and viewer.py (run from src/annotation) share a cache
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_ROOT = os.path.join(REPO_ROOT, "data")
+CACHE_ROOT = os.path.join(REPO_ROOT, ".cache", "pointclouds")
+MANIFEST_FILE = "manifest.yaml"
+
+
+class CachedPointCloud():
+    ''' Memory mapped points and colors of a point cloud and its levels of detail
+
+    Args:
+        cache_path: directory of the cached cloud
+        manifest: its manifest
+    '''
+    def __init__(self, cache_path: str, manifest: dict):
+        self.cache_path = cache_path
+        self.manifest = manifest
+        self.points = np.load(os.path.join(cache_path, "points.npy"), mmap_mode="r")
+        self._colors = np.load(os.path.join(cache_path, "colors.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def colors(self) -> np.array:
+        """ (N, 3) float64 colors in [0, 1], as Open3D returns them. """
+        return _to_unit_colors(self._colors)
+
+    @property
+    def voxel_sizes(self) -> list:
+        return sorted(self.manifest["levels"])
+
+    def level(self, voxel_size: float) -> tuple:
+        """ Returns (points, colors) of the level of detail with the given voxel size. """
+        if voxel_size not in self.manifest["levels"]:
+            raise KeyError(f"no level of detail with voxel size {voxel_size} in {self.cache_path}")
+        directory = os.path.join(self.cache_path, _level_name(voxel_size))
+        return np.load(os.path.join(directory, "points.npy"), mmap_mode="r"), \
+            _to_unit_colors(np.load(os.path.join(directory, "colors.npy"), mmap_mode="r"))
+
+    def to_open3d(self, voxel_size: float = None):
+        """ Returns the cloud (or one of its levels) as open3d point cloud, for visualization. """
+        import open3d as o3d
+        points, colors = (self.points, self.colors) if voxel_size is None \
+            else self.level(voxel_size)
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.asarray(points, np.float64)))
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+        return pcd
+
+
+def load_point_cloud(path: str, voxel_sizes=(), cache_root: str = CACHE_ROOT) -> CachedPointCloud:
+    """ Loads a PCD file through the cache, converting it on the first call.
+
+    Args:
+        path: path of the .pcd file
+        voxel_sizes: levels of detail that have to be available
+        cache_root: root directory of the cache, the cloud is cached under its relative path
+
+    Returns:
+        the cached point cloud
+    """
+    cache_path = point_cloud_cache_path(path, cache_root)
+    manifest = _read_manifest(cache_path)
+    if manifest is None or not _is_current(path, manifest) \
+            or not set(voxel_sizes) <= set(manifest["levels"]):
+        levels = set(voxel_sizes) | (set(manifest["levels"]) if manifest is not None \
+            and _is_current(path, manifest) else set())
+        manifest = build_point_cloud_cache(path, sorted(levels), cache_root)
+    return CachedPointCloud(cache_path, manifest)
+
+
+def build_point_cloud_cache(path: str, voxel_sizes=(), cache_root: str = CACHE_ROOT) -> dict:
+    """ Reads a PCD file with Open3D and writes its cache. Returns the manifest. """
+    import open3d as o3d
+    cache_path = point_cloud_cache_path(path, cache_root)
+    pcd = o3d.io.read_point_cloud(path)
+    points = _pack_points(np.asarray(pcd.points))
+    colors = _pack_colors(np.asarray(pcd.colors))
+    stat = os.stat(path)
+
+    tmp_path = f"{cache_path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "points.npy"), points)
+    np.save(os.path.join(tmp_path, "colors.npy"), colors)
+    levels = {}
+    for voxel_size in voxel_sizes:
+        level_points, level_colors = voxel_downsample(points, _to_unit_colors(colors), voxel_size)
+        os.makedirs(os.path.join(tmp_path, _level_name(voxel_size)))
+        np.save(os.path.join(tmp_path, _level_name(voxel_size), "points.npy"), level_points)
+        np.save(os.path.join(tmp_path, _level_name(voxel_size), "colors.npy"), \
+            level_colors.astype(np.float32))
+        levels[float(voxel_size)] = len(level_points)
+    manifest = {"format_version": FORMAT_VERSION, "source": os.path.abspath(path), \
+        "mtime": stat.st_mtime_ns, "size": stat.st_size, "num_points": len(points), \
+            "levels": levels}
+    with open(os.path.join(tmp_path, MANIFEST_FILE), "w", encoding="utf-8") as file:
+        yaml.safe_dump(manifest, file)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+    logger.info("cached %s points of %s in %s", len(points), path, cache_path)
+    return manifest
+
+
+def voxel_downsample(points: np.array, colors: np.array, voxel_size: float) -> tuple:
+    """ Replaces the points of every voxel by their centroid and mean color.
+
+    Returns:
+        (M, 3) float32 points and (M, 3) float64 colors
+    """
+    voxels = np.floor(points / voxel_size).astype(np.int64)
+    _, inverse, counts = np.unique(voxels, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    level_points = np.zeros((len(counts), 3))
+    level_colors = np.zeros((len(counts), 3))
+    for axis in range(3):
+        level_points[:, axis] = np.bincount(inverse, points[:, axis], len(counts)) / counts
+        level_colors[:, axis] = np.bincount(inverse, colors[:, axis], len(counts)) / counts
+    return level_points.astype(np.float32), level_colors
+
+
+def point_cloud_cache_path(path: str, cache_root: str = CACHE_ROOT) -> str:
+    """ Returns the cache directory of a PCD file below cache_root: its path relative to the data
+    folder of the repository, or relative to the repository for other files inside it.
+    """
+    path = os.path.abspath(path)
+    if path.startswith(DATA_ROOT + os.sep):
+        relative = os.path.relpath(path, DATA_ROOT)
+    elif path.startswith(REPO_ROOT + os.sep):
+        relative = os.path.relpath(path, REPO_ROOT)
+    else:
+        relative = path.lstrip(os.sep)
+    return os.path.join(cache_root, os.path.splitext(relative)[0])
+
+
+def _pack_points(points: np.array) -> np.array:
+    points_32bit = points.astype(np.float32)
+    if np.array_equal(points_32bit, points):
+        return points_32bit
+    logger.warning("points are not float32 values, caching them as float64")
+    return points
+
+
+def _pack_colors(colors: np.array) -> np.array:
+    colors_8bit = np.round(colors * 255)
+    if np.array_equal(colors_8bit / 255.0, colors):
+        return colors_8bit.astype(np.uint8)
+    return colors.astype(np.float32)
+
+
+def _to_unit_colors(colors: np.array) -> np.array:
+    if colors.dtype == np.uint8:
+        return colors / 255.0
+    return np.asarray(colors, dtype=np.float64)
+
+
+def _level_name(voxel_size: float) -> str:
+    return f"lod_{float(voxel_size):g}"
+
+
+def _read_manifest(cache_path: str):
+    try:
+        with open(os.path.join(cache_path, MANIFEST_FILE), "r", encoding="utf-8") as file:
+            manifest = yaml.safe_load(file)
+    except OSError:
+        return None
+    if manifest is None or manifest.get("format_version") != FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def _is_current(path: str, manifest: dict) -> bool:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_mtime_ns == manifest["mtime"] and stat.st_size == manifest["size"]
@@ -0,0 +1,169 @@
+# Copyright (c) 2024 TU Wien
+"""
+Camera poses of a scene as arrays.
+
+A sceneN_transformations.yaml lists the pose (map to camera frame) of every image. Extrinsic
+converts one of them at a time and inverts its matrix with np.linalg.inv. ScenePoses loads all
+entries of the file into (N, 4) quaternion (x, y, z, w) and (N, 3) translation arrays and builds
+the (N, 4, 4) poses and their rigid inverses, the world to camera extrinsics, in one call each.
+
+The parsed arrays are cached as binary sidecar next to the yaml file:
+
+    scene2_transformations.yaml
+    scene2_transformations.yaml.npz     ids, file names, timestamps, quaternions, translations
+
+The sidecar is used while the yaml file has the same mtime and size.
+"""
+import os
+import logging
+import yaml
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+CACHE_SUFFIX = ".npz"
+
+
+def quaternions_to_rotations(quaternions: np.array) -> np.array:
+    ''' Batched Extrinsic.quat_to_rot
+
+    Args:
+        quaternions: np.array of shape (N, 4) in (x, y, z, w) order
+
+    Returns:
+        np.array of shape (N, 3, 3), rotations from the camera to the map frame
+    '''
+    quaternions = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+    q1, q2, q3, q0 = quaternions.T
+    rotations = np.empty((len(quaternions), 3, 3))
+    rotations[:, 0, 0] = 2 * (q0 * q0 + q1 * q1) - 1
+    rotations[:, 0, 1] = 2 * (q1 * q2 - q0 * q3)
+    rotations[:, 0, 2] = 2 * (q1 * q3 + q0 * q2)
+    rotations[:, 1, 0] = 2 * (q1 * q2 + q0 * q3)
+    rotations[:, 1, 1] = 2 * (q0 * q0 + q2 * q2) - 1
+    rotations[:, 1, 2] = 2 * (q2 * q3 - q0 * q1)
+    rotations[:, 2, 0] = 2 * (q1 * q3 - q0 * q2)
+    rotations[:, 2, 1] = 2 * (q2 * q3 + q0 * q1)
+    rotations[:, 2, 2] = 2 * (q0 * q0 + q3 * q3) - 1
+    return rotations
+
+
+def rigid_matrices(rotations: np.array, translations: np.array) -> np.array:
+    ''' Stacks (N, 3, 3) rotations and (N, 3) translations into (N, 4, 4) homogenous matrices '''
+    matrices = np.zeros((len(rotations), 4, 4))
+    matrices[:, :3, :3] = rotations
+    matrices[:, :3, 3] = translations
+    matrices[:, 3, 3] = 1
+    return matrices
+
+
+def invert_rigid(matrices: np.array) -> np.array:
+    ''' Closed form inverse [R^T | -R^T t] of (N, 4, 4) rigid transformations. The rotations are
+    assumed to be orthonormal, which holds for the unit quaternions of the transformation files.
+    '''
+    matrices = np.asarray(matrices).reshape(-1, 4, 4)
+    rotations_t = matrices[:, :3, :3].transpose(0, 2, 1)
+    return rigid_matrices(rotations_t, -np.einsum("nij,nj->ni", rotations_t, matrices[:, :3, 3]))
+
+
+class ScenePoses():
+    ''' Poses of all images of a scene
+
+    Args:
+        ids: (N,) image ids
+        file_names: (N,) image file names
+        timestamps: (N,) float64 timestamps
+        quaternions: (N, 4) float64 rotations in (x, y, z, w) order
+        translations: (N, 3) float64 camera positions in the map frame
+    '''
+    def __init__(self, ids: np.array, file_names: np.array, timestamps: np.array,
+                 quaternions: np.array, translations: np.array):
+        assert len(ids) == len(file_names) == len(timestamps) == len(quaternions) == \
+            len(translations), "all pose arrays must have one entry per image"
+        self.ids = ids
+        self.file_names = file_names
+        self.timestamps = timestamps
+        self.quaternions = quaternions
+        self.translations = translations
+        self._extrinsic_matrices = None
+
+    @classmethod
+    def load(cls, path: str, use_cache: bool = True):
+        """ Returns the poses of a transformations yaml, from its sidecar if that is up to date. """
+        cache_path = path + CACHE_SUFFIX
+        if use_cache and os.path.isfile(cache_path):
+            poses = cls._load_cache(path, cache_path)
+            if poses is not None:
+                return poses
+        poses = cls.parse(path)
+        if use_cache:
+            poses.save(path, cache_path)
+        return poses
+
+    @classmethod
+    def parse(cls, path: str):
+        """ Parses a transformations yaml. An id that appears twice keeps the pose of its last entry
+        at the position of its first, as in utils.load_transformations.
+        """
+        with open(path, "r", encoding="utf-8") as stream:
+            data = yaml.safe_load(stream) or []
+        entries = {entry["id"]: entry for entry in data}
+        return cls(
+            np.array(list(entries), dtype=np.int64),
+            np.array([entry["file_name"] for entry in entries.values()], dtype=str),
+            np.array([entry["timestamp"] for entry in entries.values()], dtype=np.float64),
+            np.array([[entry["rotation"][axis] for axis in "xyzw"] for entry in entries.values()],
+                     dtype=np.float64).reshape(-1, 4),
+            np.array([[entry["translation"][axis] for axis in "xyz"] for entry in entries.values()],
+                     dtype=np.float64).reshape(-1, 3))
+
+    def save(self, path: str, cache_path: str = None) -> None:
+        """ Writes the sidecar of the yaml file at path. A read only dataset is not an error. """
+        cache_path = cache_path if cache_path is not None else path + CACHE_SUFFIX
+        stat = os.stat(path)
+        tmp_path = f"{cache_path}.tmp"
+        try:
+            with open(tmp_path, "wb") as file:
+                np.savez(file, format_version=FORMAT_VERSION, ids=self.ids,
+                         file_names=self.file_names, timestamps=self.timestamps,
+                         quaternions=self.quaternions, translations=self.translations,
+                         mtime=stat.st_mtime_ns, size=stat.st_size)
+            os.replace(tmp_path, cache_path)
+        except OSError as error:
+            logger.warning("could not cache %s: %s", path, error)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def rotations(self) -> np.array:
+        """ (N, 3, 3) rotations from the camera to the map frame """
+        return quaternions_to_rotations(self.quaternions)
+
+    @property
+    def poses(self) -> np.array:
+        """ (N, 4, 4) camera to map transformations """
+        return rigid_matrices(self.rotations, self.translations)
+
+    @property
+    def extrinsic_matrices(self) -> np.array:
+        """ (N, 4, 4) map to camera transformations, Extrinsic.homogenous_matrix of every image """
+        if self._extrinsic_matrices is None:
+            self._extrinsic_matrices = invert_rigid(self.poses)
+        return self._extrinsic_matrices
+
+    @classmethod
+    def _load_cache(cls, path: str, cache_path: str):
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                if int(cache["format_version"]) != FORMAT_VERSION:
+                    return None
+                stat = os.stat(path)
+                if int(cache["mtime"]) != stat.st_mtime_ns or int(cache["size"]) != stat.st_size:
+                    return None
+                return cls(cache["ids"], cache["file_names"], cache["timestamps"],
+                           cache["quaternions"], cache["translations"])
+        except (OSError, KeyError, ValueError) as error:
+            logger.warning("ignoring pose cache %s: %s", cache_path, error)
+            return None
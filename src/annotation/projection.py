@@ -10,9 +10,7 @@ import logging
 import xml.etree.ElementTree as ET
 import json
 import yaml
-import open3d as o3d
 import numpy as np
-from scipy.spatial.transform import Rotation as R
 
 logger = logging.getLogger(__name__)
 
@@ -313,6 +311,55 @@ def inside_frustum(point, fov_x, fov_y, near, far) -> bool:
     return True
 
 
+def frustum_mask(points: np.array, fov_x: float, fov_y: float, near: float = None, \
+                 far: float = None) -> np.array:
+    ''' Vectorized inside_frustum for all points at once
+
+    Args:
+        points: np.array of shape (N, 3) in camera coordinates
+        fov_x, fov_y: field of view in degrees
+        near, far: optional depth limits (far <= z <= near), not checked if None
+
+    Returns:
+        boolean mask of shape (N,)
+    '''
+    tan_x = np.tan(np.radians(fov_x / 2))
+    tan_y = np.tan(np.radians(fov_y / 2))
+    depth = np.abs(points[:, 2])
+    mask = np.abs(points[:, 0]) <= depth * tan_x
+    mask &= np.abs(points[:, 1]) <= depth * tan_y
+    if near is not None:
+        mask &= points[:, 2] <= near
+    if far is not None:
+        mask &= points[:, 2] >= far
+    return mask
+
+
+def frustum_masks(points: np.array, extrinsic_matrices: np.array, fov_x: float, fov_y: float, \
+                  near: float = None, far: float = None) -> np.array:
+    ''' Frustum test of one point cloud against a stack of camera poses
+
+    Args:
+        points: np.array of shape (N, 3) in world coordinates
+        extrinsic_matrices: np.array of shape (V, 4, 4), world to camera transformations
+        fov_x, fov_y: field of view in degrees
+        near, far: optional depth limits in camera coordinates
+
+    Returns:
+        boolean mask of shape (V, N), True where the point is inside the frustum of the view
+    '''
+    points = np.asarray(points)
+    extrinsic_matrices = np.asarray(extrinsic_matrices).reshape(-1, 4, 4)
+    masks = np.empty((len(extrinsic_matrices), len(points)), dtype=bool)
+    camera_points = np.empty((len(points), 3), dtype=np.result_type(points, extrinsic_matrices))
+    # one pose at a time keeps the memory at one transformed cloud for any number of views
+    for i, matrix in enumerate(extrinsic_matrices):
+        np.matmul(points, matrix[:3, :3].T, out=camera_points)
+        camera_points += matrix[:3, 3]
+        masks[i] = frustum_mask(camera_points, fov_x, fov_y, near, far)
+    return masks
+
+
 def frustum_culling(points: np.array, fov_x: float, fov_y: float) -> list:
     ''' Filter points based on frustum culling 
     
@@ -323,14 +370,137 @@ def frustum_culling(points: np.array, fov_x: float, fov_y: float) -> list:
     Returns:
         list of filtered points indices
     '''
-
-    far = min(points[:, 2])
-    near = max(points[:, 2])
-
-    indices = [i for i, point in enumerate(points) if inside_frustum(point, fov_x, fov_y, near, far)]
+    # near and far are the depth range of the points themselves, so only the field of view
+    # limits points here
+    indices = np.flatnonzero(frustum_mask(np.asarray(points), fov_x, fov_y))
     if len(indices) == 0:
         raise ValueError("No points in frustum")
-    return indices
+    return indices.tolist()
+
+
+class SceneProjector():
+    ''' Projects one point cloud into many camera views without copying or transforming the cloud
+
+    The world coordinates are stored once as read only array. set_view transforms them into a
+    reused camera coordinate buffer with a single matrix product, project then projects only the
+    requested indices. Open3D point clouds are only created on request for debug visualization.
+
+    Args:
+        points: (N, 3) points in world coordinates
+        intrinsics: object of instance Intrinsic
+        colors: optional (N, 3) colors in [0, 1]
+    '''
+    def __init__(self, points: np.array, intrinsics: Intrinsic, colors: np.array = None):
+        self.points = np.array(points, dtype=np.float64)
+        self.points.flags.writeable = False
+        self.colors = None
+        if colors is not None:
+            self.colors = np.array(colors, dtype=np.float64)
+            self.colors.flags.writeable = False
+        self.intrinsics = intrinsics
+        self.camera_points = np.empty_like(self.points)
+        self._K = intrinsics.homogenous_matrix()
+        self._D = intrinsics.distortion_coeffs()
+
+    def __len__(self):
+        return len(self.points)
+
+    def set_view(self, extrinsic_matrix: np.array) -> np.array:
+        ''' Transforms the cloud into the camera coordinates of a view
+
+        Args:
+            extrinsic_matrix: 4x4 world to camera transformation
+
+        Returns:
+            the (N, 3) camera coordinate buffer, overwritten by the next call
+        '''
+        np.matmul(self.points, extrinsic_matrix[:3, :3].T, out=self.camera_points)
+        self.camera_points += extrinsic_matrix[:3, 3]
+        return self.camera_points
+
+    def frustum_mask(self, fov_x: float, fov_y: float) -> np.array:
+        ''' Boolean mask of the points inside the frustum of the current view '''
+        return frustum_mask(self.camera_points, fov_x, fov_y)
+
+    def project(self, indices: np.array = None) -> (np.array, np.array):
+        ''' Projects the points of the current view, all of them or only indices
+
+        Returns:
+            u, v pixel coordinates as in project_to_2d
+        '''
+        points = self.camera_points if indices is None else self.camera_points[indices]
+        return project_to_2d(points, self._K, self._D, self.intrinsics.width, \
+            self.intrinsics.height)
+
+    def to_point_cloud(self, indices: np.array = None, camera_frame: bool = True):
+        ''' Returns an open3d point cloud of the (selected) points for debug visualization '''
+        import open3d as o3d
+        points = self.camera_points if camera_frame else self.points
+        indices = np.arange(len(self.points)) if indices is None else indices
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points[indices]))
+        if self.colors is not None:
+            pcd.colors = o3d.utility.Vector3dVector(self.colors[indices])
+        return pcd
+
+
+def project_object_bboxes(points: np.array, point_indices: np.array, object_labels: np.array, \
+                          extrinsic_matrices: np.array, intrinsics: Intrinsic, fov_x: float, \
+                          fov_y: float, num_objects: int = None, \
+                          max_chunk_points: int = 2**22) -> np.array:
+    ''' 2D bounding boxes of all annotated objects in all views in one vectorized pass
+
+    The annotated points are given as (point, object) pairs ordered by object, as the flat arrays
+    of AnnotationIndex. A point listed under several objects counts for each of them. For every
+    view the pairs are transformed, culled and projected together (one apply_distortion call per
+    chunk of views), so the visible points of each (view, object) pair form one contiguous segment
+    that is reduced with np.minimum.reduceat / np.maximum.reduceat.
+
+    Args:
+        points: (N, 3) points in world coordinates
+        point_indices: (M,) point index of every pair, e.g. AnnotationIndex.indices
+        object_labels: (M,) non decreasing object index of every pair,
+            e.g. AnnotationIndex.object_labels()
+        extrinsic_matrices: (V, 4, 4) world to camera transformations
+        intrinsics: object of instance Intrinsic
+        fov_x, fov_y: field of view in degrees
+        num_objects: number of objects O, defaults to object_labels.max() + 1
+        max_chunk_points: number of transformed points held in memory at once
+
+    Returns:
+        (V, O, 4) int array of [min_u, min_v, max_u, max_v] in pixels, -1 where no point of the
+        object is inside the frustum of the view
+    '''
+    object_labels = np.asarray(object_labels, dtype=np.int64)
+    assert len(point_indices) == len(object_labels), "one object label per point index"
+    assert np.all(object_labels[1:] >= object_labels[:-1]), "pairs must be ordered by object"
+    extrinsic_matrices = np.asarray(extrinsic_matrices, dtype=np.float64).reshape(-1, 4, 4)
+    if num_objects is None:
+        num_objects = int(object_labels[-1]) + 1 if len(object_labels) > 0 else 0
+    bboxes = np.full((len(extrinsic_matrices), num_objects, 4), -1, dtype=np.int64)
+    if len(object_labels) == 0 or num_objects == 0:
+        return bboxes
+
+    object_points = np.asarray(points, dtype=np.float64)[point_indices]
+    K, D = intrinsics.homogenous_matrix(), intrinsics.distortion_coeffs()
+    views_per_chunk = max(1, max_chunk_points // len(object_labels))
+    for start in range(0, len(extrinsic_matrices), views_per_chunk):
+        matrices = extrinsic_matrices[start:start + views_per_chunk]
+        camera_points = np.matmul(object_points[None], matrices[:, :3, :3].transpose(0, 2, 1))
+        camera_points += matrices[:, None, :3, 3]
+        camera_points = camera_points.reshape(-1, 3)
+        mask = frustum_mask(camera_points, fov_x, fov_y)
+        if not mask.any():
+            continue
+        u, v = project_to_2d(camera_points[mask], K, D, intrinsics.width, intrinsics.height)
+        # (view, object) key of every visible point, sorted because the points are ordered by
+        # view and then by object
+        keys = (np.arange(len(matrices))[:, None] * num_objects + object_labels).reshape(-1)[mask]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        chunk_bboxes = bboxes[start:start + len(matrices)].reshape(-1, 4)
+        chunk_bboxes[keys[starts]] = np.stack([
+            np.minimum.reduceat(u, starts), np.minimum.reduceat(v, starts),
+            np.maximum.reduceat(u, starts), np.maximum.reduceat(v, starts)], axis=1)
+    return bboxes
 
 
 def project_to_2d(points_pos: np.array, K: np.array, D: np.array, width: int = 640, height: int = 480) \
@@ -407,6 +577,7 @@ def apply_distortion(points_2d, K, D):
 
 
 if __name__ == "__main__":
+    import open3d as o3d
     # load pcd file
     pcd_name: str = "./testmodel/model1.pcd"
     pcd = o3d.io.read_point_cloud(pcd_name)
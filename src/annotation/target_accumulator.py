@@ -0,0 +1,87 @@
+# Copyright (c) 2024 TU Wien
+"""
+Collects the ground truth boxes of the images of a room for all_target_bboxes.pt.
+
+The boxes of every image are appended to a growable NumPy buffer (capacity doubled when full)
+and looked up by image path, the tensors of all_target_bboxes.pt are only built once in
+to_targets. The result is the same list of {"image", "boxes", "labels"} dicts that appending with
+torch.cat produced: images in order of first appearance, float32 boxes and int32 zero labels, and
+boxes of shape (0,) for an image that never got boxes appended.
+"""
+import numpy as np
+
+INITIAL_CAPACITY = 8
+
+
+class TargetAccumulator():
+    ''' Boxes of the images of a room, keyed by image path
+
+    Args:
+        box_size: number of values per box
+    '''
+    def __init__(self, box_size: int = 4):
+        self.box_size = box_size
+        self.images = []
+        self._index = {}
+        self._buffers = []
+        self._counts = []
+        self._appended = []
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, image: str) -> bool:
+        return image in self._index
+
+    def add_image(self, image: str) -> int:
+        """ Adds an image without boxes if it is not known yet and returns its position. """
+        if image not in self._index:
+            self._index[image] = len(self.images)
+            self.images.append(image)
+            self._buffers.append(np.empty((0, self.box_size)))
+            self._counts.append(0)
+            self._appended.append(False)
+        return self._index[image]
+
+    def add_boxes(self, image: str, boxes: np.array) -> None:
+        """ Appends (K, box_size) boxes to an image, K may be 0. """
+        i = self.add_image(image)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, self.box_size)
+        count = self._counts[i] + len(boxes)
+        if count > len(self._buffers[i]):
+            buffer = np.empty((max(count, 2 * len(self._buffers[i]), INITIAL_CAPACITY), \
+                self.box_size))
+            buffer[:self._counts[i]] = self._buffers[i][:self._counts[i]]
+            self._buffers[i] = buffer
+        self._buffers[i][self._counts[i]:count] = boxes
+        self._counts[i] = count
+        self._appended[i] = True
+
+    def boxes(self, image: str) -> np.array:
+        """ Returns the boxes of an image as (K, box_size) array view. """
+        i = self._index[image]
+        return self._buffers[i][:self._counts[i]]
+
+    def merge(self, other) -> None:
+        """ Appends the images and boxes of another accumulator in its order. """
+        for i, image in enumerate(other.images):
+            if other._appended[i]:
+                self.add_boxes(image, other.boxes(image))
+            else:
+                self.add_image(image)
+
+    def to_targets(self) -> list:
+        """ Builds the list of {"image", "boxes", "labels"} tensors of all_target_bboxes.pt. """
+        import torch
+        targets = []
+        for i, image in enumerate(self.images):
+            if self._appended[i]:
+                boxes = torch.as_tensor(self.boxes(image), dtype=torch.float32)
+            else:
+                boxes = torch.as_tensor([], dtype=torch.float32)
+            targets.append(dict(
+                image=image,
+                boxes=boxes,
+                labels=torch.zeros((self._counts[i],), dtype=torch.int32)
+            ))
+        return targets
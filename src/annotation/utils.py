@@ -5,55 +5,43 @@ utility function for pointcloud annotation
 """
 
 import copy
-import open3d as o3d
-import cv2
+import functools
+from typing import TYPE_CHECKING
 import numpy as np
 import yaml
 try:
     from src.annotation.projection import Intrinsic  
+    from src.annotation.annotation_index import AnnotationIndex
     from src.globals import GT_COLOR
 except ImportError:
     from projection import Intrinsic  # fallback for direct script execution
+    from annotation_index import AnnotationIndex
+if TYPE_CHECKING:
+    import open3d as o3d
+# open3d and cv2 take seconds to import, they are imported in the functions that use them
 
 
 def read_annotation(path_to_annotation: str) -> dict:
-    ''' Read annotation file and return dictionary '''
-    with open (path_to_annotation, "r", encoding="utf-8") as f:
-        anno = f.readlines()
-        annotation_dictionary = {}
-        for line in anno:
-            line = line.split()
-            obj_name = line[0]
-            indices = line[1:-1]
-            indices = [int(i) for i in indices]
-            annotation_dictionary[obj_name] = indices
-    return annotation_dictionary
-
-
-def annotate_pcd(input_pcd: o3d.geometry.PointCloud, \
+    ''' Read annotation file and return dictionary (parsed once and cached, see AnnotationIndex) '''
+    annotation = AnnotationIndex.load(path_to_annotation)
+    return {obj_name: indices.tolist() for obj_name, indices in annotation.items()}
+
+
+def annotate_pcd(input_pcd: "o3d.geometry.PointCloud", \
                  path_to_annotation: str, \
                  gt_colour: np.array = np.array([0.1, 0.9, 0.1])) \
-                     -> (o3d.geometry.PointCloud, dict):
+                     -> ("o3d.geometry.PointCloud", dict):
     ''' Annotate point cloud with indices from annotation file '''
+    import open3d as o3d
     annotated_pcd = copy.deepcopy(input_pcd)
-    with open (path_to_annotation, "r", encoding="utf-8") as f:
-        anno = f.readlines()
-        annotation_dictionary = {}
-        for line in anno:
-            line = line.split()
-            obj_name = line[0]
-            indices = line[1:-1]
-            indices = [int(i) for i in indices]
-            annotation_dictionary[obj_name] = indices
-
-    for _, indices in annotation_dictionary.items():
-        color = gt_colour
-        for i in indices:
-            annotated_pcd.colors[i] = color
+    annotation = AnnotationIndex.load(path_to_annotation)
+    annotated_pcd.colors = o3d.utility.Vector3dVector(
+        annotation.colorize(np.array(annotated_pcd.colors), gt_colour))
+    annotation_dictionary = {obj_name: indices.tolist() for obj_name, indices in annotation.items()}
     return annotated_pcd, annotation_dictionary
 
 
-def extract_3d_bboxes(input_pcd: o3d.geometry.PointCloud, \
+def extract_3d_bboxes(input_pcd: "o3d.geometry.PointCloud", \
                         annotation_dictionary: dict, \
                         result=False) -> list:
     ''' Draw bounding boxes around annotated objects 
@@ -65,6 +53,7 @@ def extract_3d_bboxes(input_pcd: o3d.geometry.PointCloud, \
     Returns:
         list of bounding boxes
     '''
+    import open3d as o3d
     bboxes = []
     for obj in annotation_dictionary:
         indices = annotation_dictionary[obj]
@@ -79,13 +68,17 @@ def extract_3d_bboxes(input_pcd: o3d.geometry.PointCloud, \
 
 def draw_image(pixel_coordinates: tuple, \
                    points_color: np.array, \
-                   intrinsics: Intrinsic):
+                   intrinsics: Intrinsic, \
+                   depth: np.array = None, \
+                   radius: int = 0):
     ''' Draw image 
     
     Args:
         pixel_coordinates: tuple of u, v coordinates
         points_color: np.array of colors
         intrinsics: object of instance Intrinsic
+        depth: optional camera depth of the points, the nearest point of a pixel wins
+        radius: splat radius in pixels
         
     Returns:
         cv2 image with bounding boxes
@@ -95,15 +88,64 @@ def draw_image(pixel_coordinates: tuple, \
     assert isinstance(intrinsics ,Intrinsic), f"intrinsics must be instance of Intrinsic Class,\
                                                 but is {type(intrinsics)}"
 
-    image = np.zeros((intrinsics.height, intrinsics.width, 3), dtype=np.uint8)
-    points_color = points_color * 255
-    # Fill the image array with your colors at the corresponding u, v coordinates
-    for u, v, color in zip(u_coords, v_coords, points_color):
-        image[int(v), int(u)] = color
-
+    image, _ = rasterize_points(u_coords, v_coords, points_color, intrinsics.height, \
+        intrinsics.width, depth, radius)
     return image
 
 
+def rasterize_points(u_coords: np.array, v_coords: np.array, points_color: np.array, \
+                     height: int, width: int, depth: np.array = None, radius: int = 0) -> tuple:
+    ''' Scatter projected points into an image with one fancy indexed write
+
+    Without depth the last point of a pixel wins, as with sequential writes. With depth a
+    z-buffer is resolved by sorting the points by pixel and depth and keeping the nearest one,
+    points with depth <= 0 are behind the camera and not drawn.
+
+    Args:
+        u_coords, v_coords: pixel coordinates of the points
+        points_color: (N, 3) colors in [0, 1]
+        height, width: size of the image
+        depth: optional (N,) camera depth of the points, positive in front of the camera
+        radius: every point covers a (2 * radius + 1)^2 square around its pixel
+
+    Returns:
+        (H, W, 3) uint8 image and (H, W) float32 depth image (0 where no point was drawn, None
+        without depth)
+    '''
+    u_coords = np.asarray(u_coords).astype(np.int64)
+    v_coords = np.asarray(v_coords).astype(np.int64)
+    point_index = np.arange(len(u_coords))
+    if radius > 0:
+        offsets = np.arange(-radius, radius + 1)
+        offsets_u, offsets_v = [offset.reshape(-1) for offset in np.meshgrid(offsets, offsets)]
+        u_coords = (u_coords[:, None] + offsets_u).reshape(-1)
+        v_coords = (v_coords[:, None] + offsets_v).reshape(-1)
+        point_index = np.repeat(point_index, len(offsets_u))
+    inside = (u_coords >= 0) & (u_coords < width) & (v_coords >= 0) & (v_coords < height)
+    if depth is not None:
+        depth = np.asarray(depth)
+        inside &= depth[point_index] > 0
+    pixels = (v_coords * width + u_coords)[inside]
+    point_index = point_index[inside]
+
+    if depth is not None:
+        order = np.lexsort((depth[point_index], pixels))
+        first = np.concatenate(([True], pixels[order][1:] != pixels[order][:-1]))
+        winners = order[first]
+    else:
+        _, last = np.unique(pixels[::-1], return_index=True)
+        winners = len(pixels) - 1 - last
+
+    image = np.zeros((height * width, 3), dtype=np.uint8)
+    image[pixels[winners]] = np.asarray(points_color)[point_index[winners]] * 255
+    depth_image = None
+    if depth is not None:
+        depth_image = np.zeros(height * width, dtype=np.float32)
+        depth_image[pixels[winners]] = depth[point_index[winners]]
+        depth_image = depth_image.reshape(height, width)
+    return image.reshape(height, width, 3), depth_image
+
+
 def draw_2d_bboxes_on_img(image_file, bboxes: list):
     ''' Draw 2D bounding boxes on image
 
@@ -114,6 +156,7 @@ def draw_2d_bboxes_on_img(image_file, bboxes: list):
     Returns:
         image with bounding boxes
     '''
+    import cv2
     if isinstance(image_file, str):
         image = cv2.imread(image_file)
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
@@ -198,31 +241,47 @@ def squeeze_img(image: np.array, intrinsics: Intrinsic, strength: float = 0.0005
                                                 but is {type(intrinsics)}"
     assert isinstance(strength, float), f"strength must be float, but is {type(strength)}"
 
-    # Create the maps for remapping
-    map_x = np.zeros((intrinsics.height, intrinsics.width), dtype=np.float32)
-    map_y = np.zeros((intrinsics.height, intrinsics.width), dtype=np.float32)
+    import cv2
+    map_x, map_y = squeeze_maps(intrinsics.width, intrinsics.height, strength)
+    squeezed_img = cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR)
+    return squeezed_img
+
+def squeeze_images(images, intrinsics: Intrinsic, strength: float = 0.0005) -> np.array:
+    """ Squeeze a stack of images (N, H, W[, C]) with the same cached maps as squeeze_img.
 
+    Returns:
+        squeezed images as array of the same shape
+    """
+    assert isinstance(intrinsics, Intrinsic), f"intrinsics must be instance of Intrinsic Class,\
+                                                but is {type(intrinsics)}"
+    assert isinstance(strength, float), f"strength must be float, but is {type(strength)}"
+
+    import cv2
+    map_x, map_y = squeeze_maps(intrinsics.width, intrinsics.height, strength)
+    squeezed_imgs = np.empty_like(np.asarray(images))
+    for i, image in enumerate(images):
+        squeezed_imgs[i] = cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR)
+    return squeezed_imgs
+
+@functools.lru_cache(maxsize=8)
+def squeeze_maps(width: int, height: int, strength: float) -> tuple:
+    """ Remap grids of the squeeze for cv2.remap, computed once per (width, height, strength).
+
+    Returns:
+        map_x, map_y as (height, width) float32 arrays, shared between calls and not to be modified
+    """
     # Define the center of the image
-    center_x = intrinsics.width / 2
+    center_x = width / 2
 
-    for j in range(intrinsics.height):
-        for i in range(intrinsics.width):
-            # Offset from the center
-            offset = (i - center_x)
-            
-            # Calculate the stretched position with a non-linear transformation
-            stretched_position = center_x + offset * (1 + strength * abs(offset))
-            
-            # Ensure that the stretched position does not go out of the image bounds
-            stretched_position = max(0, min(intrinsics.width - 1, stretched_position))
-            
-            # Assign the stretched position to the map
-            map_x[j, i] = stretched_position
-            map_y[j, i] = j
-
-    # Remap the image
-    squeezed_img = cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR)
-    return squeezed_img
+    # Offset of every column from the center and its stretched position, clipped to the image
+    offset = np.arange(width) - center_x
+    stretched_position = center_x + offset * (1 + strength * np.abs(offset))
+    stretched_position = np.clip(stretched_position, 0, width - 1)
+
+    # every row uses the same columns, cv2.remap needs materialised maps
+    map_x = np.tile(stretched_position.astype(np.float32), (height, 1))
+    map_y = np.tile(np.arange(height, dtype=np.float32)[:, None], (1, width))
+    return map_x, map_y
 
 def squeeze_coordinates(coords: tuple, intrinsics: Intrinsic, strength: float = 0.0005) -> np.array:
     """ Squeeze image coordinates with non-linear transformation.
@@ -238,10 +297,6 @@ def squeeze_coordinates(coords: tuple, intrinsics: Intrinsic, strength: float =
     assert isinstance(u_coords, np.ndarray), f"u_coords must be numpy array, but is {type(u_coords)}"
     assert isinstance(strength, float), f"strength must be float, but is {type(strength)}"
 
-      # Create the maps for remapping
-    map_x = np.zeros((intrinsics.height, intrinsics.width), dtype=np.float32)
-    map_y = np.zeros((intrinsics.height, intrinsics.width), dtype=np.float32)
-    
     # Define the center of the image
     center_x = intrinsics.width / 2
 
@@ -276,6 +331,7 @@ def resize_coordinates(u_coords: np.array, v_coords: np.array, new_size: tuple)
 
 
 if __name__ == "__main__":
+    import open3d as o3d
     PCD_NAME: str = "../../data/annotation/office/scene4/merged_plane_clouds_ds002.pcd"
     # PCD_NAME: str = "./testmodel/model1.pcd"
     ANNO_NAME: str = "../../data/annotation/office/scene4/merged_plane_clouds_ds002_GT.anno"
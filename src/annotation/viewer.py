@@ -10,14 +10,16 @@ import matplotlib.pyplot as plt
 import json
 try:
     from src.globals import DATASET_FOLDER, ROOM, SCENE, PLANE, PCD_PATH 
+    from src.annotation.pointcloud_store import load_point_cloud
     PREFIX = "../../"
 except ImportError:
     from ..globals import DATASET_FOLDER, ROOM, SCENE, PLANE, PCD_PATH
+    from .pointcloud_store import load_point_cloud
     PREFIX = "../../"
 
 if __name__ == "__main__":
-    # load pcd file
-    pcd = o3d.io.read_point_cloud(PREFIX + DATASET_FOLDER + ROOM + SCENE + PLANE + PCD_PATH)
+    # load pcd file through the point cloud cache
+    pcd = load_point_cloud(PREFIX + DATASET_FOLDER + ROOM + SCENE + PLANE + PCD_PATH).to_open3d()
     # create mesh for showing the origin
     mesh_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(size=1, origin=[0, 0, 0])
 
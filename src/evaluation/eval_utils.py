@@ -113,4 +113,58 @@ def prepare_target_bboxes(target_bboxes, metadata_path) -> list:
     image2_list = [entry['image2'] for entry in targets_metadata]
     sorted_boxes = sorted(filtered_boxes, key=lambda x: image2_list.index(x['image']))
     # pprint(sorted_boxes)
-    return sorted_boxes
\ No newline at end of file
+    return sorted_boxes
+
+
+def summarise_inference_runs(configuration_paths) -> dict:
+    ''' this function collects the precision mode and prediction time of inference runs from their
+    metadata_configurations.yaml files (runs without timing are skipped)
+    '''
+    precisions = set()
+    seconds, pairs = 0.0, 0
+    for configuration_path in configuration_paths:
+        try:
+            with open(configuration_path, "r", encoding="utf-8") as file:
+                configuration = yaml.safe_load(file) or {}
+        except FileNotFoundError:
+            continue
+        if "predict_seconds" not in configuration:
+            continue
+        precisions.add(configuration.get("precision", "fp32"))
+        seconds += configuration["predict_seconds"]
+        pairs += configuration.get("predicted_pairs", 0)
+    return {
+        "inference_precision": ",".join(sorted(precisions)) if precisions else "unknown",
+        "predict_seconds_per_pair": float(seconds / pairs) if pairs > 0 else float(-1),
+    }
+
+
+def precision_report(metrics: dict, reference: str = "fp32") -> dict:
+    ''' this function compares the accuracy and speed of the precision modes in metrics.yaml.
+    Entries that only differ in their "_precision-<mode>" part of the key are grouped, every mode
+    gets its mAP, mAP_50 and prediction time per pair together with the mAP change and the speedup
+    against the reference mode (None if the reference mode or its timing is missing)
+    '''
+    groups = {}
+    for key, values in metrics.items():
+        mode = values.get("inference_precision", "unknown")
+        groups.setdefault(key.replace(f"_precision-{mode}", ""), {})[mode] = values
+    report = {}
+    for key, modes in sorted(groups.items()):
+        baseline = modes.get(reference)
+        report[key] = {}
+        for mode, values in sorted(modes.items()):
+            seconds = values.get("predict_seconds_per_pair", -1)
+            entry = {
+                "mAP": values["mAP"],
+                "mAP_50": values["mAP_50"],
+                "predict_seconds_per_pair": seconds,
+                "mAP_delta": None,
+                "speedup": None,
+            }
+            if baseline is not None:
+                entry["mAP_delta"] = float(values["mAP"] - baseline["mAP"])
+                if seconds > 0 and baseline.get("predict_seconds_per_pair", -1) > 0:
+                    entry["speedup"] = float(baseline["predict_seconds_per_pair"] / seconds)
+            report[key][mode] = entry
+    return report
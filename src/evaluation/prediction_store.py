@@ -0,0 +1,301 @@
+# Copyright (c) 2024 TU Wien
+"""
+Columnar storage for predicted bounding boxes.
+
+Instead of pickling a list of dicts of tiny tensors with torch.save, the predictions of one
+inference run are stored as a directory of flat numpy arrays:
+
+    batch_image2_predicted_bboxes/
+        boxes.npy       (M, 4) float32, all boxes of all images
+        scores.npy      (M,)   float32
+        labels.npy      (M,)   int32
+        offsets.npy     (N+1,) int64, boxes of image i are boxes[offsets[i]:offsets[i+1]]
+        images.npy      (N,)   str, image name of every entry
+        indices.npy     (N,)   int64, position of the image pair in the input metadata
+        keys.npy        (N,)   str, identifies the image pair when resuming a run
+        metadata.yaml   format version and number of images
+
+The arrays are memory mapped on load, so evaluation only touches the columns it asks for.
+"""
+import os
+import shutil
+import logging
+import yaml
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+COLUMNS = ("boxes", "scores", "labels")
+METADATA_FILE = "metadata.yaml"
+
+
+class PredictionWriter():
+    ''' Collects the predictions of one inference run and writes them as a columnar store.
+
+    Predictions are appended per image and flushed per batch into small append-only part files
+    next to the store (<path>.parts/part-00000.npz, ...). close() merges all parts into the
+    columnar store, ordered by their index. With resume=True the parts and the store of an earlier,
+    interrupted run are kept and completed() tells which images can be skipped.
+
+    Args:
+        path: directory of the store, e.g. predictions/batch_image2_predicted_bboxes
+        resume: keep the predictions of an earlier run instead of starting from scratch
+    '''
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.parts_path = f"{path}.parts"
+        self._pending = []
+        self._previous = []
+        self._written = 0
+        self._next_part = 0
+        if not resume:
+            if os.path.exists(self.parts_path):
+                shutil.rmtree(self.parts_path)
+            return
+        if os.path.isdir(path):
+            self._previous = _read_store_records(path)
+        if os.path.isdir(self.parts_path):
+            part_files = _part_files(self.parts_path)
+            if len(part_files) > 0:
+                self._next_part = int(part_files[-1][len("part-"):-len(".npz")]) + 1
+        logger.info("resuming %s with %s completed predictions", path, len(self.completed()))
+
+    def append(self, image: str, boxes, scores, labels=None, index: int = None, key: str = None):
+        """ Adds the predictions for one image.
+
+        Args:
+            image: image name, e.g. prediction_3
+            boxes, scores, labels: predictions of the image, labels default to 0
+            index: position of the image pair in the input metadata, defaults to append order
+            key: identifies the image pair (e.g. its image paths) for resuming
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        if labels is None:
+            labels = np.zeros(len(boxes), dtype=np.int32)
+        labels = np.asarray(labels, dtype=np.int32).reshape(-1)
+        assert len(boxes) == len(scores) == len(labels), \
+            f"got {len(boxes)} boxes, {len(scores)} scores and {len(labels)} labels for {image}"
+        if index is None:
+            index = len(self._previous) + self._written + len(self._pending)
+        self._pending.append(_Record(int(index), "" if key is None else key, image, \
+            boxes, scores, labels))
+
+    def flush(self):
+        """ Appends the pending predictions as a new part file. """
+        if len(self._pending) == 0:
+            return
+        os.makedirs(self.parts_path, exist_ok=True)
+        part_file = os.path.join(self.parts_path, f"part-{self._next_part:05d}.npz")
+        with open(f"{part_file}.tmp", "wb") as file:
+            np.savez(file, **_records_to_columns(self._pending))
+        os.replace(f"{part_file}.tmp", part_file)
+        logger.debug("flushed %s predictions to %s", len(self._pending), part_file)
+        self._written += len(self._pending)
+        self._next_part += 1
+        self._pending = []
+
+    def completed(self) -> dict:
+        """ Returns {index: key} of all images whose predictions are already stored. """
+        return {record.index: record.key for record in self._all_records()}
+
+    def __len__(self):
+        return len(self.completed())
+
+    def close(self):
+        """ Merges all parts into the columnar store, replacing an existing one. """
+        self.flush()
+        records = {}
+        for record in self._all_records():
+            records[record.index] = record # later predictions of the same pair win
+        records = [records[index] for index in sorted(records)]
+        columns = _records_to_columns(records)
+        write_columns(self.path, columns["images"], columns["boxes"], columns["scores"], \
+            columns["labels"], columns["offsets"], columns["indices"], columns["keys"])
+        if os.path.exists(self.parts_path):
+            shutil.rmtree(self.parts_path)
+        logger.debug("wrote %s predictions to %s", len(records), self.path)
+
+    def _all_records(self) -> list:
+        records = list(self._previous)
+        if os.path.isdir(self.parts_path):
+            for part_file in _part_files(self.parts_path):
+                with np.load(os.path.join(self.parts_path, part_file)) as part:
+                    records.extend(_columns_to_records(part))
+        return records + self._pending
+
+
+class PredictionStore():
+    ''' Read access to a columnar prediction store. Columns are memory mapped lazily.
+
+    Args:
+        path: directory of the store
+    '''
+    def __init__(self, path: str, mmap: bool = True):
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"no prediction store found at {path}")
+        self.path = path
+        self._mmap_mode = "r" if mmap else None
+        self._columns = {}
+        with open(os.path.join(path, METADATA_FILE), "r", encoding="utf-8") as file:
+            self.metadata = yaml.safe_load(file)
+        if self.metadata["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"unsupported prediction store version {self.metadata['format_version']}")
+        self.offsets = self.column("offsets")
+
+    def column(self, name: str) -> np.ndarray:
+        """ Returns a (memory mapped) column. """
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, f"{name}.npy"), \
+                mmap_mode=self._mmap_mode)
+        return self._columns[name]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, index: int, columns=COLUMNS) -> dict:
+        """ Returns the predictions of one image as dict of tensors, like the old .pt format. """
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        entry = {}
+        if "image" in columns:
+            entry["image"] = str(self.column("images")[index])
+        for name in columns:
+            if name == "image":
+                continue
+            entry[name] = torch.from_numpy(np.array(self.column(name)[start:end]))
+        return entry
+
+    def to_list(self, columns=COLUMNS) -> list:
+        """ Returns all predictions as list of dicts. """
+        return [self.get(i, columns) for i in range(len(self))]
+
+
+def write_columns(path, images, boxes, scores, labels, offsets, indices=None, keys=None):
+    """ Writes the columns of a prediction store. The store is written next to its final location
+    and moved into place afterwards, so readers never see a half written store.
+    """
+    if indices is None:
+        indices = np.arange(len(images), dtype=np.int64)
+    if keys is None:
+        keys = [""] * len(images)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "boxes.npy"), boxes)
+    np.save(os.path.join(tmp_path, "scores.npy"), scores)
+    np.save(os.path.join(tmp_path, "labels.npy"), labels)
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_path, "images.npy"), np.asarray(images, dtype=str).reshape(-1))
+    np.save(os.path.join(tmp_path, "indices.npy"), np.asarray(indices, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "keys.npy"), np.asarray(keys, dtype=str).reshape(-1))
+    with open(os.path.join(tmp_path, METADATA_FILE), "w", encoding="utf-8") as file:
+        yaml.safe_dump({"format_version": FORMAT_VERSION, "num_images": len(images)}, file)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def load_predictions(path: str, columns=COLUMNS) -> list:
+    """ Loads predictions as list of dicts of tensors from a columnar store or a legacy .pt file.
+
+    Args:
+        path: path of the store directory or the .pt file; the suffix may be omitted
+        columns: columns to read, any of "image", "boxes", "scores" and "labels"
+
+    Returns:
+        list of dicts, one per image, in the order they were written
+    """
+    path = resolve_predictions_path(path)
+    if os.path.isdir(path):
+        return PredictionStore(path).to_list(columns)
+    predictions = torch.load(path)
+    return [{key: value for key, value in entry.items() if key in columns} \
+        for entry in predictions]
+
+
+def resolve_predictions_path(path: str) -> str:
+    """ Prefers the columnar store and falls back to the legacy .pt file. """
+    store_path = path[:-3] if path.endswith(".pt") else path
+    if os.path.isdir(store_path):
+        return store_path
+    if os.path.isfile(f"{store_path}.pt"):
+        return f"{store_path}.pt"
+    raise FileNotFoundError(f"no predictions found at {store_path}")
+
+
+def convert_pt_to_columnar(pt_path: str, store_path: str = None) -> str:
+    """ Converts a legacy list-of-dicts .pt file into a columnar store next to it. """
+    if store_path is None:
+        store_path = pt_path[:-3] if pt_path.endswith(".pt") else f"{pt_path}.columns"
+    writer = PredictionWriter(store_path)
+    for entry in torch.load(pt_path):
+        writer.append(
+            entry.get("image", ""),
+            entry["boxes"].cpu().numpy(),
+            entry["scores"].cpu().numpy(),
+            entry["labels"].cpu().numpy())
+    writer.close()
+    return store_path
+
+
+class _Record():
+    """ Predictions of a single image. """
+    __slots__ = ("index", "key", "image", "boxes", "scores", "labels")
+
+    def __init__(self, index, key, image, boxes, scores, labels):
+        self.index = index
+        self.key = key
+        self.image = image
+        self.boxes = boxes
+        self.scores = scores
+        self.labels = labels
+
+
+def _records_to_columns(records) -> dict:
+    return {
+        "indices": np.asarray([record.index for record in records], dtype=np.int64),
+        "keys": np.asarray([record.key for record in records], dtype=str).reshape(-1),
+        "images": np.asarray([record.image for record in records], dtype=str).reshape(-1),
+        "offsets": np.cumsum([0] + [len(record.boxes) for record in records], dtype=np.int64),
+        "boxes": _concatenate([record.boxes for record in records], (0, 4), np.float32),
+        "scores": _concatenate([record.scores for record in records], (0,), np.float32),
+        "labels": _concatenate([record.labels for record in records], (0,), np.int32),
+    }
+
+
+def _columns_to_records(columns) -> list:
+    offsets = columns["offsets"]
+    boxes, scores, labels = columns["boxes"], columns["scores"], columns["labels"]
+    records = []
+    for i, (index, key, image) in enumerate(zip(columns["indices"], columns["keys"], \
+            columns["images"])):
+        start, end = offsets[i], offsets[i + 1]
+        records.append(_Record(int(index), str(key), str(image), np.array(boxes[start:end]), \
+            np.array(scores[start:end]), np.array(labels[start:end])))
+    return records
+
+
+def _read_store_records(path) -> list:
+    store = PredictionStore(path, mmap=False)
+    columns = {name: store.column(name) for name in \
+        ("offsets", "boxes", "scores", "labels", "images")}
+    if os.path.isfile(os.path.join(path, "indices.npy")):
+        columns["indices"] = store.column("indices")
+        columns["keys"] = store.column("keys")
+    else:
+        columns["indices"] = np.arange(len(store), dtype=np.int64)
+        columns["keys"] = np.asarray([""] * len(store), dtype=str)
+    return _columns_to_records(columns)
+
+
+def _part_files(parts_path) -> list:
+    return sorted(f for f in os.listdir(parts_path) if f.startswith("part-") and f.endswith(".npz"))
+
+
+def _concatenate(arrays, empty_shape, dtype):
+    if len(arrays) == 0:
+        return np.zeros(empty_shape, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
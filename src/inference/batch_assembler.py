@@ -0,0 +1,93 @@
+# Copyright (c) 2024 TU Wien
+"""
+Moves batches to the compute device and assembles the model input in reused buffers.
+
+On cuda the resident host tensors are pinned once, so every batch can be copied with
+non_blocking=True on a side stream while the previous batch is still being processed. The resized
+model inputs are written into preallocated (B, 3, 224, 224) image and (B, 224, 224) depth buffers
+that are reused for every batch instead of stacking fresh tensors. On cpu the transfers are no-ops
+and only the buffer reuse remains.
+
+Frames loaded as PackedFrames are copied in their uint8/uint16 dtype and converted to float on the
+device in wait().
+"""
+import logging
+import torch
+try:
+    from src.inference.utils import prepare_batch_for_model
+    from src.inference.packed_frames import PackedFrame, unpack_frames
+except ImportError:
+    from utils import prepare_batch_for_model
+    from packed_frames import PackedFrame, unpack_frames
+
+logger = logging.getLogger(__name__)
+
+class BatchAssembler():
+    ''' Transfers batches to the device and prepares them for the model in reused buffers.
+
+    Args:
+        batch_size: maximum number of image pairs per batch
+        device: compute device
+        image_hw: resolution of the model input
+    '''
+    def __init__(self, batch_size: int, device="cpu", image_hw=(224, 224)):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == "cuda"
+        self._copy_stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        self.buffers = {
+            "image1": torch.empty((batch_size, 3, *image_hw), device=self.device),
+            "image2": torch.empty((batch_size, 3, *image_hw), device=self.device),
+            "depth1": torch.empty((batch_size, *image_hw), device=self.device),
+            "depth2": torch.empty((batch_size, *image_hw), device=self.device),
+        }
+
+    def pin(self, host_batch: dict) -> dict:
+        """ Pins the tensors of the resident host batch so they can be copied asynchronously. """
+        if not self.use_cuda:
+            return host_batch
+        for key, values in host_batch.items():
+            host_batch[key] = [_pin(value) for value in values]
+        return host_batch
+
+    def to_device(self, host_batch: dict) -> dict:
+        """ Starts copying a batch to the device without blocking. Call wait() before using it. """
+        if not self.use_cuda:
+            return {key: [_move(value, self.device) for value in values] \
+                for key, values in host_batch.items()}
+        with torch.cuda.stream(self._copy_stream):
+            return {key: [_move(value, self.device) for value in values] \
+                for key, values in host_batch.items()}
+
+    def wait(self, device_batch: dict) -> dict:
+        """ Makes the compute stream wait until the copies of a batch have finished and converts
+        packed frames to float on the device.
+        """
+        if not self.use_cuda:
+            return unpack_frames(device_batch)
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_stream(self._copy_stream)
+        for values in device_batch.values():
+            for value in values:
+                if isinstance(value, (torch.Tensor, PackedFrame)):
+                    # the tensors were allocated on the copy stream but are used on this one
+                    value.record_stream(compute_stream)
+        return unpack_frames(device_batch)
+
+    def assemble(self, batch: dict) -> dict:
+        """ Resizes and normalises the batch into the reused model input buffers. The returned
+        tensors are views of the buffers and are overwritten by the next call.
+        """
+        assert len(batch["image1"]) <= len(self.buffers["image1"]), \
+            f"batch of {len(batch['image1'])} does not fit into {len(self.buffers['image1'])} buffers"
+        return prepare_batch_for_model(batch, device=self.device, buffers=self.buffers)
+
+
+def _pin(value):
+    if isinstance(value, (torch.Tensor, PackedFrame)) and value.device.type != "cuda":
+        return value.pin_memory()
+    return value
+
+def _move(value, device):
+    if isinstance(value, (torch.Tensor, PackedFrame)):
+        return value.to(device, non_blocking=True)
+    return value
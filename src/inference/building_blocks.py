@@ -80,9 +80,15 @@ class Sequence2SpatialBlock(nn.Module):
 
 
 class FeatureFusionBlock(nn.Module):
-    def __init__(self, input_dims, hidden_dims, output_dims, output_resolution):
+    def __init__(self, input_dims, hidden_dims, output_dims, output_resolution, feature_resolution=(128, 128)):
         super().__init__()
         self.out_res = output_resolution
+        # the resizes to the resolution of the decoded features and to the output resolution are
+        # created once, forward does not modify the module (torch.compile)
+        self._resizes = nn.ModuleDict({
+            _resolution_key(hw): K.augmentation.Resize(tuple(hw), resample=2, keepdim=True)
+            for hw in (feature_resolution, output_resolution)
+        })
         self._conv_bn_layer1 = nn.Sequential(
             create_conv_layer_with_kaiming_init(input_dims, hidden_dims, kernel_size=3, stride=1, padding=1),
             create_batch_norm_layer_with_custom_init(hidden_dims),
@@ -93,15 +99,23 @@ class FeatureFusionBlock(nn.Module):
         )
 
     def forward(self, x, y):
-        bicubic_resize = K.augmentation.Resize(y.shape[-2:], resample=2, keepdim=True)
-        x = bicubic_resize(x)
+        x = self._bicubic_resize(tuple(y.shape[-2:]))(x)
         xy = torch.cat([x, y], dim=1)
         xy = self._conv_bn_layer1(xy)
         xy = F.gelu(xy)
         xy = self._conv_bn_layer2(xy)
         xy = F.gelu(xy)
-        bicubic_resize = K.augmentation.Resize(self.out_res, resample=2, keepdim=True)
-        return bicubic_resize(xy)
+        return self._bicubic_resize(tuple(self.out_res))(xy)
+
+    def _bicubic_resize(self, output_hw):
+        key = _resolution_key(output_hw)
+        if key in self._resizes:
+            return self._resizes[key]
+        return K.augmentation.Resize(output_hw, resample=2, keepdim=True)
+
+
+def _resolution_key(hw):
+    return f"{hw[0]}x{hw[1]}"
 
 
 class ResidualConvBock(nn.Module):
@@ -140,10 +154,10 @@ class DownSamplingBlock(nn.Module):
 
     def forward(self, input):
         shortcut = self.shortcut(input)
-        input = nn.ReLU()(self.bn1(self.conv1(input)))
-        input = nn.ReLU()(self.bn2(self.conv2(input)))
+        input = F.relu(self.bn1(self.conv1(input)))
+        input = F.relu(self.bn2(self.conv2(input)))
         input = input + shortcut
-        return nn.ReLU()(input)
+        return F.relu(input)
 
 
 def create_conv_layer_with_kaiming_init(*args, **kwargs):
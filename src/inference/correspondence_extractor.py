@@ -13,7 +13,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 class CorrespondenceExtractor(nn.Module):
-    def __init__(self, nms_radius=4, keypoint_threshold=0.005, max_keypoints=1024, superglue="indoor", sinkhorn_iterations=20, match_threshold=0.2, resize=640, device="cpu"):
+    def __init__(self, nms_radius=4, keypoint_threshold=0.005, max_keypoints=1024, superglue="indoor", sinkhorn_iterations=20, match_threshold=0.2, resize=640, device="cpu", state_dict=None):
         super().__init__()
         config = {
             'superpoint': {
@@ -27,7 +27,11 @@ class CorrespondenceExtractor(nn.Module):
                 'match_threshold': match_threshold,
             }
         }
-        self._matching = Matching(config).eval().to(device)
+        self._matching = Matching(config).eval()
+        if state_dict is not None:
+            # SuperPoint/SuperGlue weights from a model bundle
+            self._matching.load_state_dict(state_dict)
+        self._matching = self._matching.to(device)
         logger.debug('Running correspondance extractor on device \"{}\"'.format(device))
         self._resize = K.augmentation.Resize(resize, side="long")
 
@@ -0,0 +1,298 @@
+# Copyright (c) 2024 TU Wien
+"""
+Export friendly variant of the change detection model.
+
+Model.forward reads python lists from the batch dict, stores closures in
+batch["transform_points_1_to_2"] and renders the registered features with pytorch3d, so it can not
+be exported as a whole. ExportableModel splits it into
+
+- ChangeDetectionEncoder: image -> DINO features and the unet encoder pyramid (exportable)
+- registration: plain tensors computed once per batch by compute_registration_tensors
+  (K_inv, Rt, homographies, depth and a strategy code per pair), applied by register_features;
+  the point rendering stays in pytorch3d and runs eagerly
+- ChangeDetectionDecoder: registered pyramid -> CenterNet heatmaps (exportable)
+
+Points are transferred between the images with transform_points_between_images instead of the
+closures. export_model writes the encoder and decoder as TorchScript and ONNX.
+"""
+import os
+import logging
+import kornia as K
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from einops import rearrange
+try:
+    import src.inference.geometry as geometry
+    from src.inference.registeration_module import estimate_Rt_using_camera_parameters, \
+        estimate_Rt_using_points
+except ImportError:
+    import geometry
+    from registeration_module import estimate_Rt_using_camera_parameters, estimate_Rt_using_points
+
+logger = logging.getLogger(__name__)
+
+# strategy codes of the registration tensors
+STRATEGIES = ("3d", "2d", "identity")
+REGISTRATION_KEYS = ("K_inv_1", "K_inv_2", "Rt_1_to_2", "Rt_2_to_1", "M_1_to_2", "M_2_to_1", \
+    "depth1", "depth2", "strategy")
+ONNX_OPSET = 17
+
+
+class ChangeDetectionEncoder(nn.Module):
+    ''' Backbone and unet encoder of a Model. Returns the first DINO feature layer followed by the
+    encoder pyramid (64x64 last DINO layer and the outputs of the DownSamplingBlocks).
+    '''
+    def __init__(self, model):
+        super().__init__()
+        self.feature_backbone = model.feature_backbone
+        self.bicubic_resize = model.bicubic_resize
+        self.unet_encoder = model.unet_encoder
+
+    def forward(self, image):
+        dino_features = self.feature_backbone(image)
+        encoded_features = [self.bicubic_resize(dino_features[-1])]
+        for layer in self.unet_encoder:
+            encoded_features.append(layer(encoded_features[-1]))
+        return (dino_features[0], *encoded_features)
+
+
+class ChangeDetectionDecoder(nn.Module):
+    ''' Unet decoder, fusion block and CenterNet head of a Model. Takes the first DINO feature
+    layer and the registered encoder pyramid, returns the heatmap, wh and offset predictions.
+    '''
+    def __init__(self, model):
+        super().__init__()
+        self.unet_decoder = model.unet_decoder
+        self.feature_fusion_block = model.feature_fusion_block
+        self.centernet_head = model.centernet_head
+
+    def forward(self, dino_features, *encoded_features):
+        # the unet decoder skips its first input, which is an empty list in Model.forward
+        decoded_features = self.unet_decoder([], *encoded_features)
+        fused_features = self.feature_fusion_block(dino_features, decoded_features)
+        center_heatmap, wh, offset = self.centernet_head([fused_features])
+        return center_heatmap[0], wh[0], offset[0]
+
+
+class ExportableModel(nn.Module):
+    ''' Model with the registration given as plain tensors instead of the batch dict.
+
+    Args:
+        model: a loaded Model, its modules are shared
+    '''
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = ChangeDetectionEncoder(model)
+        self.decoder = ChangeDetectionDecoder(model)
+        self.feature_warper = model.registeration_module.feature_warper
+        self.centernet_head = model.centernet_head
+
+    def forward(self, image1, image2, registration: dict):
+        """ Returns the CenterNet outputs for both images like Model.forward. registration is the
+        dict returned by compute_registration_tensors.
+        """
+        image1_features = self.encoder(image1)
+        image2_features = self.encoder(image2)
+        image1_encoded_features = list(image1_features[1:])
+        image2_encoded_features = list(image2_features[1:])
+        for i in range(len(image1_encoded_features)):
+            image1_encoded_features[i], image2_encoded_features[i] = register_features(
+                self.feature_warper, registration,
+                image1_encoded_features[i].float(), image2_encoded_features[i].float())
+        image1_outputs = self.decoder(image1_features[0], *image1_encoded_features)
+        image2_outputs = self.decoder(image2_features[0], *image2_encoded_features)
+        return ([image1_outputs[0]], [image1_outputs[1]], [image1_outputs[2]]), \
+            ([image2_outputs[0]], [image2_outputs[1]], [image2_outputs[2]])
+
+    @torch.no_grad()
+    def predict(self, batch):
+        """ Same as Model.predict, without storing closures in the batch. """
+        registration = compute_registration_tensors(batch)
+        image1_outputs, image2_outputs = self(batch["image1"], batch["image2"], registration)
+        image1_predicted_bboxes = self.centernet_head.get_bboxes(
+            *image1_outputs, img_metas=batch["query_metadata"], rescale=False)
+        image2_predicted_bboxes = self.centernet_head.get_bboxes(
+            *image2_outputs, img_metas=batch["query_metadata"], rescale=False)
+        return image1_predicted_bboxes, image2_predicted_bboxes
+
+
+def compute_registration_tensors(batch) -> dict:
+    """ Computes the registration of every image pair of a prepared batch as plain tensors.
+
+    Returns:
+        dict with K_inv_1, K_inv_2 (B, 3, 3), Rt_1_to_2, Rt_2_to_1 (B, 4, 4) for 3d pairs,
+        M_1_to_2, M_2_to_1 (B, 3, 3) homographies for 2d pairs, depth1, depth2 (B, H, W) with
+        zeros for pairs without depth and strategy (B,) with the index into STRATEGIES
+    """
+    images = batch["image1"]
+    b, _, h, w = images.shape
+    strategy = torch.tensor([STRATEGIES.index(s) for s in batch["registration_strategy"]], \
+        device=images.device)
+    registration = {
+        "K_inv_1": images.new_zeros((b, 3, 3)),
+        "K_inv_2": images.new_zeros((b, 3, 3)),
+        "Rt_1_to_2": images.new_zeros((b, 4, 4)),
+        "Rt_2_to_1": images.new_zeros((b, 4, 4)),
+        "M_1_to_2": torch.eye(3).repeat(b, 1, 1).type_as(images),
+        "M_2_to_1": torch.eye(3).repeat(b, 1, 1).type_as(images),
+        "strategy": strategy,
+    }
+    for key in ["depth1", "depth2"]:
+        registration[key] = torch.stack([images.new_zeros((h, w)) if depth is None else depth \
+            for depth in batch[key]])
+
+    using_camera_parameters = [s == "3d" and batch["intrinsics1"][i] is not None \
+        for i, s in enumerate(batch["registration_strategy"])]
+    if any(using_camera_parameters):
+        indices = [i for i, x in enumerate(using_camera_parameters) if x]
+        K_inv_1, K_inv_2, Rt_1_to_2, Rt_2_to_1 = estimate_Rt_using_camera_parameters(
+            *[torch.stack([batch[key][i] for i in indices]) for key in \
+                ["intrinsics1", "intrinsics2", "rotation1", "rotation2", "position1", "position2"]])
+        _assign(registration, indices, K_inv_1=K_inv_1, K_inv_2=K_inv_2, \
+            Rt_1_to_2=Rt_1_to_2, Rt_2_to_1=Rt_2_to_1)
+    using_points = [s == "3d" and batch["intrinsics1"][i] is None \
+        for i, s in enumerate(batch["registration_strategy"])]
+    if any(using_points):
+        indices = [i for i, x in enumerate(using_points) if x]
+        K_inv_1, K_inv_2, Rt_1_to_2, Rt_2_to_1 = estimate_Rt_using_points(
+            [batch["points1"][i] for i in indices], [batch["points2"][i] for i in indices],
+            registration["depth1"][indices], registration["depth2"][indices])
+        _assign(registration, indices, K_inv_1=K_inv_1, K_inv_2=K_inv_2, \
+            Rt_1_to_2=Rt_1_to_2, Rt_2_to_1=Rt_2_to_1)
+    for i, s in enumerate(batch["registration_strategy"]):
+        if s != "2d":
+            continue
+        if batch["points1"][i] is not None:
+            p1, p2 = batch["points1"][i].unsqueeze(0), batch["points2"][i].unsqueeze(0)
+            registration["M_1_to_2"][i] = geometry.estimate_linear_warp(p1, p2).squeeze(0)
+            registration["M_2_to_1"][i] = geometry.estimate_linear_warp(p2, p1).squeeze(0)
+        else:
+            registration["M_1_to_2"][i] = batch["transfm2d_1_to_2"][i]
+            registration["M_2_to_1"][i] = batch["transfm2d_2_to_1"][i]
+    return registration
+
+
+def register_features(feature_warper, registration: dict, features1, features2):
+    """ Warps the features of each image onto the other one and returns the visible differences,
+    like FeatureRegisterationModule.forward.
+    """
+    registered1 = torch.zeros_like(features1)
+    registered2 = torch.zeros_like(features2)
+    for code, strategy in enumerate(STRATEGIES):
+        mask = registration["strategy"] == code
+        if not bool(mask.any()):
+            continue
+        subset = {key: value[mask] for key, value in registration.items()}
+        registered1[mask], registered2[mask] = _register_subset(
+            feature_warper, subset, features1[mask], features2[mask], strategy)
+    return registered1, registered2
+
+
+def transform_points_between_images(registration: dict, points, index_in_batch: int, \
+        direction: str = "1_to_2"):
+    """ Maps normalised (N, 2) points of one image into the other image of pair index_in_batch.
+    Replaces the batch["transform_points_*"] closures of FeatureRegisterationModule.
+    """
+    source, target = ("1", "2") if direction == "1_to_2" else ("2", "1")
+    strategy = STRATEGIES[int(registration["strategy"][index_in_batch])]
+    if strategy == "identity":
+        return points
+    points = points.unsqueeze(0)
+    if strategy == "2d":
+        return geometry.transform_points(
+            registration[f"M_{direction}"][index_in_batch].unsqueeze(0), points, keep_depth=False)[0]
+    Rt = registration[f"Rt_{direction}"][index_in_batch].unsqueeze(0)
+    return geometry.convert_world_to_image_coordinates(
+        geometry.convert_image_coordinates_to_world(
+            image_coords=points,
+            depth=geometry.sample_depth_for_given_points(
+                registration[f"depth{source}"][index_in_batch].unsqueeze(0), points),
+            K_inv=registration[f"K_inv_{source}"][index_in_batch].unsqueeze(0),
+            Rt=Rt,
+        ),
+        registration[f"K_inv_{target}"][index_in_batch].unsqueeze(0),
+        torch.eye(4).unsqueeze(0).type_as(Rt),
+        keep_depth=False,
+    )[0]
+
+
+def export_model(model, save_dir: str, batch_size: int = 1, formats=("torchscript", "onnx")) -> dict:
+    """ Exports encoder and decoder of a Model.
+
+    Returns:
+        dict of format -> list of written files
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    model = model.eval()
+    device = next(model.parameters()).device
+    encoder = ChangeDetectionEncoder(model).eval()
+    decoder = ChangeDetectionDecoder(model).eval()
+    example_image = torch.rand((batch_size, 3, 224, 224), device=device)
+    with torch.no_grad():
+        example_features = encoder(example_image)
+    feature_names = ["dino_features"] + [f"encoded_features_{i}" \
+        for i in range(len(example_features) - 1)]
+    written = {}
+    if "torchscript" in formats:
+        with torch.no_grad():
+            traced_encoder = torch.jit.trace(encoder, example_image, check_trace=False)
+            traced_decoder = torch.jit.trace(decoder, example_features, check_trace=False)
+        written["torchscript"] = [os.path.join(save_dir, "encoder.ts"), \
+            os.path.join(save_dir, "decoder.ts")]
+        traced_encoder.save(written["torchscript"][0])
+        traced_decoder.save(written["torchscript"][1])
+    if "onnx" in formats:
+        written["onnx"] = [os.path.join(save_dir, "encoder.onnx"), \
+            os.path.join(save_dir, "decoder.onnx")]
+        dynamic_axes = {name: {0: "batch"} for name in ["image"] + feature_names + \
+            ["center_heatmap", "wh", "offset"]}
+        with torch.no_grad():
+            torch.onnx.export(encoder, (example_image,), written["onnx"][0], \
+                input_names=["image"], output_names=feature_names, dynamic_axes=dynamic_axes, \
+                opset_version=ONNX_OPSET)
+            torch.onnx.export(decoder, example_features, written["onnx"][1], \
+                input_names=feature_names, output_names=["center_heatmap", "wh", "offset"], \
+                dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET)
+    for files in written.values():
+        for file in files:
+            logger.info("exported %s", file)
+    return written
+
+
+def _register_subset(feature_warper, registration, features1, features2, strategy):
+    b, _, h, w = features1.shape
+    if strategy == "identity":
+        image_coords = F.pad(_image_coordinates(b, h, w, features1), (0, 1), value=1)
+        warped1 = feature_warper.render_features_from_points(image_coords, features1)
+        warped2 = feature_warper.render_features_from_points(image_coords, features2)
+        return features1 - warped2, features2 - warped1
+    visibility = torch.ones((b, 1, h, w), requires_grad=False).type_as(features1)
+    features1_with_visibility = torch.cat([features1, visibility], dim=1)
+    features2_with_visibility = torch.cat([features2, visibility], dim=1)
+    if strategy == "3d":
+        nearest_resize = K.augmentation.Resize((h, w), resample=0, align_corners=None, keepdim=True)
+        warped1 = feature_warper.warp(features1_with_visibility, \
+            nearest_resize(registration["depth1"]), registration["K_inv_1"], \
+            registration["K_inv_2"], registration["Rt_1_to_2"])
+        warped2 = feature_warper.warp(features2_with_visibility, \
+            nearest_resize(registration["depth2"]), registration["K_inv_2"], \
+            registration["K_inv_1"], registration["Rt_2_to_1"])
+    else:
+        image_coords = _image_coordinates(b, h, w, features1)
+        warped1 = feature_warper.render_features_from_points(geometry.transform_points( \
+            registration["M_1_to_2"], image_coords, keep_depth=True), features1_with_visibility)
+        warped2 = feature_warper.render_features_from_points(geometry.transform_points( \
+            registration["M_2_to_1"], image_coords, keep_depth=True), features2_with_visibility)
+    visibility1, visibility2 = warped1[:, -1:], warped2[:, -1:]
+    return visibility2 * (features1 - warped2[:, :-1]), visibility1 * (features2 - warped1[:, :-1])
+
+
+def _image_coordinates(b, h, w, type_as):
+    return rearrange(geometry.get_index_grid(h, w, batch=b, type_as=type_as), \
+        "b h w t -> b (h w) t")
+
+
+def _assign(registration, indices, **values):
+    for key, value in values.items():
+        registration[key][indices] = value
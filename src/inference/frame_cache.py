@@ -0,0 +1,212 @@
+# Copyright (c) 2024 TU Wien
+"""
+Decode-once cache for the RGB and depth frames of a room.
+
+Every inference run decodes the same PNG/TIFF frames again. create_frame_cache.py decodes them once
+and packs them into uint8 (RGB) and uint16 (depth) arrays, one .npy file per dtype and resolution,
+together with an index:
+
+    data/GH30_Office/frame_cache/
+        rgb_uint8_480x640.npy       (N, 3, 480, 640) uint8
+        depth_uint16_480x640.npy    (N, 480, 640) uint16
+        index.yaml                  {relative frame path: {array, row, mtime, size}}
+
+The arrays are memory mapped, so reading a frame is a slice without any decoding. Frames are kept
+at their full resolution, because depth prediction and correspondence matching run before the
+images are resized to the model input. Frames that changed on disk after the cache was built are
+treated as misses and decoded as usual.
+
+Each dataset lists its frames differently: find_frames scans the sceneN/ directories of a GH30
+room, find_rc3d_frames reads the coco_annotations.json of an RC3D part (every part has its own
+cache) and find_kc3d_frames the test split of the KC3D data_split.pkl.
+"""
+import os
+import re
+import json
+import pickle
+import shutil
+import logging
+import yaml
+import numpy as np
+import imageio.v2 as imageio
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+CACHE_DIR = "frame_cache"
+INDEX_FILE = "index.yaml"
+FRAME_SUFFIXES = (".png", ".jpg", ".jpeg", ".tiff", ".tif")
+# the camera frames referenced by input_metadata.yaml, annotate.py and the prediction writer put
+# their own PNGs next to them (ground_truth/, image_<plane>_<key>.png, predictions/)
+RGB_PREFIX = "hsrb_head_rgbd_sensor_rgb_image_raw-"
+DEPTH_PREFIX = "hsrb_head_rgbd_sensor_depth_registered_image_raw-"
+SCENE_PATTERN = re.compile(r"scene\d+")
+RC3D_PARTS = ("part1", "part2", "part3", "part4")
+
+
+class FrameCache():
+    ''' Read access to a frame cache. Missing or outdated frames return None.
+
+    Args:
+        root: directory the frame paths are relative to, e.g. data/GH30_Office
+        cache_path: directory of the cache, defaults to <root>/frame_cache
+    '''
+    def __init__(self, root: str, cache_path: str = None):
+        self.root = os.path.abspath(root)
+        self.cache_path = cache_path if cache_path is not None else os.path.join(root, CACHE_DIR)
+        with open(os.path.join(self.cache_path, INDEX_FILE), "r", encoding="utf-8") as file:
+            index = yaml.safe_load(file)
+        if index["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"unsupported frame cache version {index['format_version']}")
+        self.frames = index["frames"]
+        self._arrays = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, root: str, cache_path: str = None):
+        """ Returns the cache of root or None if it was not built yet. """
+        cache_path = cache_path if cache_path is not None else os.path.join(root, CACHE_DIR)
+        if not os.path.isfile(os.path.join(cache_path, INDEX_FILE)):
+            return None
+        return cls(root, cache_path)
+
+    def get(self, path: str) -> np.ndarray:
+        """ Returns the cached frame as read only array, (3, H, W) uint8 for RGB frames and
+        (H, W) for depth maps, or None if the frame is not cached or changed on disk.
+        """
+        entry = self.frames.get(self._key(path))
+        if entry is None or not _is_unchanged(path, entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._array(entry["array"])[entry["row"]]
+
+    def __contains__(self, path: str) -> bool:
+        return self._key(path) in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def _array(self, name: str) -> np.ndarray:
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.cache_path, f"{name}.npy"), mmap_mode="r")
+        return self._arrays[name]
+
+
+def build_frame_cache(root: str, rgb_paths, depth_paths, cache_path: str = None) -> str:
+    """ Decodes the frames once and writes them as frame cache of root.
+
+    Args:
+        root: directory the frame paths are stored relative to
+        rgb_paths: paths of the RGB frames
+        depth_paths: paths of the depth maps (.png or .tiff)
+        cache_path: directory of the cache, defaults to <root>/frame_cache
+
+    Returns:
+        the directory of the cache
+    """
+    cache_path = cache_path if cache_path is not None else os.path.join(root, CACHE_DIR)
+    root = os.path.abspath(root)
+    groups = {}
+    frames = {}
+    for kind, paths, read in [("rgb", rgb_paths, read_rgb_frame), \
+            ("depth", depth_paths, read_depth_frame)]:
+        for path in sorted(set(paths)):
+            frame = read(path)
+            name = f"{kind}_{frame.dtype.name}_{frame.shape[-2]}x{frame.shape[-1]}"
+            rows = groups.setdefault(name, [])
+            stat = os.stat(path)
+            frames[os.path.relpath(os.path.abspath(path), root)] = {
+                "array": name, "row": len(rows), "mtime": stat.st_mtime_ns, "size": stat.st_size}
+            rows.append(frame)
+
+    tmp_path = f"{cache_path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, rows in groups.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), np.stack(rows))
+        logger.debug("packed %s frames into %s", len(rows), name)
+    with open(os.path.join(tmp_path, INDEX_FILE), "w", encoding="utf-8") as file:
+        yaml.safe_dump({"format_version": FORMAT_VERSION, "frames": frames}, file)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+    logger.info("cached %s frames in %s", len(frames), cache_path)
+    return cache_path
+
+
+def find_frames(root: str):
+    """ Returns (rgb_paths, depth_paths) of the camera frames in the sceneN/ directories of a room
+    (or in root itself if it is a scene directory). Subdirectories and files written by the
+    pipeline are skipped.
+    """
+    if SCENE_PATTERN.fullmatch(os.path.basename(os.path.normpath(root))):
+        scene_dirs = [root]
+    else:
+        scene_dirs = [os.path.join(root, d) for d in sorted(os.listdir(root)) \
+            if SCENE_PATTERN.fullmatch(d) and os.path.isdir(os.path.join(root, d))]
+    rgb_paths, depth_paths = [], []
+    for directory in scene_dirs:
+        for file in sorted(os.listdir(directory)):
+            if not file.lower().endswith(FRAME_SUFFIXES):
+                continue
+            if file.startswith(RGB_PREFIX):
+                rgb_paths.append(os.path.join(directory, file))
+            elif file.startswith(DEPTH_PREFIX):
+                depth_paths.append(os.path.join(directory, file))
+    return rgb_paths, depth_paths
+
+
+def find_rc3d_frames(root: str):
+    """ Returns (rgb_paths, depth_paths) of the image pairs of an RC3D part, as read by
+    rc3d.SubDataset. Depth maps are only listed if they exist.
+    """
+    with open(os.path.join(root, "coco_annotations.json"), "r", encoding="utf-8") as file:
+        images = json.load(file)["images"]
+    file_names = [image["file_name"] for image in images[0::3] + images[2::3]]
+    rgb_paths = [os.path.join(root, file_name) for file_name in file_names]
+    depth_paths = [os.path.join(root, f"depth_{file_name.replace('.jpg', '')}.png") \
+        for file_name in file_names]
+    return rgb_paths, [path for path in depth_paths if os.path.isfile(path)]
+
+
+def find_kc3d_frames(root: str):
+    """ Returns (rgb_paths, depth_paths) of the test split of a KC3D dataset, as read by
+    kc3d.KC3D.
+    """
+    with open(os.path.join(root, "data_split.pkl"), "rb") as file:
+        scenes = pickle.load(file)["test"]
+    rgb_paths = [os.path.join(root, scene[key]) for scene in scenes for key in ("image1", "image2")]
+    depth_paths = [os.path.join(root, scene[key]) for scene in scenes for key in ("depth1", "depth2")]
+    return rgb_paths, depth_paths
+
+
+def read_rgb_frame(path: str) -> np.ndarray:
+    """ Decodes an image as (3, H, W) uint8 array. """
+    with open(path, "rb") as file:
+        image = np.asarray(Image.open(file).convert("RGB"))
+    return np.ascontiguousarray(image.transpose(2, 0, 1))
+
+
+def read_depth_frame(path: str) -> np.ndarray:
+    """ Decodes a depth map as (H, W) array in its stored dtype (uint16 for PNG). """
+    if path.lower().endswith((".tiff", ".tif")):
+        depth = imageio.imread(path, format="tiff")
+    else:
+        with open(path, "rb") as file:
+            depth = np.asarray(Image.open(file))
+    return np.ascontiguousarray(np.squeeze(depth))
+
+
+def _is_unchanged(path: str, entry: dict) -> bool:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_mtime_ns == entry["mtime"] and stat.st_size == entry["size"]
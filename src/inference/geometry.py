@@ -1,13 +1,9 @@
-import kornia as K
 import numpy as np
 import torch
 import torch.nn.functional as F
 from einops import rearrange, repeat
-from pytorch3d.transforms import matrix_to_quaternion
-from scipy.ndimage import generate_binary_structure
-from scipy.ndimage import label as label_connected_components
-from torchvision.ops import masks_to_boxes
-import shapely.geometry
+# kornia, pytorch3d and shapely are imported where they are used, so that scripts which only
+# need the bbox filters (annotate.py) do not pay for them at startup
 
 
 def get_index_grid(height, width, batch=None, type_as=None):
@@ -175,6 +171,7 @@ def get_relative_pose(rotation_before, rotation_after, position_before, position
     if as_single_matrix:
         return Rt_1_to_2, Rt_2_to_1
 
+    from pytorch3d.transforms import matrix_to_quaternion
     rotation_from_1_to_2 = matrix_to_quaternion(Rt_1_to_2[:, :3, :3])
     rotation_from_2_to_1 = matrix_to_quaternion(Rt_2_to_1[:, :3, :3])
     translation_from_1_to_2 = Rt_1_to_2[:, :3, 3]
@@ -188,6 +185,7 @@ def get_relative_pose(rotation_before, rotation_after, position_before, position
 
 
 def bboxes_to_masks(batch_of_boxes, image_hw):
+    import kornia as K
     type_as = batch_of_boxes[0]
     masks = []
     for boxes in batch_of_boxes:
@@ -253,6 +251,7 @@ def sample_depth_for_given_points(depth_map, points):
     return rearrange(depth_of_points, "b 1 1 n -> b n")
 
 def remove_bboxes_with_area_less_than(bboxes_as_np_array, threshold):
+    import shapely.geometry
     bboxes = []
 
     for bbox in bboxes_as_np_array:
@@ -271,6 +270,7 @@ def keep_matching_bboxes(batch, image_index, left_predictions, right_predictions
     we can filter out bboxes that don't have a corresponding bbox in the other image.
     The process of finding "corresponding bounding boxes" is a bit naive for now.
     """
+    import shapely.geometry
     
     left_high_confidence_bboxes = left_predictions[left_scores > confidence_threshold]
     right_high_confidence_bboxes = right_predictions[right_scores > confidence_threshold]
@@ -7,16 +7,21 @@ import numpy as np
 import torch
 import torch.nn as nn
 from einops import rearrange
-from etils import epath
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision.transforms.functional import pil_to_tensor
 from tqdm import tqdm
 from torchvision.ops import masks_to_boxes
+try:
+    from src.inference.frame_cache import FrameCache
+except ImportError:
+    from frame_cache import FrameCache
 
 class KC3D(Dataset):
-    def __init__(self, path_to_dataset, use_ground_truth_registration):
+    def __init__(self, path_to_dataset, use_ground_truth_registration, use_frame_cache=True):
         self.path_to_dataset = path_to_dataset
+        # frames packed by create_frame_cache.py are sliced instead of decoded
+        self.frame_cache = FrameCache.open(path_to_dataset) if use_frame_cache else None
         self.data = self.get_data_info(path_to_dataset)
         len_train = len(self.data["train"])
         len_val = len(self.data["val"])
@@ -35,6 +40,9 @@ class KC3D(Dataset):
         """
         Returms a normalised RGB image as tensor.
         """
+        frame = self.frame_cache.get(path_to_image) if self.frame_cache is not None else None
+        if frame is not None:
+            return torch.from_numpy(np.array(frame)).float() / 255.0
         with open(path_to_image, "rb") as file:
             pil_image = Image.open(file).convert("RGB")
             image_as_tensor = pil_to_tensor(pil_image).float() / 255.0
@@ -44,8 +52,10 @@ class KC3D(Dataset):
         """
         Returns the depth map as a float tensor.
         """
-        filename = epath.Path(path_to_depth)
-        img = imageio.imread(filename.read_bytes(), format="tiff")
+        frame = self.frame_cache.get(path_to_depth) if self.frame_cache is not None else None
+        if frame is not None:
+            return torch.from_numpy(np.array(frame, dtype=np.float32))
+        img = imageio.imread(path_to_depth, format="tiff")
         if img.ndim == 2:
             img = img[:, :, None]
         return K.image_to_tensor(img).float().squeeze()
@@ -1,3 +1,4 @@
+import contextlib
 import math
 import os
 import pickle
@@ -22,11 +23,26 @@ except ImportError:
     from building_blocks import DownSamplingBlock, FeatureFusionBlock, Sequence2SpatialBlock
     from registeration_module import FeatureRegisterationModule
 
+# autocast dtypes of the precision modes, fp32 runs without autocast
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
 class Model(nn.Module):
-    def __init__(self, args, load_weights_from=None):
+    def __init__(self, args, load_weights_from=None, precision="fp32", pretrained_backbone=True):
         super().__init__()
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {list(PRECISIONS)}, got {precision}")
         self.args = args
-        model = build_model(args)
+        self.precision = precision
+        # torch.compile'd encode/decode stages, see compile_stages()
+        self._compiled_stages = {}
+        checkpoint_state_dict = None
+        if load_weights_from is not None:
+            checkpoint_state_dict = torch.load(load_weights_from, map_location="cpu")
+        # the pretrained DINO weights are only downloaded if the checkpoint does not replace them,
+        # pretrained_backbone=False skips them for weights that are loaded afterwards (bundles)
+        model = build_model(args, pretrained=False)
+        if pretrained_backbone and not checkpoint_covers_backbone(checkpoint_state_dict, model):
+            load_pretrained_backbone(model)
         self.feature_backbone = FeatureBackbone(args, model)
         self.registeration_module = FeatureRegisterationModule(args)
         self.bicubic_resize = K.augmentation.Resize((64, 64), resample=2, keepdim=True)
@@ -41,7 +57,9 @@ class Model(nn.Module):
             num_coam_layers=0,
             return_features=False,
         )
-        self.feature_fusion_block = FeatureFusionBlock(input_dims=64 + 768, hidden_dims=256, output_dims=64, output_resolution=[224,224])
+        # the unet encoder halves the 64x64 features per block, every decoder block doubles them
+        feature_resolution = [64 // 2 ** len(args.decoder.downsampling_blocks) * 2 ** len(args.decoder.decoder_channels)] * 2
+        self.feature_fusion_block = FeatureFusionBlock(input_dims=64 + 768, hidden_dims=256, output_dims=64, output_resolution=[224,224], feature_resolution=feature_resolution)
         self.centernet_head = CenterNetHead(
             in_channel=64,
             feat_channel=64,
@@ -49,8 +67,8 @@ class Model(nn.Module):
             test_cfg=EasyDict({"topk": 100, "local_maximum_kernel": 3, "max_per_img": 100}),
         )
         self.centernet_head.init_weights()
-        if load_weights_from is not None:
-            self.safely_load_state_dict(torch.load(load_weights_from))
+        if checkpoint_state_dict is not None:
+            self.safely_load_state_dict(checkpoint_state_dict)
 
     def safely_load_state_dict(self, checkpoint_state_dict):
         model_state_dict = self.state_dict()
@@ -68,28 +86,111 @@ class Model(nn.Module):
                 L.log("INFO", f"Dropping parameter {k}")
         self.load_state_dict(checkpoint_state_dict, strict=False)
 
+    def autocast(self):
+        """
+        Returns the autocast context of the precision mode. fp16 needs cuda, on cpu bf16 is used.
+        """
+        dtype = PRECISIONS[self.precision]
+        if dtype is None:
+            return contextlib.nullcontext()
+        device_type = next(self.parameters()).device.type
+        if device_type == "cpu" and dtype == torch.float16:
+            L.log("WARNING", "fp16 autocast is not available on cpu, using bf16")
+            dtype = torch.bfloat16
+        return torch.autocast(device_type=device_type, dtype=dtype)
+
+    def compile_stages(self, cache_dir=None, mode=None, fullgraph=False):
+        """
+        Compiles the static shape stages (backbone + unet encoder, unet decoder + fusion) with
+        torch.compile. The registration module runs eagerly in between. With cache_dir the inductor
+        artifacts are kept on disk and reused by later runs. fullgraph=True makes a graph break an
+        error instead of a silent fallback, see explain_stages(). Call warmup() before timing.
+        """
+        if not hasattr(torch, "compile"):
+            L.log("WARNING", "torch.compile needs torch>=2.0, running eagerly")
+            return self
+        if cache_dir is not None:
+            # read by inductor when the first graph is compiled
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+            try:
+                import torch._inductor.config as inductor_config
+                inductor_config.fx_graph_cache = True
+            except (ImportError, AttributeError):
+                pass
+        self._compiled_stages = {
+            "encode": torch.compile(self._encode, mode=mode, dynamic=False, fullgraph=fullgraph),
+            "decode": torch.compile(self._decode, mode=mode, dynamic=False, fullgraph=fullgraph),
+        }
+        return self
+
+    @torch.no_grad()
+    def explain_stages(self, batch_size=1):
+        """
+        Traces the encode and decode stages with torch._dynamo.explain on dummy inputs.
+        Returns {stage: (graph count, graph break count, break reasons)}.
+        """
+        import torch._dynamo
+        device = next(self.parameters()).device
+        images = torch.zeros((batch_size, 3, 224, 224), device=device)
+        dino_features, encoded_features = self._encode(images)
+        explanations = {
+            "encode": torch._dynamo.explain(self._encode)(images),
+            "decode": torch._dynamo.explain(self._decode)(dino_features, encoded_features),
+        }
+        torch._dynamo.reset()
+        return {name: (explanation.graph_count, explanation.graph_break_count,
+                       [str(reason.reason) for reason in explanation.break_reasons])
+                for name, explanation in explanations.items()}
+
+    @torch.no_grad()
+    def warmup(self, batch_sizes=(1,), iterations=2):
+        """
+        Runs the encode and decode stages on dummy inputs of every batch size, so compilation (and
+        cudnn autotuning) happens before the first real batch.
+        """
+        device = next(self.parameters()).device
+        for batch_size in batch_sizes:
+            for _ in range(iterations):
+                images = torch.zeros((batch_size, 3, 224, 224), device=device)
+                with self.autocast():
+                    dino_features, encoded_features = self._stage("encode")(images)
+                encoded_features = [encoded_features[0]] + [f.float() for f in encoded_features[1:]]
+                with self.autocast():
+                    self._stage("decode")(dino_features, encoded_features)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def _stage(self, name):
+        return self._compiled_stages.get(name, getattr(self, f"_{name}"))
+
+    def _encode(self, image):
+        dino_features = self.feature_backbone(image)
+        encoded_features = [[], self.bicubic_resize(dino_features[-1])]
+        for layer in self.unet_encoder:
+            encoded_features.append(layer(encoded_features[-1]))
+        return dino_features, encoded_features
+
+    def _decode(self, dino_features, encoded_features):
+        decoded_features = self.unet_decoder(*encoded_features)
+        return self.feature_fusion_block(dino_features[0], decoded_features)
+
     def forward(self, batch):
         print("predicting...")
-        image1_dino_features = self.feature_backbone(batch["image1"])
-        image2_dino_features = self.feature_backbone(batch["image2"])
-        image1_last_layer = self.bicubic_resize(image1_dino_features[-1])
-        image2_last_layer = self.bicubic_resize(image2_dino_features[-1])
-        image1_encoded_features = [[], image1_last_layer]
-        image2_encoded_features = [[], image2_last_layer]
-        for layer in self.unet_encoder:
-            image1_encoded_features.append(layer(image1_encoded_features[-1]))
-            image2_encoded_features.append(layer(image2_encoded_features[-1]))
+        # backbone, unet and fusion run in the precision mode, registration and centernet in fp32
+        with self.autocast():
+            image1_dino_features, image1_encoded_features = self._stage("encode")(batch["image1"])
+            image2_dino_features, image2_encoded_features = self._stage("encode")(batch["image2"])
         for i in range(len(self.unet_encoder)+1):
             image1_encoded_features[i + 1], image2_encoded_features[i + 1] = self.registeration_module(
-                batch, image1_encoded_features[i + 1], image2_encoded_features[i + 1]
+                batch, image1_encoded_features[i + 1].float(), image2_encoded_features[i + 1].float()
             )
-        image1_decoded_features = self.unet_decoder(*image1_encoded_features)
-        image2_decoded_features = self.unet_decoder(*image2_encoded_features)
-        image1_decoded_features = self.feature_fusion_block(image1_dino_features[0], image1_decoded_features)
-        image2_decoded_features = self.feature_fusion_block(image2_dino_features[0], image2_decoded_features)
+        with self.autocast():
+            image1_decoded_features = self._stage("decode")(image1_dino_features, image1_encoded_features)
+            image2_decoded_features = self._stage("decode")(image2_dino_features, image2_encoded_features)
         return (
-            self.centernet_head([image1_decoded_features]),
-            self.centernet_head([image2_decoded_features]),
+            self.centernet_head([image1_decoded_features.float()]),
+            self.centernet_head([image2_decoded_features.float()]),
         )
 
     def get_bboxes_from_logits(self, image1_outputs, image2_outputs, batch):
@@ -152,8 +253,11 @@ class FeatureBackbone(nn.Module):
         self._features.clear()  # clear for next forward pass
         return output
 
-def build_model(args, frozen=True):
-    model = timm.create_model("vit_base_patch8_224_dino", pretrained=True)
+BACKBONE_NAME = "vit_base_patch8_224_dino"
+BACKBONE_PREFIX = "feature_backbone.model."
+
+def build_model(args, frozen=True, pretrained=True):
+    model = timm.create_model(BACKBONE_NAME, pretrained=pretrained)
     model = patch_vit_resolution(model, image_hw=[224,224], stride=args.encoder.stride)
     if frozen:
         for _, value in model.named_parameters():
@@ -161,6 +265,36 @@ def build_model(args, frozen=True):
     return model
 
 
+def config_to_dict(args):
+    """
+    Converts a (nested) EasyDict config into plain dicts and lists, e.g. for saving it.
+    """
+    if isinstance(args, dict):
+        return {key: config_to_dict(value) for key, value in args.items()}
+    if isinstance(args, (list, tuple)):
+        return [config_to_dict(value) for value in args]
+    return args
+
+def checkpoint_covers_backbone(checkpoint_state_dict, backbone: nn.Module) -> bool:
+    """
+    Returns True if the checkpoint contains every weight of the ViT backbone with a matching shape.
+    """
+    if checkpoint_state_dict is None:
+        return False
+    for key, value in backbone.state_dict().items():
+        checkpoint_value = checkpoint_state_dict.get(BACKBONE_PREFIX + key)
+        if checkpoint_value is None or checkpoint_value.shape != value.shape:
+            return False
+    return True
+
+def load_pretrained_backbone(backbone: nn.Module) -> None:
+    """
+    Loads the pretrained timm weights into an already built (and patched) backbone.
+    """
+    L.log("INFO", f"Loading pretrained {BACKBONE_NAME} weights")
+    pretrained = timm.create_model(BACKBONE_NAME, pretrained=True)
+    backbone.load_state_dict(pretrained.state_dict())
+
 def patch_vit_resolution(model: nn.Module, image_hw, stride: int) -> nn.Module:
     """
     change resolution of model output by changing the stride of the patch extraction.
@@ -179,8 +313,31 @@ def patch_vit_resolution(model: nn.Module, image_hw, stride: int) -> nn.Module:
     model.patch_embed.proj.stride = stride
     # fix the positional encoding code
     model._pos_embed = types.MethodType(fix_pos_enc(patch_size, image_hw, stride), model)
+    # the interpolated embedding is a buffer, so it follows .to()/_apply; loading weights
+    # recomputes it, forward only reads it
+    model._pos_embed_geometry = (patch_size, tuple(image_hw), stride)
+    refresh_interpolated_pos_embed(model)
+    model.register_load_state_dict_post_hook(_refresh_interpolated_pos_embed_hook)
     return model
 
+def refresh_interpolated_pos_embed(model: nn.Module) -> None:
+    """
+    Interpolates pos_embed of a patched ViT to its strided grid and stores it as non-persistent
+    interpolated_pos_embed buffer. Called after the weights of the ViT changed.
+    """
+    patch_size, image_hw, stride_hw = model._pos_embed_geometry
+    with torch.no_grad():
+        interpolated = _interpolate_pos_embed(model.pos_embed.detach(), \
+            _num_patches(patch_size, image_hw, stride_hw), image_hw, patch_size, stride_hw)
+    model.register_buffer("interpolated_pos_embed", interpolated, persistent=False)
+
+def _refresh_interpolated_pos_embed_hook(module, incompatible_keys):
+    refresh_interpolated_pos_embed(module)
+
+def _num_patches(patch_size, image_hw, stride_hw) -> int:
+    h, w = image_hw
+    return (1 + (w - patch_size[1]) // stride_hw[1]) * (1 + (h - patch_size[1]) // stride_hw[0])
+
 def fix_pos_enc(patch_size: Tuple[int, int], image_hw, stride_hw: Tuple[int, int]):
     """
     Creates a method for position encoding interpolation.
@@ -197,28 +354,36 @@ def fix_pos_enc(patch_size: Tuple[int, int], image_hw, stride_hw: Tuple[int, int
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == h:
             return self.pos_embed
-        class_pos_embed = self.pos_embed[:, 0]
-        patch_pos_embed = self.pos_embed[:, 1:]
-        dim = x.shape[-1]
-        # compute number of tokens taking stride into account
-        w0 = 1 + (w - patch_size[1]) // stride_hw[1]
-        h0 = 1 + (h - patch_size[1]) // stride_hw[0]
-        assert (
-            w0 * h0 == npatch
-        ), f"""got wrong grid size for {h}x{w} with patch_size {patch_size} and
-                                        stride {stride_hw} got {h0}x{w0}={h0 * w0} expecting {npatch}"""
-        # we add a small number to avoid floating point error in the interpolation
-        # see discussion at https://github.com/facebookresearch/dino/issues/8
-        w0, h0 = w0 + 0.1, h0 + 0.1
-        patch_pos_embed = nn.functional.interpolate(
-            patch_pos_embed.reshape(1, int(math.sqrt(N)), int(math.sqrt(N)), dim).permute(0, 3, 1, 2),
-            scale_factor=(w0 / math.sqrt(N), h0 / math.sqrt(N)),
-            mode="bicubic",
-            align_corners=False,
-            recompute_scale_factor=False,
-        )
-        assert int(w0) == patch_pos_embed.shape[-2] and int(h0) == patch_pos_embed.shape[-1]
-        patch_pos_embed = patch_pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
-        return x + torch.cat((class_pos_embed.unsqueeze(0), patch_pos_embed), dim=1)
+        if self.pos_embed.requires_grad and torch.is_grad_enabled():
+            return x + _interpolate_pos_embed(self.pos_embed, npatch, image_hw, patch_size, stride_hw)
+        # image_hw and the stride are fixed, see refresh_interpolated_pos_embed
+        return x + self.interpolated_pos_embed
+
+    return interpolate_pos_encoding
 
-    return interpolate_pos_encoding
\ No newline at end of file
+def _interpolate_pos_embed(pos_embed, npatch, image_hw, patch_size, stride_hw) -> torch.Tensor:
+    h, w = image_hw
+    N = pos_embed.shape[1] - 1
+    class_pos_embed = pos_embed[:, 0]
+    patch_pos_embed = pos_embed[:, 1:]
+    dim = pos_embed.shape[-1]
+    # compute number of tokens taking stride into account
+    w0 = 1 + (w - patch_size[1]) // stride_hw[1]
+    h0 = 1 + (h - patch_size[1]) // stride_hw[0]
+    assert (
+        w0 * h0 == npatch
+    ), f"""got wrong grid size for {h}x{w} with patch_size {patch_size} and
+                                    stride {stride_hw} got {h0}x{w0}={h0 * w0} expecting {npatch}"""
+    # we add a small number to avoid floating point error in the interpolation
+    # see discussion at https://github.com/facebookresearch/dino/issues/8
+    w0, h0 = w0 + 0.1, h0 + 0.1
+    patch_pos_embed = nn.functional.interpolate(
+        patch_pos_embed.reshape(1, int(math.sqrt(N)), int(math.sqrt(N)), dim).permute(0, 3, 1, 2),
+        scale_factor=(w0 / math.sqrt(N), h0 / math.sqrt(N)),
+        mode="bicubic",
+        align_corners=False,
+        recompute_scale_factor=False,
+    )
+    assert int(w0) == patch_pos_embed.shape[-2] and int(h0) == patch_pos_embed.shape[-1]
+    patch_pos_embed = patch_pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
+    return torch.cat((class_pos_embed.unsqueeze(0), patch_pos_embed), dim=1)
@@ -0,0 +1,192 @@
+# Copyright (c) 2024 TU Wien
+"""
+Single file bundle of all networks needed for inference.
+
+Without a bundle every start resolves ZoeDepth through torch.hub, downloads the DINO weights with
+timm and then overwrites them with cyws-3d.ckpt. A bundle (created with create_model_bundle.py) is
+one torch.save archive:
+
+    {
+        "format": "cyws3d-bundle", "version": 1,
+        "config": model config (config.yml),
+        "weights": {"cyws3d": ..., "zoedepth": ..., "matching": ...},   # state dicts
+        "hashes": {"cyws3d": sha256, ...},
+        "zoedepth": {"repo": "isl-org/ZoeDepth", "model": "ZoeD_NK"},
+    }
+
+It is loaded with mmap=True and weights_only=True, so the weights are paged in from the file
+instead of being read and copied up front. Where torch supports it (>=2.1) the cyws3d model is
+built on the meta device and the mapped weights are assigned directly, without initialising
+the parameters first. ZoeDepth is built from the torch.hub cache (source="local") without
+downloading its weights; the hub code has to be cached once, e.g. by creating the bundle.
+"""
+import os
+import time
+import hashlib
+import inspect
+import logging
+import torch
+import torch.nn as nn
+from easydict import EasyDict
+try:
+    from src.inference.model import Model, config_to_dict
+    from src.inference.correspondence_extractor import CorrespondenceExtractor
+except ImportError:
+    from model import Model, config_to_dict
+    from correspondence_extractor import CorrespondenceExtractor
+
+logger = logging.getLogger(__name__)
+
+FORMAT = "cyws3d-bundle"
+VERSION = 1
+ZOEDEPTH_REPO = "isl-org/ZoeDepth"
+ZOEDEPTH_MODEL = "ZoeD_NK"
+
+
+def create_model_bundle(path: str, model: Model, depth_predictor: nn.Module,
+                        correspondence_extractor: CorrespondenceExtractor) -> dict:
+    """ Writes the weights of all networks and their hashes into one archive.
+
+    Returns:
+        the sha256 hashes of the components
+    """
+    weights = {
+        "cyws3d": _cpu_state_dict(model),
+        "zoedepth": _cpu_state_dict(depth_predictor),
+        "matching": _cpu_state_dict(correspondence_extractor._matching),
+    }
+    hashes = {name: hash_state_dict(state_dict) for name, state_dict in weights.items()}
+    tmp_path = f"{path}.tmp"
+    torch.save({
+        "format": FORMAT,
+        "version": VERSION,
+        "config": config_to_dict(model.args),
+        "weights": weights,
+        "hashes": hashes,
+        "zoedepth": {"repo": ZOEDEPTH_REPO, "model": ZOEDEPTH_MODEL},
+    }, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info("wrote model bundle %s", path)
+    return hashes
+
+
+def load_model_bundle(path: str, device="cpu", precision: str = "fp32", verify: bool = False,
+                      hub_dir: str = None) -> dict:
+    """ Loads all networks of a bundle.
+
+    Args:
+        path: path of the bundle
+        device: device to move the networks to
+        precision: precision mode of the cyws3d model
+        verify: check the weights against the stored hashes (reads every weight once)
+        hub_dir: torch.hub cache with the ZoeDepth code, defaults to torch.hub.get_dir()
+
+    Returns:
+        dict with "config", "model", "depth_predictor", "correspondence_extractor" and "timings"
+    """
+    timings = {}
+    start_time = time.perf_counter()
+    bundle = _load_archive(path)
+    if bundle.get("format") != FORMAT or bundle.get("version") != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} model bundle")
+    timings["archive"] = time.perf_counter() - start_time
+    if verify:
+        start_time = time.perf_counter()
+        verify_model_bundle(bundle)
+        timings["verify"] = time.perf_counter() - start_time
+
+    config = EasyDict(bundle["config"])
+    start_time = time.perf_counter()
+    model = build_model_from_state_dict(config, bundle["weights"]["cyws3d"], precision)
+    timings["cyws3d"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    depth_predictor = load_depth_predictor(bundle["weights"]["zoedepth"], bundle["zoedepth"], \
+        hub_dir)
+    timings["zoedepth"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    correspondence_extractor = CorrespondenceExtractor(device=device, \
+        state_dict=bundle["weights"]["matching"])
+    timings["matching"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    model = model.to(device)
+    depth_predictor = depth_predictor.eval().to(device)
+    timings["to_device"] = time.perf_counter() - start_time
+    logger.info("loaded model bundle %s in %.2f s: %s", path, sum(timings.values()), \
+        ", ".join(f"{name} {seconds:.2f} s" for name, seconds in timings.items()))
+    return {
+        "config": config,
+        "model": model,
+        "depth_predictor": depth_predictor,
+        "correspondence_extractor": correspondence_extractor,
+        "timings": timings,
+    }
+
+
+def build_model_from_state_dict(config, state_dict: dict, precision: str = "fp32") -> Model:
+    """ Builds the cyws3d model and loads its weights, on the meta device if torch supports it. """
+    if _supports_meta_init():
+        with torch.device("meta"):
+            model = Model(config, precision=precision, pretrained_backbone=False)
+        model.load_state_dict(state_dict, strict=True, assign=True)
+        uninitialised = [name for name, tensor in \
+            list(model.named_parameters()) + list(model.named_buffers()) if tensor.is_meta]
+        if len(uninitialised) == 0:
+            return model
+        logger.warning("meta initialisation left %s without weights, building eagerly", \
+            uninitialised)
+    model = Model(config, precision=precision, pretrained_backbone=False)
+    model.load_state_dict(state_dict, strict=True)
+    return model
+
+
+def load_depth_predictor(state_dict: dict, source: dict = None, hub_dir: str = None) -> nn.Module:
+    """ Builds ZoeDepth from the torch.hub cache without pretrained weights and loads state_dict. """
+    source = source if source is not None else {"repo": ZOEDEPTH_REPO, "model": ZOEDEPTH_MODEL}
+    hub_dir = hub_dir if hub_dir is not None else torch.hub.get_dir()
+    repo_dir = os.path.join(hub_dir, source["repo"].replace("/", "_") + "_main")
+    if os.path.isdir(repo_dir):
+        depth_predictor = torch.hub.load(repo_dir, source["model"], source="local", \
+            pretrained=False)
+    else:
+        logger.warning("%s is not in the torch.hub cache, resolving it online", source["repo"])
+        depth_predictor = torch.hub.load(source["repo"], source["model"], pretrained=False)
+    depth_predictor.load_state_dict(state_dict)
+    return depth_predictor
+
+
+def verify_model_bundle(bundle: dict) -> None:
+    """ Raises a ValueError if a component does not match its stored hash. """
+    for name, expected in bundle["hashes"].items():
+        actual = hash_state_dict(bundle["weights"][name])
+        if actual != expected:
+            raise ValueError(f"hash mismatch for {name}: expected {expected}, got {actual}")
+
+
+def hash_state_dict(state_dict: dict) -> str:
+    """ Returns the sha256 of the names, dtypes, shapes and bytes of all tensors. """
+    sha256 = hashlib.sha256()
+    for key in sorted(state_dict):
+        tensor = state_dict[key].detach().cpu().contiguous()
+        sha256.update(f"{key}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        sha256.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha256.hexdigest()
+
+
+def _load_archive(path: str) -> dict:
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError: # torch<2.1 has no mmap
+        return torch.load(path, map_location="cpu")
+
+
+def _supports_meta_init() -> bool:
+    return hasattr(torch.device("cpu"), "__enter__") and \
+        "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def _cpu_state_dict(module: nn.Module) -> dict:
+    return {key: value.detach().cpu() for key, value in module.state_dict().items()}
+
@@ -0,0 +1,100 @@
+# Copyright (c) 2024 TU Wien
+"""
+Frames that stay in their stored integer dtype until they are used.
+
+inference.py keeps the frames of a whole room resident in host memory. As float32 an RGB frame
+takes four times and a depth map two times the memory of its uint8/uint16 source. A PackedFrame
+keeps the source dtype through pinning and the host to device copy and is converted to float on
+the compute device right before the batch is processed (see BatchAssembler.wait).
+
+torch has no uint16 dtype, so uint16 depth maps are stored as int16 bit pattern and widened
+again on conversion.
+"""
+import numpy as np
+import torch
+
+RGB = "rgb"
+DEPTH = "depth"
+
+
+class PackedFrame():
+    ''' An RGB image (uint8, (3, H, W)) or depth map ((H, W)) in its stored dtype.
+
+    Args:
+        data: tensor in the stored dtype, uint16 depth as int16 bit pattern
+        kind: "rgb" or "depth"
+        depth_scale: factor from stored depth values to the depth used by the model
+        unsigned: True if an int16 tensor holds uint16 values
+    '''
+    __slots__ = ("data", "kind", "depth_scale", "unsigned")
+
+    def __init__(self, data: torch.Tensor, kind: str, depth_scale: float = 1.0,
+                 unsigned: bool = False):
+        assert kind in (RGB, DEPTH), f"unknown frame kind {kind}"
+        self.data = data
+        self.kind = kind
+        self.depth_scale = depth_scale
+        self.unsigned = unsigned
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, kind: str, depth_scale: float = 1.0):
+        """ Packs a decoded frame. The array is copied, so memory mapped slices can be passed. """
+        array = np.array(array)
+        unsigned = array.dtype == np.uint16
+        if unsigned:
+            array = array.view(np.int16)
+        return cls(torch.from_numpy(array), kind, depth_scale, unsigned)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def device(self):
+        return self.data.device
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.element_size() * self.data.nelement()
+
+    def to(self, device, non_blocking: bool = False):
+        return PackedFrame(self.data.to(device, non_blocking=non_blocking), self.kind, \
+            self.depth_scale, self.unsigned)
+
+    def pin_memory(self):
+        return PackedFrame(self.data.pin_memory(), self.kind, self.depth_scale, self.unsigned)
+
+    def record_stream(self, stream):
+        self.data.record_stream(stream)
+
+    def float(self) -> torch.Tensor:
+        """ Returns the frame as float32 tensor, RGB in [0, 1] and depth multiplied by its scale. """
+        if self.kind == RGB:
+            return self.data.float() / 255.0
+        data = self.data
+        if self.unsigned:
+            data = data.to(torch.int32) & 0xFFFF
+        depth = data.float()
+        if self.depth_scale != 1.0:
+            depth = depth * self.depth_scale
+        return depth
+
+
+def unpack_frames(batch: dict, keys=("image1", "image2", "depth1", "depth2")) -> dict:
+    """ Converts all PackedFrames of the batch to float tensors on their device. """
+    for key in keys:
+        batch[key] = [value.float() if isinstance(value, PackedFrame) else value \
+            for value in batch[key]]
+    return batch
+
+
+def resident_bytes(batch: dict) -> int:
+    """ Returns the memory taken by the frames of a batch. """
+    total = 0
+    for values in batch.values():
+        for value in values:
+            if isinstance(value, PackedFrame):
+                total += value.nbytes
+            elif isinstance(value, torch.Tensor):
+                total += value.element_size() * value.nelement()
+    return total
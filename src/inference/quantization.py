@@ -0,0 +1,195 @@
+# Copyright (c) 2024 TU Wien
+"""
+int8 build of the model for cpu inference.
+
+- the linear layers of the ViT backbone (qkv, proj, mlp) are quantized dynamically
+- the DownSamplingBlocks of the unet encoder are quantized statically with FX graph mode; conv,
+  bn and relu are fused and the activation ranges come from a calibration pass over real images
+- in the unet decoder and the fusion block every conv+bn(+relu) stack is quantized statically on
+  its own, with float in- and outputs; the upsampling, kornia resizes, gelu and attention blocks
+  between them stay in fp32. The decoder is calibrated on the encoder pyramids of image pairs
+  registered with the identity (feature differences), registration itself needs pytorch3d
+- registration and the CenterNet head are unchanged
+
+The quantized weights are saved as <checkpoint>.int8.pt next to the fp32 checkpoint and loaded
+by rebuilding the same quantized structure and loading its state dict into it.
+"""
+import logging
+import torch
+import torch.nn as nn
+from easydict import EasyDict
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+try:
+    from src.inference.model import Model, config_to_dict
+except ImportError:
+    from model import Model, config_to_dict
+
+logger = logging.getLogger(__name__)
+
+BACKEND = "fbgemm"
+# v2: the conv stacks of the unet decoder and the fusion block are quantized as well
+FORMAT = "cyws3d-int8-v2"
+QUANTIZED_SUFFIX = ".int8.pt"
+# input of the first DownSamplingBlock: last DINO layer resized to 64x64
+ENCODER_INPUT_SHAPE = (1, 768, 64, 64)
+
+
+def quantized_model_path(checkpoint_path: str) -> str:
+    """ Returns the path of the int8 artifact for a checkpoint, e.g. cyws-3d.int8.pt. """
+    if checkpoint_path.endswith(".ckpt"):
+        checkpoint_path = checkpoint_path[:-len(".ckpt")]
+    return f"{checkpoint_path}{QUANTIZED_SUFFIX}"
+
+
+def fuse_conv_bn(module: nn.Module) -> nn.Module:
+    """ Folds every BatchNorm2d that directly follows a Conv2d in a nn.Sequential into the conv.
+    The module has to be in eval mode.
+    """
+    for child in module.modules():
+        if not isinstance(child, nn.Sequential):
+            continue
+        for i in range(len(child) - 1):
+            if isinstance(child[i], nn.Conv2d) and isinstance(child[i + 1], nn.BatchNorm2d):
+                child[i] = fuse_conv_bn_eval(child[i], child[i + 1])
+                child[i + 1] = nn.Identity()
+    return module
+
+
+def quantize_backbone(model: Model) -> None:
+    """ Replaces the linear layers of the ViT with dynamically quantized int8 layers. """
+    backbone = model.feature_backbone
+    quantize_dynamic(backbone.model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    # the features are collected by hooks on the qkv layers, which have been replaced
+    qkv_layers = [backbone.model.blocks[i].attn.qkv for i in model.args.vit_feature_layers]
+    if not all(len(layer._forward_hooks) > 0 for layer in qkv_layers):
+        backbone.register_hooks(model.args.vit_feature_layers)
+
+
+def conv_bn_stacks(module: nn.Module) -> list:
+    """ Returns (parent, name, stack) of every nn.Sequential below module that only consists of a
+    Conv2d, a BatchNorm2d and optionally a ReLU, e.g. the Conv2dReLU blocks of the unet decoder.
+    """
+    stacks = []
+    for parent in module.modules():
+        for name, child in parent.named_children():
+            if not isinstance(child, nn.Sequential) or not 2 <= len(child) <= 3:
+                continue
+            if isinstance(child[0], nn.Conv2d) and isinstance(child[1], nn.BatchNorm2d) and \
+                    (len(child) == 2 or isinstance(child[2], nn.ReLU)):
+                stacks.append((parent, name, child))
+    return stacks
+
+
+def prepare_conv_bn_stacks(module: nn.Module) -> None:
+    """ Inserts observers into every conv+bn(+relu) stack of module, each one is quantized on its
+    own and keeps float in- and outputs.
+    """
+    qconfig_mapping = get_default_qconfig_mapping(BACKEND)
+    for parent, name, stack in conv_bn_stacks(module):
+        example_input = torch.zeros((1, stack[0].in_channels, 8, 8))
+        setattr(parent, name, prepare_fx(stack, qconfig_mapping, (example_input,)))
+
+
+def convert_prepared_modules(module: nn.Module) -> None:
+    """ Converts the calibrated stacks prepared by prepare_conv_bn_stacks to int8. """
+    for parent in list(module.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, torch.fx.GraphModule):
+                setattr(parent, name, convert_fx(child))
+
+
+def prepare_unet_encoder(model: Model) -> None:
+    """ Inserts observers into the DownSamplingBlocks for the calibration pass. """
+    qconfig_mapping = get_default_qconfig_mapping(BACKEND)
+    example_input = torch.zeros(ENCODER_INPUT_SHAPE)
+    for i, block in enumerate(model.unet_encoder):
+        model.unet_encoder[i] = prepare_fx(block, qconfig_mapping, (example_input,))
+        with torch.no_grad():
+            example_input = block(example_input)
+
+
+def convert_unet_encoder(model: Model) -> None:
+    """ Converts the calibrated DownSamplingBlocks to int8. """
+    for i, block in enumerate(model.unet_encoder):
+        model.unet_encoder[i] = convert_fx(block)
+
+
+def convert_model(model: Model) -> None:
+    """ Converts all statically quantized parts to int8. """
+    convert_unet_encoder(model)
+    convert_prepared_modules(model.unet_decoder)
+    convert_prepared_modules(model.feature_fusion_block)
+
+
+@torch.no_grad()
+def calibrate(model: Model, images1: torch.Tensor, images2: torch.Tensor,
+              batch_size: int = 5) -> None:
+    """ Runs normalised (B, 3, 224, 224) image pairs through the model, so the observers record the
+    activation ranges. The decoder gets the differences of the two encoder pyramids, as after a
+    registration with the identity.
+    """
+    for start in range(0, len(images1), batch_size):
+        dino_features1, encoded_features1 = model._encode(images1[start:start + batch_size])
+        dino_features2, encoded_features2 = model._encode(images2[start:start + batch_size])
+        pairs = list(zip(encoded_features1[1:], encoded_features2[1:]))
+        differences1 = [[]] + [f1 - f2 for f1, f2 in pairs]
+        differences2 = [[]] + [f2 - f1 for f1, f2 in pairs]
+        model._decode(dino_features1, differences1)
+        model._decode(dino_features2, differences2)
+        logger.debug("calibrated on %s image pairs", min(start + batch_size, len(images1)))
+
+
+def _quantize_structure(model: Model) -> Model:
+    torch.backends.quantized.engine = BACKEND
+    model = model.cpu().eval()
+    quantize_backbone(model)
+    prepare_unet_encoder(model)
+    prepare_conv_bn_stacks(model.unet_decoder)
+    prepare_conv_bn_stacks(model.feature_fusion_block)
+    # conv+bn pairs that are not a quantizable stack are folded in fp32
+    fuse_conv_bn(model.unet_decoder)
+    fuse_conv_bn(model.feature_fusion_block)
+    return model
+
+
+def quantize_model(model: Model, images1: torch.Tensor, images2: torch.Tensor,
+                   batch_size: int = 5) -> Model:
+    """ Builds the int8 model in place. images1 and images2 are normalised image pairs. """
+    model = _quantize_structure(model)
+    calibrate(model, images1, images2, batch_size)
+    convert_model(model)
+    model.precision = "fp32" # the fp32 parts must not run under autocast
+    return model
+
+
+def save_quantized_model(model: Model, path: str) -> None:
+    """ Saves the state of a quantized model together with its config. """
+    torch.save({
+        "format": FORMAT,
+        "backend": BACKEND,
+        "config": config_to_dict(model.args),
+        "state_dict": model.state_dict(),
+    }, path)
+    logger.info("saved quantized model to %s", path)
+
+
+def load_quantized_model(path: str, args=None) -> Model:
+    """ Loads a model saved with save_quantized_model. The model runs on cpu only.
+
+    Args:
+        path: path of the .int8.pt file
+        args: model config, defaults to the config stored in the file
+    """
+    # our own artifact, it contains packed quantized parameters next to plain tensors
+    artifact = torch.load(path, map_location="cpu", weights_only=False)
+    if artifact.get("format") != FORMAT:
+        raise ValueError(f"{path} is not a quantized cyws3d model")
+    # the backbone weights are part of the state dict, downloading them would break offline nodes
+    model = _quantize_structure(Model(args if args is not None else EasyDict(artifact["config"]), \
+        pretrained_backbone=False))
+    convert_model(model)
+    model.load_state_dict(artifact["state_dict"])
+    return model
+
@@ -3,21 +3,28 @@ import os
 
 import kornia as K
 import numpy as np
+import torch
 from einops import rearrange
 from PIL import Image
 from torch.utils.data import ConcatDataset, Dataset
 from torchvision.transforms.functional import pil_to_tensor
+try:
+    from src.inference.frame_cache import FrameCache, RC3D_PARTS
+except ImportError:
+    from frame_cache import FrameCache, RC3D_PARTS
 
 
-def RC3D(path_to_dataset, use_gt_depth):
-    parts = ["part1", "part2", "part3", "part4"]
-    datasets = [SubDataset(os.path.join(path_to_dataset, part), use_gt_depth) for part in parts]
+def RC3D(path_to_dataset, use_gt_depth, use_frame_cache=True):
+    datasets = [SubDataset(os.path.join(path_to_dataset, part), use_gt_depth, use_frame_cache) \
+        for part in RC3D_PARTS]
     return ConcatDataset(datasets)
 
 
 class SubDataset(Dataset):
-    def __init__(self, path_to_dataset, use_gt_depth):
+    def __init__(self, path_to_dataset, use_gt_depth, use_frame_cache=True):
         self.path_to_dataset = path_to_dataset
+        # frames packed by create_frame_cache.py are sliced instead of decoded
+        self.frame_cache = FrameCache.open(path_to_dataset) if use_frame_cache else None
         with open(os.path.join(self.path_to_dataset, "coco_annotations.json"), "r") as j:
             annotations_json = json.loads(j.read())
         self.image1 = [x["file_name"] for x in annotations_json["images"][0::3]]
@@ -30,6 +37,9 @@ class SubDataset(Dataset):
         """
         Returms a normalised RGB image as tensor.
         """
+        frame = self.frame_cache.get(path_to_image) if self.frame_cache is not None else None
+        if frame is not None:
+            return torch.from_numpy(np.array(frame)).float() / 255.0
         with open(path_to_image, "rb") as file:
             pil_image = Image.open(file).convert("RGB")
             image_as_tensor = pil_to_tensor(pil_image).float() / 255.0
@@ -39,6 +49,9 @@ class SubDataset(Dataset):
         """
         Returms a normalised RGB image as tensor.
         """
+        frame = self.frame_cache.get(path_to_image) if self.frame_cache is not None else None
+        if frame is not None:
+            return torch.from_numpy(np.array(frame, dtype=np.float32))
         with open(path_to_image, "rb") as file:
             pil_image = Image.open(file)
             image_as_tensor = pil_to_tensor(pil_image).float()
@@ -76,17 +89,6 @@ class SubDataset(Dataset):
         
         return data
 
-def get_easy_dict_from_yaml_file(path_to_yaml_file):
-    """
-    Reads a yaml and returns it as an easy dict.
-    """
-    import yaml
-    from easydict import EasyDict
-
-    with open(path_to_yaml_file, "r") as stream:
-        yaml_file = yaml.safe_load(stream)
-    return EasyDict(yaml_file)
-
 if __name__ == "__main__":
     from torch.utils.data import DataLoader
     dataset = RC3D(path_to_dataset="path", use_gt_depth=True)
@@ -1,19 +1,39 @@
 import kornia as K
-from etils import epath
 from PIL import Image
 from torchvision.transforms.functional import pil_to_tensor
 import imageio.v2 as imageio
 import torch
 import numpy as np
 from einops import rearrange
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from matplotlib.patches import ConnectionPatch
+import functools
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from src.inference.frame_cache import read_rgb_frame, read_depth_frame
+    from src.inference.packed_frames import PackedFrame, RGB, DEPTH
+except ImportError:
+    from frame_cache import read_rgb_frame, read_depth_frame
+    from packed_frames import PackedFrame, RGB, DEPTH
 
 logger = logging.getLogger(__name__)
 
-def create_batch_from_metadata(metadata, device="cpu"):
+MODEL_HW = (224, 224)
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+def create_batch_from_metadata(metadata, device="cpu", frame_cache=None, num_workers=4,
+                               packed=False):
+    """
+    Reads the images, depth maps and camera parameters of all items. Frames found in the
+    frame_cache (see frame_cache.py) are sliced from it instead of being decoded.
+
+    The files are decoded on a pool of num_workers threads (PIL and imageio release the GIL while
+    decoding); num_workers=0 reads them one after another. The order of the items is kept.
+
+    With packed=True images and depth maps are returned as PackedFrames in their stored uint8 and
+    uint16 dtype and have to be converted with unpack_frames before they are used.
+    """
     list_of_items = metadata["batch"]
     batch = {}
     all_keys = [
@@ -32,37 +52,89 @@ def create_batch_from_metadata(metadata, device="cpu"):
         "registration_strategy"
     ]
     for key in all_keys:
-        batch[key] = []
-    for item in list_of_items:
-        for key in all_keys:
-            value = item.get(key, None)
-            if value is None:
-                batch[key].append(None)
-                continue
-            if "image" in key:
-                value = read_image_as_tensor(value).to(device)
-            if "depth" in key:
-                value = read_depth_as_tensor(value).to(device)
-            for k in ["position","rotation","intrinsics","transfm2d"]:
-                if k in key:
-                    value = torch.tensor(np.load(value), dtype=torch.float32)
-            batch[key].append(value)
+        batch[key] = [item.get(key, None) for item in list_of_items]
+    jobs = [(key, i) for key in all_keys if key != "registration_strategy" \
+        for i in range(len(list_of_items)) if batch[key][i] is not None]
+
+    def load(job):
+        key, i = job
+        start_time = time.perf_counter()
+        value = _read_batch_value(key, batch[key][i], frame_cache, packed)
+        return value, time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    if num_workers > 0 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(load, jobs))
+    else:
+        results = [load(job) for job in jobs]
+    wall_time = time.perf_counter() - start_time
+
+    latencies = []
+    for (key, i), (value, latency) in zip(jobs, results):
+        logger.debug("Read %s in %.1f ms", batch[key][i], latency * 1000)
+        latencies.append((latency, batch[key][i]))
+        batch[key][i] = value.to(device) if ("image" in key or "depth" in key) else value
+    if len(latencies) > 0:
+        slowest_latency, slowest_file = max(latencies, key=lambda entry: entry[0])
+        logger.info("Read %s files in %.2f s with %s workers (%.1f ms per file, slowest %.1f ms: %s)",
+            len(latencies), wall_time, num_workers,
+            1000 * sum(latency for latency, _ in latencies) / len(latencies),
+            1000 * slowest_latency, slowest_file)
     _sanity_test_batch(batch, list_of_items)
     return batch
 
-def read_image_as_tensor(path_to_image):
+def _read_batch_value(key, value, frame_cache=None, packed=False):
+    if "image" in key:
+        if packed:
+            return read_packed_image(value, frame_cache)
+        return read_image_as_tensor(value, frame_cache)
+    if "depth" in key:
+        if packed:
+            return read_packed_depth(value, frame_cache)
+        return read_depth_as_tensor(value, frame_cache)
+    return torch.tensor(np.load(value), dtype=torch.float32)
+
+def read_image_as_tensor(path_to_image, frame_cache=None):
     assert path_to_image is not None
+    frame = frame_cache.get(path_to_image) if frame_cache is not None else None
+    if frame is not None:
+        return torch.from_numpy(np.array(frame)).float() / 255.0
     with open(path_to_image, "rb") as file:
         pil_image = Image.open(file).convert("RGB")
         image_as_tensor = pil_to_tensor(pil_image).float() / 255.0
     return image_as_tensor
 
-def read_depth_as_tensor(path_to_depth):
+def read_depth_as_tensor(path_to_depth, frame_cache=None):
     assert path_to_depth is not None
+    frame = frame_cache.get(path_to_depth) if frame_cache is not None else None
+    if frame is not None:
+        return torch.from_numpy(np.array(frame, dtype=np.float32))
     if ".tiff" in path_to_depth:
         return _read_depth_from_tiff(path_to_depth)
     return _read_depth_from_png(path_to_depth)
 
+def read_packed_image(path_to_image, frame_cache=None):
+    """
+    Returns the RGB image as uint8 PackedFrame.
+    """
+    assert path_to_image is not None
+    frame = frame_cache.get(path_to_image) if frame_cache is not None else None
+    if frame is None:
+        frame = read_rgb_frame(path_to_image)
+    return PackedFrame.from_array(frame, RGB)
+
+def read_packed_depth(path_to_depth, frame_cache=None, depth_scale=1.0):
+    """
+    Returns the depth map as PackedFrame in its stored dtype. The depth values are used as
+    stored (depth_scale=1.0), like read_depth_as_tensor does.
+    """
+    assert path_to_depth is not None
+    frame = frame_cache.get(path_to_depth) if frame_cache is not None else None
+    if frame is None:
+        frame = read_depth_frame(path_to_depth)
+    return PackedFrame.from_array(frame, DEPTH, depth_scale)
+
 @torch.no_grad()
 def fill_in_the_missing_information(batch, depth_predictor, correspondence_extractor, device="cpu"):
     for i in range(len(batch["image1"])):
@@ -77,35 +149,67 @@ def fill_in_the_missing_information(batch, depth_predictor, correspondence_extra
     batch = correspondence_extractor(batch, device)
     return batch
 
-def prepare_batch_for_model(batch, device="cpu"):
-    nearest_resize = K.augmentation.Resize((224,224), resample=0, align_corners=None, keepdim=True)
-    bicubic_resize = K.augmentation.Resize((224,224), resample=2, keepdim=True)
-    for i in range(len(batch["image1"])):
-        original_hw1 = batch["image1"][i].shape[-2:]
-        original_hw2 = batch["image2"][i].shape[-2:]
-        batch["image1"][i] = bicubic_resize(normalise_image(batch["image1"][i]))
-        batch["image2"][i] = bicubic_resize(normalise_image(batch["image2"][i]))
-        if batch["depth1"][i] is not None:
-            original_depth_hw1 = batch["depth1"][i].shape[-2:]
-            batch["depth1"][i] = nearest_resize(batch["depth1"][i])
-        if batch["depth2"][i] is not None:
-            original_depth_hw2 = batch["depth2"][i].shape[-2:]
-            batch["depth2"][i] = nearest_resize(batch["depth2"][i])
-        if batch["intrinsics1"][i] is not None:
-            assert original_hw1 == original_depth_hw1
-            logger.debug(f"Transforming intrinsics for image pair {i}")
-            transformation = nearest_resize.transform_matrix.squeeze()
-            transformation = convert_kornia_transformation_matrix_to_normalised_coordinates(
-                transformation, original_hw1, (224, 224)).to(device)
-            batch["intrinsics1"][i] = transformation @ batch["intrinsics1"][i]
-        if batch["intrinsics2"][i] is not None:
-            assert original_hw2 == original_depth_hw2
-            transformation = nearest_resize.transform_matrix.squeeze()
-            transformation = convert_kornia_transformation_matrix_to_normalised_coordinates(
-                transformation, original_hw2, (224, 224)).to(device)
-            batch["intrinsics2"][i] = transformation @ batch["intrinsics2"][i]
-    for keys in ["image1", "image2"]:
-        batch[keys] = torch.stack(batch[keys])
+def prepare_batch_for_model(batch, device="cpu", buffers=None):
+    """
+    Resizes and normalises the images and depth maps of the batch to the model resolution and
+    rescales the intrinsics accordingly. If buffers (see BatchAssembler) are given, the images
+    and depth maps are written into them instead of allocating new tensors.
+
+    Images and depth maps of the same source resolution are resized together in one call and
+    all intrinsics are rescaled with a single stacked matrix multiplication.
+    """
+    nearest_resize = _get_resize(MODEL_HW, resample=0)
+    bicubic_resize = _get_resize(MODEL_HW, resample=2)
+    # the intrinsics are rescaled with the transformation of the depth resize, which only holds
+    # if the image has the resolution of its depth map
+    for key, image_key, depth_key in [("intrinsics1", "image1", "depth1"), \
+            ("intrinsics2", "image2", "depth2")]:
+        for i, intrinsics in enumerate(batch[key]):
+            if intrinsics is None:
+                continue
+            assert batch[depth_key][i] is not None and \
+                batch[image_key][i].shape[-2:] == batch[depth_key][i].shape[-2:], \
+                f"intrinsics of image pair {i} need a depth map of the same resolution"
+    original_hw = {}
+    for key in ["image1", "image2"]:
+        images = batch[key]
+        original_hw[key] = [tuple(image.shape[-2:]) for image in images]
+        groups = _group_by_resolution(images)
+        out = None if buffers is None else buffers[key][:len(images)]
+        if out is None and len(groups) == 1:
+            batch[key] = bicubic_resize(normalise_images(torch.stack(images)))
+            continue
+        if out is None:
+            out = images[0].new_empty((len(images), 3, *MODEL_HW))
+        for indices in groups.values():
+            out[indices] = bicubic_resize(normalise_images(torch.stack([images[i] for i in indices])))
+        batch[key] = out
+
+    transformations = {}
+    for key in ["depth1", "depth2"]:
+        for hw, indices in _group_by_resolution(batch[key]).items():
+            depth = nearest_resize(torch.stack([batch[key][i] for i in indices]).unsqueeze(1))
+            if hw not in transformations:
+                transformations[hw] = convert_kornia_transformation_matrix_to_normalised_coordinates(
+                    nearest_resize.transform_matrix[0].cpu(), hw, MODEL_HW)
+            for j, i in enumerate(indices):
+                batch[key][i] = depth[j, 0] if buffers is None else buffers[key][i].copy_(depth[j, 0])
+
+    scaled_intrinsics = []
+    for key, image_key in [("intrinsics1", "image1"), ("intrinsics2", "image2")]:
+        for i, intrinsics in enumerate(batch[key]):
+            if intrinsics is None:
+                continue
+            hw = original_hw[image_key][i]
+            scaled_intrinsics.append((key, i, transformations[hw], intrinsics))
+    if len(scaled_intrinsics) > 0:
+        logger.debug("Transforming intrinsics for %s images", len(scaled_intrinsics))
+        intrinsics = torch.stack([entry[3] for entry in scaled_intrinsics])
+        transformation = torch.stack([entry[2] for entry in scaled_intrinsics]).to(intrinsics)
+        intrinsics = transformation @ intrinsics
+        for j, (key, i, _, _) in enumerate(scaled_intrinsics):
+            batch[key][i] = intrinsics[j]
+
     batch["query_metadata"] = [
         {
             "pad_shape": (224, 224),
@@ -116,17 +220,43 @@ def prepare_batch_for_model(batch, device="cpu"):
     return batch
 
 def normalise_image(img_as_tensor):
-    imagenet_normalisation = K.enhance.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     img = rearrange(img_as_tensor, "c h w -> 1 c h w")
-    img = imagenet_normalisation(img)
+    img = normalise_images(img)
     return img.squeeze()
 
+def normalise_images(images_as_tensor):
+    """
+    Applies the imagenet normalisation to a (B, 3, H, W) batch.
+    """
+    return _get_imagenet_normalisation()(images_as_tensor)
+
+@functools.lru_cache(maxsize=None)
+def _get_imagenet_normalisation():
+    return K.enhance.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+
+@functools.lru_cache(maxsize=None)
+def _get_resize(output_hw, resample):
+    if resample == 0:
+        return K.augmentation.Resize(output_hw, resample=0, align_corners=None, keepdim=True)
+    return K.augmentation.Resize(output_hw, resample=resample, keepdim=True)
+
+def _group_by_resolution(tensors):
+    """
+    Returns {(h, w): [indices]} for all tensors that are not None, in order of first appearance.
+    """
+    groups = {}
+    for i, tensor in enumerate(tensors):
+        if tensor is None:
+            continue
+        groups.setdefault(tuple(tensor.shape[-2:]), []).append(i)
+    return groups
+
 def undo_imagenet_normalization(image_as_tensor):
     """
     Undo the imagenet normalization.
     """
-    mean = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
-    std = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+    mean = torch.tensor(IMAGENET_MEAN).view(3, 1, 1)
+    std = torch.tensor(IMAGENET_STD).view(3, 1, 1)
     image_as_tensor = image_as_tensor * std + mean
     return image_as_tensor
 
@@ -144,8 +274,7 @@ def _read_depth_from_png(path_to_depth):
     return image_as_tensor
 
 def _read_depth_from_tiff(path_to_depth):
-    filename = epath.Path(path_to_depth)
-    img = imageio.imread(filename.read_bytes(), format="tiff")
+    img = imageio.imread(path_to_depth, format="tiff")
     if img.ndim == 2:
         img = img[:, :, None]
     return K.image_to_tensor(img).float().squeeze()
@@ -168,6 +297,8 @@ def visualise_predictions(
     right_scores = right_scores if right_scores is not None else [None] * len(right_predicted_bboxes)
     TARGET_COLOUR = "#1E88E5"
     PREDICTED_COLOUR = "#FFC107"
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
     figure, plot = plt.subplots(1, 2)
     plot[0].imshow(K.tensor_to_image(left_image))
     for bbox, score in zip(left_predicted_bboxes, left_scores):
@@ -205,7 +336,8 @@ def plot_correspondences(source_image, target_image, source_points, target_point
     """
     Helper function to plot correspondences.
     """
-    
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import ConnectionPatch
     fig, axarr = plt.subplots(1,2)
     if torch.is_tensor(source_image):
         source_image = K.tensor_to_image(source_image)
@@ -226,7 +358,8 @@ def plot_correspondences(source_image, target_image, source_points, target_point
             axarr[1].add_artist(con)
             axarr[0].plot(pt_q[0], pt_q[1], c=col, marker='x')
             axarr[1].plot(pt_t[0], pt_t[1], c=col, marker='x')
-    plt.savefig(save_path, bbox_inches="tight")
+    fig.savefig(save_path, bbox_inches="tight")
+    plt.close(fig)
 
 def _sanity_test_batch(batch, list_of_items):
     keys_and_their_existance = [
@@ -257,3 +390,15 @@ def _sanity_test_batch(batch, list_of_items):
             keys = dict["keys"]
             keys_exist = [batch[key][i] is not None for key in keys]
             assert keys_exist in dict["possible_values"]
+
+
+def get_easy_dict_from_yaml_file(path_to_yaml_file):
+    """
+    Reads a yaml and returns it as an easy dict.
+    """
+    import yaml
+    from easydict import EasyDict
+
+    with open(path_to_yaml_file, "r") as stream:
+        yaml_file = yaml.safe_load(stream)
+    return EasyDict(yaml_file)
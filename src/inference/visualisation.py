@@ -0,0 +1,205 @@
+# Copyright (c) 2024 TU Wien
+"""
+Off-thread visualisation of predictions and correspondences.
+
+The matplotlib helpers in utils.py are slow and not thread safe, so this module draws the boxes
+and correspondences directly onto uint8 arrays with cv2 and writes them from a small pool of
+background threads. Images are handed over through a bounded queue; if the queue is full the image
+is dropped instead of blocking the inference loop.
+"""
+import logging
+import queue
+import threading
+import cv2
+import kornia as K
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+PREDICTED_COLOUR = (255, 193, 7) # "#FFC107"
+CORRESPONDENCE_COLOUR = (0, 128, 0)
+IMAGE_GAP = 10
+
+def tensor_to_uint8_image(image) -> np.ndarray:
+    """ Converts a (3, H, W) float tensor in [0, 1] or a (H, W, 3) array to a (H, W, 3) uint8 array.
+    """
+    if torch.is_tensor(image):
+        image = K.tensor_to_image(image.detach().cpu())
+    if image.dtype != np.uint8:
+        image = np.clip(image * 255.0, 0, 255).astype(np.uint8)
+    return np.ascontiguousarray(image)
+
+def _side_by_side(left_image: np.ndarray, right_image: np.ndarray) -> np.ndarray:
+    height = max(left_image.shape[0], right_image.shape[0])
+    canvas = np.full((height, left_image.shape[1] + IMAGE_GAP + right_image.shape[1], 3), 255, \
+        dtype=np.uint8)
+    canvas[:left_image.shape[0], :left_image.shape[1]] = left_image
+    canvas[:right_image.shape[0], left_image.shape[1] + IMAGE_GAP:] = right_image
+    return canvas
+
+def _draw_bboxes(image: np.ndarray, bboxes, scores, offset_x: int = 0) -> None:
+    scores = scores if scores is not None else [None] * len(bboxes)
+    height, width = image.shape[:2]
+    for bbox, score in zip(bboxes, scores):
+        x1, x2 = (bbox[0] * (width / 224), bbox[2] * (width / 224))
+        y1, y2 = (bbox[1] * (height / 224), bbox[3] * (height / 224))
+        top_left = (int(round(x1)) + offset_x, int(round(y1)))
+        cv2.rectangle(image, top_left, (int(round(x2)) + offset_x, int(round(y2))), \
+            PREDICTED_COLOUR, 2)
+        if score is not None:
+            cv2.putText(image, f"{score:.2f}", (top_left[0], max(top_left[1] - 4, 10)), \
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, PREDICTED_COLOUR, 1, cv2.LINE_AA)
+
+def draw_predictions(
+    left_image: np.ndarray,
+    right_image: np.ndarray,
+    left_predicted_bboxes,
+    right_predicted_bboxes,
+    left_scores=None,
+    right_scores=None
+) -> np.ndarray:
+    """ Draws the predicted boxes (in 224x224 model coordinates) onto both uint8 images and returns
+    them side by side. Scores are written above the top left corner of their box.
+    """
+    right_offset = left_image.shape[1] + IMAGE_GAP
+    canvas = _side_by_side(left_image, right_image)
+    _draw_bboxes(canvas[:left_image.shape[0], :left_image.shape[1]], left_predicted_bboxes, \
+        left_scores)
+    _draw_bboxes(canvas[:right_image.shape[0], right_offset:], right_predicted_bboxes, \
+        right_scores)
+    return canvas
+
+def draw_correspondences(
+    source_image: np.ndarray,
+    target_image: np.ndarray,
+    source_points: np.ndarray,
+    target_points: np.ndarray
+) -> np.ndarray:
+    """ Draws matched points (normalised xy coordinates) onto both uint8 images and connects them.
+    """
+    canvas = _side_by_side(source_image, target_image)
+    right_offset = source_image.shape[1] + IMAGE_GAP
+    source_points = np.asarray(source_points) * [source_image.shape[1], source_image.shape[0]]
+    target_points = np.asarray(target_points) * [target_image.shape[1], target_image.shape[0]]
+    colours = np.random.randint(0, 256, size=(len(source_points), 3))
+    for pt_q, pt_t, col in zip(source_points.astype(int), target_points.astype(int), colours):
+        pt_t = (int(pt_t[0]) + right_offset, int(pt_t[1]))
+        pt_q = (int(pt_q[0]), int(pt_q[1]))
+        cv2.line(canvas, pt_q, pt_t, CORRESPONDENCE_COLOUR, 1, cv2.LINE_AA)
+        cv2.drawMarker(canvas, pt_q, col.tolist(), cv2.MARKER_TILTED_CROSS, 6)
+        cv2.drawMarker(canvas, pt_t, col.tolist(), cv2.MARKER_TILTED_CROSS, 6)
+    return canvas
+
+def save_image(save_path: str, image: np.ndarray) -> None:
+    """ Writes a RGB uint8 image to disk. """
+    if not cv2.imwrite(save_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR)):
+        raise IOError(f"could not write image to {save_path}")
+
+
+class VisualisationWriter():
+    ''' Draws and saves visualisations on background threads.
+
+    Args:
+        num_workers: number of writer threads
+        max_queue_size: number of pending images before new ones are dropped
+        enabled: if False every submit is a no-op, so the writer can stay in the loop
+    '''
+    def __init__(self, num_workers: int = 2, max_queue_size: int = 16, enabled: bool = True):
+        self.enabled = enabled
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._workers = []
+        if not enabled:
+            return
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._work, name=f"visualisation-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit_predictions(
+        self,
+        left_image,
+        right_image,
+        left_predicted_bboxes,
+        right_predicted_bboxes,
+        left_scores=None,
+        right_scores=None,
+        save_path="./results.png"
+    ) -> bool:
+        """ Queues a prediction image. The images are converted to uint8 on the calling thread so
+        the caller may reuse its tensors right away. Returns False if the image was not queued.
+        """
+        if not self.enabled:
+            return False
+        args = (
+            tensor_to_uint8_image(left_image),
+            tensor_to_uint8_image(right_image),
+            np.array(left_predicted_bboxes, copy=True),
+            np.array(right_predicted_bboxes, copy=True),
+            None if left_scores is None else np.array(left_scores, copy=True),
+            None if right_scores is None else np.array(right_scores, copy=True),
+        )
+        return self._submit(draw_predictions, args, save_path)
+
+    def submit_correspondences(
+        self,
+        source_image,
+        target_image,
+        source_points,
+        target_points,
+        save_path="./correspondences.png"
+    ) -> bool:
+        """ Queues a correspondence image, see submit_predictions. """
+        if not self.enabled:
+            return False
+        if torch.is_tensor(source_points):
+            source_points = source_points.detach().cpu().numpy()
+        if torch.is_tensor(target_points):
+            target_points = target_points.detach().cpu().numpy()
+        args = (
+            tensor_to_uint8_image(source_image),
+            tensor_to_uint8_image(target_image),
+            np.array(source_points, copy=True),
+            np.array(target_points, copy=True),
+        )
+        return self._submit(draw_correspondences, args, save_path)
+
+    def _submit(self, draw_function, args, save_path) -> bool:
+        try:
+            self._queue.put_nowait((draw_function, args, save_path))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Visualisation queue full, dropping %s", save_path)
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                draw_function, args, save_path = job
+                save_image(save_path, draw_function(*args))
+            except Exception: # pylint: disable=broad-except
+                logger.exception("Failed to write visualisation %s", job[2])
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """ Waits for all queued images to be written and stops the workers. """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self.dropped > 0:
+            logger.warning("%s visualisations were dropped because the queue was full", \
+                self.dropped)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -6,8 +6,8 @@ This module contains the functions to create metadata for the inference.
 import os
 import numpy as np
 from src.globals import CAMERA_INFO_JSON_PATH
-from src.annotation import utils
-from src.annotation.projection import Intrinsic, Extrinsic
+from src.annotation.projection import Intrinsic
+from src.annotation.poses import ScenePoses
 
 def create_metadata(
     ROOM, 
@@ -1145,16 +1145,12 @@ def get_transformations(ROOM_DIR, logger):
             logger.debug("Skipping %s", root)
             continue
         logger.debug(f"root: {root}")
-        transformations = utils.load_transformations(
-            f"{root}/{root.split('/')[-1]}_transformations.yaml")
-        logger.debug(f"transformations: {transformations}")
-        for key, value in transformations.items():
-            logger.debug("dict value %s", value)
-            extrinsics = Extrinsic()
-            extrinsics.from_dict(value)
-            logger.debug(f"extrinsics: {extrinsics}")
-            np.save(f"{root}/{value['file_name'][:-4]}_position.npy", extrinsics.position)
-            np.save(f"{root}/{value['file_name'][:-4]}_rotation.npy", extrinsics.rotation)
+        poses = ScenePoses.load(f"{root}/{root.split('/')[-1]}_transformations.yaml")
+        logger.debug("loaded %s poses", len(poses))
+        for file_name, position, rotation in zip(poses.file_names.tolist(), poses.translations, \
+                poses.rotations):
+            np.save(f"{root}/{file_name[:-4]}_position.npy", position)
+            np.save(f"{root}/{file_name[:-4]}_rotation.npy", rotation)
         intrinsics = Intrinsic()
         intrinsics.from_json(f"data/ObChange/{CAMERA_INFO_JSON_PATH}")
         np.save(f"data/ObChange/{CAMERA_INFO_JSON_PATH[:-5]}.npy", intrinsics.matrix())
\ No newline at end of file
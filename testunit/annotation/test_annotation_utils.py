@@ -0,0 +1,181 @@
+# Copyright (c) 2024 TU Wien
+"""
+Module for testing the annotation utility functions.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from src.annotation.annotation_index import AnnotationIndex
+from src.annotation.pointcloud_store import voxel_downsample, point_cloud_cache_path, \
+    CACHE_ROOT, DATA_ROOT
+from src.annotation.target_accumulator import TargetAccumulator
+from src.annotation.utils import rasterize_points, squeeze_maps
+
+class TestRasterizePoints(unittest.TestCase):
+    """ Test the point rasterizer against sequential per point writes
+    """
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.height, cls.width = 48, 64
+        cls.u = rng.integers(0, cls.width, size=5000)
+        cls.v = rng.integers(0, cls.height, size=5000)
+        cls.colors = rng.uniform(0, 1, size=(5000, 3))
+        cls.depth = rng.uniform(0.5, 5, size=5000)
+
+    def test_last_point_wins_without_depth(self):
+        expected = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        for u, v, color in zip(self.u, self.v, self.colors * 255):
+            expected[v, u] = color
+        image, depth_image = rasterize_points(self.u, self.v, self.colors, self.height, self.width)
+        np.testing.assert_array_equal(image, expected)
+        self.assertIsNone(depth_image)
+
+    def test_nearest_point_wins_with_depth(self):
+        expected = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        expected_depth = np.full((self.height, self.width), np.inf)
+        for u, v, color, depth in zip(self.u, self.v, self.colors * 255, self.depth):
+            if depth < expected_depth[v, u]:
+                expected[v, u] = color
+                expected_depth[v, u] = depth
+        expected_depth[np.isinf(expected_depth)] = 0
+        image, depth_image = rasterize_points(self.u, self.v, self.colors, self.height, \
+            self.width, depth=self.depth)
+        np.testing.assert_array_equal(image, expected)
+        np.testing.assert_allclose(depth_image, expected_depth.astype(np.float32))
+
+    def test_points_behind_camera_are_dropped(self):
+        depth = self.depth * np.where(np.arange(len(self.depth)) % 2 == 0, 1, -1)
+        expected = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        expected_depth = np.full((self.height, self.width), np.inf)
+        for u, v, color, point_depth in zip(self.u, self.v, self.colors * 255, depth):
+            if 0 < point_depth < expected_depth[v, u]:
+                expected[v, u] = color
+                expected_depth[v, u] = point_depth
+        expected_depth[np.isinf(expected_depth)] = 0
+        image, depth_image = rasterize_points(self.u, self.v, self.colors, self.height, \
+            self.width, depth=depth)
+        np.testing.assert_array_equal(image, expected)
+        np.testing.assert_allclose(depth_image, expected_depth.astype(np.float32))
+        self.assertTrue(np.all(depth_image >= 0))
+
+    def test_splat_radius_covers_neighbours(self):
+        image, depth_image = rasterize_points([10], [5], [[1.0, 1.0, 1.0]], self.height, \
+            self.width, depth=[2.0], radius=1)
+        self.assertEqual(int((image[..., 0] == 255).sum()), 9)
+        self.assertTrue(np.all(depth_image[4:7, 9:12] == 2.0))
+        image, _ = rasterize_points([0], [0], [[1.0, 1.0, 1.0]], self.height, self.width, radius=1)
+        self.assertEqual(int((image[..., 0] == 255).sum()), 4)
+
+class TestSqueezeMaps(unittest.TestCase):
+    """ Test the broadcast squeeze maps against the per pixel computation
+    """
+    def test_squeeze_maps_match_per_pixel_maps(self):
+        width, height, strength = 64, 12, 0.005
+        expected_x = np.zeros((height, width), dtype=np.float32)
+        expected_y = np.zeros((height, width), dtype=np.float32)
+        center_x = width / 2
+        for j in range(height):
+            for i in range(width):
+                offset = i - center_x
+                stretched_position = center_x + offset * (1 + strength * abs(offset))
+                expected_x[j, i] = max(0, min(width - 1, stretched_position))
+                expected_y[j, i] = j
+        map_x, map_y = squeeze_maps(width, height, strength)
+        np.testing.assert_array_equal(map_x, expected_x)
+        np.testing.assert_array_equal(map_y, expected_y)
+        self.assertIs(squeeze_maps(width, height, strength)[0], map_x)
+
+class TestAnnotationIndex(unittest.TestCase):
+    """ Test parsing and caching of .anno files
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.anno")
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write("chair 1 2 3 7\ncup 10 11 5\n\nbook 4\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_drops_the_last_token(self):
+        index = AnnotationIndex.load(self.path)
+        self.assertEqual(index.names, ["chair", "cup", "book"])
+        np.testing.assert_array_equal(index.object_indices(0), [1, 2, 3])
+        np.testing.assert_array_equal(index.object_indices(1), [10, 11])
+        self.assertEqual(len(index.object_indices(2)), 0)
+        np.testing.assert_array_equal(index.labels(12)[[0, 1, 10]], [-1, 0, 1])
+
+    def test_sidecar_is_used_and_invalidated(self):
+        AnnotationIndex.load(self.path)
+        self.assertTrue(os.path.isfile(self.path + ".npz"))
+        self.assertEqual(AnnotationIndex.load(self.path).names, ["chair", "cup", "book"])
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write("lamp 3 4 5 0\n")
+        index = AnnotationIndex.load(self.path)
+        self.assertEqual(index.names, ["lamp"])
+        np.testing.assert_array_equal(index.object_indices(0), [3, 4, 5])
+
+    def test_sidecar_is_refreshed_after_touch(self):
+        AnnotationIndex.load(self.path)
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(AnnotationIndex.load(self.path).names, ["chair", "cup", "book"])
+        with np.load(self.path + ".npz") as cache:
+            self.assertEqual(int(cache["mtime"]), os.stat(self.path).st_mtime_ns)
+
+class TestVoxelDownsample(unittest.TestCase):
+    """ Test the voxel levels of detail of the point cloud store
+    """
+    def test_voxel_downsample_averages_points_per_voxel(self):
+        points = np.array([[0.1, 0.1, 0.1], [0.3, 0.3, 0.3], [1.2, 0.1, 0.1]], dtype=np.float32)
+        colors = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, 1.0, 0.0]])
+        level_points, level_colors = voxel_downsample(points, colors, 0.5)
+        order = np.argsort(level_points[:, 0])
+        np.testing.assert_allclose(level_points[order], [[0.2, 0.2, 0.2], [1.2, 0.1, 0.1]], rtol=1e-6)
+        np.testing.assert_allclose(level_colors[order], [[0.5, 0.0, 0.5], [0.0, 1.0, 0.0]])
+
+    def test_cache_path_does_not_depend_on_the_working_directory(self):
+        expected = os.path.join(CACHE_ROOT, "ObChange", "Office", "scene2", "merged")
+        working_directory = os.getcwd()
+        try:
+            os.chdir(os.path.join(DATA_ROOT, os.pardir, "src", "annotation"))
+            self.assertEqual(point_cloud_cache_path("../../data/ObChange/Office/scene2/merged.pcd"),
+                             expected)
+        finally:
+            os.chdir(working_directory)
+        self.assertEqual(point_cloud_cache_path(
+            os.path.join(DATA_ROOT, "ObChange", "Office", "scene2", "merged.pcd")), expected)
+
+class TestTargetAccumulator(unittest.TestCase):
+    """ Test the target accumulator against appending the boxes with torch.cat
+    """
+    def test_matches_torch_cat(self):
+        import torch
+        rng = np.random.default_rng(0)
+        additions = [("a.png", rng.uniform(0, 224, size=(3, 4))), ("b.png", None), \
+            ("a.png", rng.uniform(0, 224, size=(20, 4))), ("c.png", np.empty((0, 4)))]
+        accumulator = TargetAccumulator()
+        expected = {}
+        for image, boxes in additions:
+            accumulator.add_image(image)
+            expected.setdefault(image, dict(image=image, \
+                boxes=torch.as_tensor([], dtype=torch.float32), \
+                labels=torch.zeros((0,), dtype=torch.int32)))
+            if boxes is None:
+                continue
+            accumulator.add_boxes(image, boxes)
+            expected[image]["boxes"] = torch.cat([expected[image]["boxes"], \
+                torch.as_tensor(boxes, dtype=torch.float32)])
+            expected[image]["labels"] = torch.cat([expected[image]["labels"], \
+                torch.zeros((len(boxes),), dtype=torch.int32)])
+        merged = TargetAccumulator()
+        merged.merge(accumulator)
+        targets = merged.to_targets()
+        self.assertEqual([target["image"] for target in targets], ["a.png", "b.png", "c.png"])
+        for target in targets:
+            for key in ("boxes", "labels"):
+                self.assertEqual(target[key].dtype, expected[target["image"]][key].dtype)
+                self.assertTrue(torch.equal(target[key], expected[target["image"]][key]))
@@ -8,6 +8,7 @@ import logging
 import torch
 from src.evaluation.calculate_mAP import calculate_mAP
 from src.evaluation.obchange_dataloader import load_pascal_voc_export
+from src.evaluation.eval_utils import precision_report
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -32,3 +33,24 @@ class TestCalculate_mAP(unittest.TestCase):
         self.map = calculate_mAP(self.predictions, self.targets)
         logger.debug(f'mAP: {self.map}')
         self.assertGreaterEqual(self.map['map'], 0.5)
+
+class TestPrecisionReport(unittest.TestCase):
+    """ Test the comparison of the precision modes
+    """
+    def test_precision_report(self):
+        """ test if runs that only differ in their precision are compared against fp32
+        """
+        metrics = {
+            "area-300_precision-fp32_depth-": {"mAP": 0.5, "mAP_50": 0.7, \
+                "inference_precision": "fp32", "predict_seconds_per_pair": 0.4},
+            "area-300_precision-bf16_depth-": {"mAP": 0.45, "mAP_50": 0.68, \
+                "inference_precision": "bf16", "predict_seconds_per_pair": 0.2},
+            "area-400_precision-fp16_depth-": {"mAP": 0.3, "mAP_50": 0.5, \
+                "inference_precision": "fp16", "predict_seconds_per_pair": 0.1},
+        }
+        report = precision_report(metrics)
+        self.assertEqual(set(report), {"area-300_depth-", "area-400_depth-"})
+        self.assertAlmostEqual(report["area-300_depth-"]["bf16"]["mAP_delta"], -0.05)
+        self.assertAlmostEqual(report["area-300_depth-"]["bf16"]["speedup"], 2.0)
+        self.assertEqual(report["area-300_depth-"]["fp32"]["mAP_delta"], 0.0)
+        self.assertIsNone(report["area-400_depth-"]["fp16"]["speedup"])
@@ -0,0 +1,92 @@
+# Copyright (c) 2024 TU Wien
+"""
+Module for testing the columnar prediction store.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+from src.evaluation.prediction_store import PredictionWriter, PredictionStore, \
+    load_predictions, convert_pt_to_columnar
+
+LEGACY_PREDICTIONS = 'testunit/evaluation/resources/batch_image2_predicted_bboxes.pt'
+
+class TestPredictionStore(unittest.TestCase):
+    """ Test writing and reading the columnar prediction store
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.tmp_dir, "batch_image2_predicted_bboxes")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        ''' boxes, scores and labels come back per image and in order, empty images included
+        '''
+        writer = PredictionWriter(self.store_path)
+        writer.append("prediction_0", [[1, 2, 3, 4], [5, 6, 7, 8]], [0.9, 0.4])
+        writer.append("prediction_1", np.array([]), np.array([]))
+        writer.append("prediction_2", [[10, 20, 30, 40]], [0.5], [1])
+        writer.close()
+
+        store = PredictionStore(self.store_path)
+        self.assertEqual(len(store), 3)
+        predictions = load_predictions(self.store_path, columns=("image", "boxes", "scores", "labels"))
+        self.assertEqual([p["image"] for p in predictions], \
+            ["prediction_0", "prediction_1", "prediction_2"])
+        self.assertTrue(torch.equal(predictions[0]["boxes"], \
+            torch.tensor([[1, 2, 3, 4], [5, 6, 7, 8]], dtype=torch.float32)))
+        self.assertEqual(tuple(predictions[1]["boxes"].shape), (0, 4))
+        self.assertEqual(predictions[2]["labels"].tolist(), [1])
+        self.assertEqual(predictions[0]["labels"].dtype, torch.int32)
+
+    def test_only_requested_columns_are_read(self):
+        ''' the loader returns just the requested columns
+        '''
+        writer = PredictionWriter(self.store_path)
+        writer.append("prediction_0", [[1, 2, 3, 4]], [0.9])
+        writer.close()
+        predictions = load_predictions(self.store_path, columns=("boxes",))
+        self.assertEqual(list(predictions[0].keys()), ["boxes"])
+
+    def test_resume_after_crash(self):
+        ''' flushed predictions survive a crash and are merged in index order on close
+        '''
+        writer = PredictionWriter(self.store_path)
+        writer.append("prediction_1", [[1, 1, 2, 2]], [0.3], index=1, key="a|b")
+        writer.flush()
+        writer.append("prediction_2", [[2, 2, 3, 3]], [0.3], index=2, key="c|d")
+        # crash: prediction_2 was never flushed
+
+        resumed = PredictionWriter(self.store_path, resume=True)
+        self.assertEqual(resumed.completed(), {1: "a|b"})
+        resumed.append("prediction_0", [[0, 0, 1, 1]], [0.3], index=0, key="e|f")
+        resumed.append("prediction_2", [[2, 2, 3, 3]], [0.3], index=2, key="c|d")
+        resumed.close()
+
+        predictions = load_predictions(self.store_path, columns=("image",))
+        self.assertEqual([p["image"] for p in predictions], \
+            ["prediction_0", "prediction_1", "prediction_2"])
+        self.assertFalse(os.path.exists(f"{self.store_path}.parts"))
+        self.assertEqual(PredictionWriter(self.store_path, resume=True).completed(), \
+            {0: "e|f", 1: "a|b", 2: "c|d"})
+
+    def test_convert_legacy_file(self):
+        ''' converting a .pt file keeps every entry
+        '''
+        legacy = torch.load(LEGACY_PREDICTIONS)
+        pt_path = os.path.join(self.tmp_dir, "batch_image2_predicted_bboxes.pt")
+        shutil.copy(LEGACY_PREDICTIONS, pt_path)
+        store_path = convert_pt_to_columnar(pt_path)
+        self.assertEqual(store_path, self.store_path)
+        converted = load_predictions(store_path)
+        self.assertEqual(len(converted), len(legacy))
+        for old, new in zip(legacy, converted):
+            self.assertTrue(torch.allclose(old["boxes"].reshape(-1, 4).float(), new["boxes"]))
+            self.assertTrue(torch.allclose(old["scores"].float(), new["scores"]))
+
+if __name__ == '__main__':
+    unittest.main()
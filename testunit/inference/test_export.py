@@ -0,0 +1,124 @@
+# Copyright (c) 2024 TU Wien
+"""
+Module for testing the export friendly model against the eager model.
+
+Uses the checkpoint cyws-3d.ckpt in the repository root if it exists and a randomly initialised
+model otherwise. The ONNX comparison needs onnxruntime and is skipped without it.
+"""
+import os
+import math
+import tempfile
+import importlib.util
+import unittest
+import numpy as np
+import torch
+import yaml
+from easydict import EasyDict
+
+CHECKPOINT = "./cyws-3d.ckpt"
+CONFIG = "config.yml"
+
+def rotation_about_y(angle: float) -> torch.Tensor:
+    return torch.tensor([[math.cos(angle), 0.0, math.sin(angle)], [0.0, 1.0, 0.0], \
+        [-math.sin(angle), 0.0, math.cos(angle)]])
+
+class TestExport(unittest.TestCase):
+    """ Test the outputs of ExportableModel and the traced/exported encoder and decoder
+    """
+    @classmethod
+    def setUpClass(cls):
+        from src.inference.model import Model
+        with open(CONFIG, "r", encoding="utf-8") as file:
+            config = EasyDict(yaml.safe_load(file))
+        torch.manual_seed(0)
+        if os.path.isfile(CHECKPOINT):
+            cls.model = Model(config, load_weights_from=CHECKPOINT).eval()
+        else:
+            cls.model = Model(config, pretrained_backbone=False).eval()
+        homography = torch.tensor([[1.0, 0.02, 0.01], [0.0, 1.0, -0.02], [0.0, 0.0, 1.0]])
+        # normalised intrinsics, two poses 0.2 m and 3 degrees apart and a depth of 1.5 to 2.5 m
+        intrinsics = torch.tensor([[1.0, 0.0, 0.5], [0.0, 1.0, 0.5], [0.0, 0.0, 1.0]])
+        cls.batch = {
+            "image1": torch.rand(3, 3, 224, 224),
+            "image2": torch.rand(3, 3, 224, 224),
+            "registration_strategy": ["identity", "2d", "3d"],
+            "points1": [None, None, None],
+            "points2": [None, None, None],
+            "transfm2d_1_to_2": [None, homography, None],
+            "transfm2d_2_to_1": [None, homography.inverse(), None],
+            "depth1": [None, None, 1.5 + torch.rand(224, 224)],
+            "depth2": [None, None, 1.5 + torch.rand(224, 224)],
+            "intrinsics1": [None, None, intrinsics],
+            "intrinsics2": [None, None, intrinsics.clone()],
+            "rotation1": [None, None, torch.eye(3)],
+            "rotation2": [None, None, rotation_about_y(math.radians(3))],
+            "position1": [None, None, torch.zeros(3)],
+            "position2": [None, None, torch.tensor([0.2, 0.0, 0.05])],
+            "query_metadata": [{"pad_shape": (224, 224), "border": np.array([0, 0, 0, 0]),
+                                "batch_input_shape": (224, 224)}] * 3,
+        }
+
+    def test_exportable_model_matches_model(self):
+        ''' same heatmaps as Model.forward for identity, 2d and 3d registration
+        '''
+        from src.inference.export import ExportableModel, compute_registration_tensors
+        with torch.no_grad():
+            expected = self.model(dict(self.batch))
+            exportable = ExportableModel(self.model).eval()
+            registration = compute_registration_tensors(self.batch)
+            actual = exportable(self.batch["image1"], self.batch["image2"], registration)
+        self.assertEqual(registration["strategy"].tolist(), [2, 1, 0])
+        torch.testing.assert_close(registration["K_inv_1"][2], self.batch["intrinsics1"][2].inverse())
+        self.assertEqual(int(torch.count_nonzero(registration["Rt_1_to_2"][:2])), 0)
+        for expected_outputs, actual_outputs in zip(expected, actual):
+            for expected_output, actual_output in zip(expected_outputs, actual_outputs):
+                torch.testing.assert_close(actual_output[0], expected_output[0],
+                                           rtol=1e-4, atol=1e-4)
+
+    def test_torchscript_matches_eager(self):
+        ''' traced encoder and decoder give the eager outputs
+        '''
+        from src.inference.export import ChangeDetectionEncoder, ChangeDetectionDecoder, \
+            export_model
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            written = export_model(self.model, tmp_dir, formats=("torchscript",))
+            encoder = torch.jit.load(written["torchscript"][0])
+            decoder = torch.jit.load(written["torchscript"][1])
+            with torch.no_grad():
+                image = self.batch["image1"][:1]
+                expected_features = ChangeDetectionEncoder(self.model).eval()(image)
+                actual_features = encoder(image)
+                expected_outputs = ChangeDetectionDecoder(self.model).eval()(*expected_features)
+                actual_outputs = decoder(*expected_features)
+        for expected, actual in zip(expected_features + expected_outputs,
+                                    tuple(actual_features) + tuple(actual_outputs)):
+            torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+    @unittest.skipUnless(importlib.util.find_spec("onnxruntime"), "onnxruntime not installed")
+    def test_onnx_matches_eager(self):
+        ''' the ONNX encoder and decoder give the eager outputs in onnxruntime
+        '''
+        import onnxruntime
+        from src.inference.export import ChangeDetectionEncoder, ChangeDetectionDecoder, \
+            export_model
+        image = self.batch["image1"][:1]
+        with torch.no_grad():
+            expected_features = ChangeDetectionEncoder(self.model).eval()(image)
+            expected_outputs = ChangeDetectionDecoder(self.model).eval()(*expected_features)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            written = export_model(self.model, tmp_dir, formats=("onnx",))
+            encoder = onnxruntime.InferenceSession(written["onnx"][0], \
+                providers=["CPUExecutionProvider"])
+            decoder = onnxruntime.InferenceSession(written["onnx"][1], \
+                providers=["CPUExecutionProvider"])
+            actual_features = encoder.run(None, {"image": image.numpy()})
+            # the decoder gets the eager features, so its error is measured on its own
+            actual_outputs = decoder.run(None, {
+                entry.name: feature.numpy() for entry, feature in \
+                    zip(decoder.get_inputs(), expected_features)})
+        for expected, actual in zip(expected_features + expected_outputs,
+                                    actual_features + actual_outputs):
+            np.testing.assert_allclose(actual, expected.numpy(), rtol=1e-3, atol=1e-3)
+
+if __name__ == '__main__':
+    unittest.main()
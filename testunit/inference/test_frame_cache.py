@@ -0,0 +1,55 @@
+# Copyright (c) 2024 TU Wien
+"""
+Module for testing the frame discovery of the frame cache.
+"""
+import os
+import json
+import pickle
+import tempfile
+import unittest
+from src.inference.frame_cache import find_frames, find_rc3d_frames, find_kc3d_frames, \
+    RGB_PREFIX, DEPTH_PREFIX
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb"):
+        pass
+
+
+class TestFindFrames(unittest.TestCase):
+    """ Test that every dataset layout lists the frames its dataset class reads
+    """
+    def test_gh30_scenes(self):
+        with tempfile.TemporaryDirectory() as root:
+            rgb = os.path.join(root, "scene1", f"{RGB_PREFIX}1.png")
+            depth = os.path.join(root, "scene1", f"{DEPTH_PREFIX}1.png")
+            for path in (rgb, depth, os.path.join(root, "scene1", "image_1_1.png"), \
+                    os.path.join(root, "predictions", f"{RGB_PREFIX}2.png")):
+                _touch(path)
+            self.assertEqual(find_frames(root), ([rgb], [depth]))
+
+    def test_rc3d_part(self):
+        with tempfile.TemporaryDirectory() as root:
+            images = [{"file_name": f"{i}.jpg"} for i in range(6)]
+            with open(os.path.join(root, "coco_annotations.json"), "w", encoding="utf-8") as file:
+                json.dump({"images": images, "annotations": []}, file)
+            _touch(os.path.join(root, "depth_0.png"))
+            rgb_paths, depth_paths = find_rc3d_frames(root)
+            self.assertEqual(rgb_paths, [os.path.join(root, f"{i}.jpg") for i in (0, 3, 2, 5)])
+            self.assertEqual(depth_paths, [os.path.join(root, "depth_0.png")])
+
+    def test_kc3d_test_split(self):
+        with tempfile.TemporaryDirectory() as root:
+            scene = {"image1": "a_1.png", "image2": "a_2.png", "depth1": "a_1.tiff", \
+                "depth2": "a_2.tiff"}
+            with open(os.path.join(root, "data_split.pkl"), "wb") as file:
+                pickle.dump({"train": [], "val": [], "test": [scene]}, file)
+            rgb_paths, depth_paths = find_kc3d_frames(root)
+            self.assertEqual(rgb_paths, [os.path.join(root, "a_1.png"), os.path.join(root, "a_2.png")])
+            self.assertEqual(depth_paths, \
+                [os.path.join(root, "a_1.tiff"), os.path.join(root, "a_2.tiff")])
+
+
+if __name__ == '__main__':
+    unittest.main()
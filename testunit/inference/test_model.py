@@ -0,0 +1,72 @@
+# Copyright (c) 2024 TU Wien
+"""
+Module for testing the model with randomly initialised weights (no checkpoint or download needed).
+"""
+import unittest
+import torch
+import yaml
+from easydict import EasyDict
+from src.inference.model import Model, _interpolate_pos_embed, _num_patches
+
+CONFIG = "config.yml"
+
+def build_random_model() -> Model:
+    """ Model with random weights, the pretrained DINO weights are not downloaded. """
+    with open(CONFIG, "r", encoding="utf-8") as file:
+        config = EasyDict(yaml.safe_load(file))
+    torch.manual_seed(0)
+    return Model(config, pretrained_backbone=False).eval()
+
+class TestPosEmbed(unittest.TestCase):
+    """ Test the interpolated position embedding buffer of the patched ViT
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.model = build_random_model()
+        cls.vit = cls.model.feature_backbone.model
+
+    def expected(self):
+        patch_size, image_hw, stride_hw = self.vit._pos_embed_geometry
+        with torch.no_grad():
+            return _interpolate_pos_embed(self.vit.pos_embed, \
+                _num_patches(patch_size, image_hw, stride_hw), image_hw, patch_size, stride_hw)
+
+    def test_buffer_is_refreshed_after_loading_weights(self):
+        torch.testing.assert_close(self.vit.interpolated_pos_embed, self.expected())
+        state_dict = self.model.state_dict()
+        state_dict["feature_backbone.model.pos_embed"] = \
+            torch.randn_like(state_dict["feature_backbone.model.pos_embed"])
+        self.model.load_state_dict(state_dict)
+        torch.testing.assert_close(self.vit.interpolated_pos_embed, self.expected())
+        self.assertNotIn("feature_backbone.model.interpolated_pos_embed", self.model.state_dict())
+
+    def test_buffer_follows_dtype(self):
+        model = build_random_model().to(torch.float64)
+        vit = model.feature_backbone.model
+        self.assertEqual(vit.interpolated_pos_embed.dtype, torch.float64)
+
+@unittest.skipUnless(hasattr(torch, "compile"), "torch.compile needs torch>=2.0")
+class TestCompileStages(unittest.TestCase):
+    """ Test that the static shape stages compile into single graphs
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.model = build_random_model()
+
+    def test_stages_have_no_graph_breaks(self):
+        for stage, (graph_count, break_count, reasons) in self.model.explain_stages().items():
+            self.assertEqual(break_count, 0, f"{stage}: {reasons}")
+            self.assertEqual(graph_count, 1, stage)
+
+    def test_fullgraph_compile_matches_eager(self):
+        images = torch.rand(1, 3, 224, 224)
+        with torch.no_grad():
+            dino_features, encoded_features = self.model._encode(images)
+            expected = self.model._decode(dino_features, encoded_features)
+            model = build_random_model().compile_stages(fullgraph=True)
+            actual_dino_features, actual_encoded_features = model._stage("encode")(images)
+            actual = model._stage("decode")(actual_dino_features, actual_encoded_features)
+        torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,15 @@
 """
 Module for testing the projection module functions.
 """
+import os
+import tempfile
 import unittest
 import logging
-from src.annotation.projection import Intrinsic, Extrinsic
+import yaml
+import numpy as np
+from src.annotation.projection import Intrinsic, Extrinsic, inside_frustum, frustum_culling, \
+    frustum_mask, frustum_masks, project_to_2d, SceneProjector, project_object_bboxes
+from src.annotation.poses import ScenePoses
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -83,3 +89,126 @@ class TestExtrinsic(unittest.TestCase):
         
         self.assertAlmostEqual(self.extrinsics.homogenous_matrix()[0][0], 0.95547, places=3)
         self.assertAlmostEqual(self.extrinsics.homogenous_matrix()[3][3], 1.0, places=3)
+
+
+class TestScenePoses(unittest.TestCase):
+    """ Test the batched poses against Extrinsic.from_dict
+    """
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        quaternions = rng.normal(size=(20, 4))
+        quaternions /= np.linalg.norm(quaternions, axis=1, keepdims=True)
+        cls.entries = [{
+            "id": i,
+            "file_name": f"image_{i}.png",
+            "timestamp": 1567880058.4 + i,
+            "rotation": dict(zip("xyzw", quaternion.tolist())),
+            "translation": dict(zip("xyz", rng.uniform(-3, 3, size=3).tolist())),
+        } for i, quaternion in enumerate(quaternions)]
+
+    def test_matches_extrinsic(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scene2_transformations.yaml")
+            with open(path, "w", encoding="utf-8") as file:
+                yaml.safe_dump(self.entries, file)
+            poses = ScenePoses.load(path)
+            self.assertTrue(os.path.isfile(path + ".npz"))
+            cached = ScenePoses.load(path)
+        np.testing.assert_array_equal(cached.quaternions, poses.quaternions)
+        self.assertEqual(cached.file_names.tolist(), [entry["file_name"] for entry in self.entries])
+        for entry, rotation, matrix in zip(self.entries, poses.rotations, poses.extrinsic_matrices):
+            extrinsics = Extrinsic()
+            extrinsics.from_dict(entry)
+            np.testing.assert_allclose(rotation, extrinsics.rotation, atol=1e-12)
+            np.testing.assert_allclose(matrix, extrinsics.homogenous_matrix(), atol=1e-9)
+
+
+class TestFrustumCulling(unittest.TestCase):
+    """ Test the vectorized frustum culling against the per point test
+    """
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.points = rng.uniform(-3, 3, size=(2000, 3))
+        cls.fov_x, cls.fov_y = 60.0, 45.0
+
+    def test_frustum_culling_matches_inside_frustum(self):
+        far, near = self.points[:, 2].min(), self.points[:, 2].max()
+        expected = [i for i, point in enumerate(self.points) \
+            if inside_frustum(point, self.fov_x, self.fov_y, near, far)]
+        self.assertEqual(frustum_culling(self.points, self.fov_x, self.fov_y), expected)
+
+    def test_frustum_culling_raises_without_points(self):
+        with self.assertRaises(ValueError):
+            frustum_culling(np.array([[10.0, 0.0, 1.0]]), self.fov_x, self.fov_y)
+
+    def test_frustum_masks_match_single_poses(self):
+        extrinsics = np.repeat(np.eye(4)[None], 3, axis=0)
+        extrinsics[1, :3, 3] = [0.5, -0.2, 1.0]
+        angle = np.radians(30)
+        extrinsics[2, :3, :3] = [[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], \
+            [-np.sin(angle), 0, np.cos(angle)]]
+        masks = frustum_masks(self.points, extrinsics, self.fov_x, self.fov_y)
+        self.assertEqual(masks.shape, (3, len(self.points)))
+        for matrix, mask in zip(extrinsics, masks):
+            camera_points = self.points @ matrix[:3, :3].T + matrix[:3, 3]
+            np.testing.assert_array_equal(mask, frustum_mask(camera_points, self.fov_x, self.fov_y))
+
+    def test_scene_projector_matches_transform_and_project(self):
+        intrinsics = Intrinsic(320, 240, 500, 640, 480)
+        intrinsics.distortion = [0.01, -0.002, 0.0005, 0.0003, 0.0]
+        extrinsic = np.eye(4)
+        extrinsic[:3, 3] = [0.1, 0.2, 4.0]
+        projector = SceneProjector(self.points, intrinsics)
+        projector.set_view(extrinsic)
+        indices = np.flatnonzero(projector.frustum_mask(self.fov_x, self.fov_y))
+        camera_points = self.points @ extrinsic[:3, :3].T + extrinsic[:3, 3]
+        expected_u, expected_v = project_to_2d(camera_points[indices], \
+            intrinsics.homogenous_matrix(), intrinsics.distortion_coeffs(), 640, 480)
+        u, v = projector.project(indices)
+        np.testing.assert_array_equal(u, expected_u)
+        np.testing.assert_array_equal(v, expected_v)
+
+    def test_project_object_bboxes_matches_per_object_projection(self):
+        intrinsics = Intrinsic(320, 240, 500, 640, 480)
+        intrinsics.distortion = [0.01, -0.002, 0.0005, 0.0003, 0.0]
+        # objects 2 and 3 share points, as overlapping annotations in a .anno file
+        rng = np.random.default_rng(1)
+        object_indices = [rng.choice(len(self.points), size=size, replace=False) \
+            for size in (40, 0, 60, 30)]
+        object_indices[3][:10] = object_indices[2][:10]
+        object_indices.append(np.zeros(0, dtype=np.int64))
+        point_indices = np.concatenate(object_indices)
+        object_labels = np.repeat(np.arange(5), [len(indices) for indices in object_indices])
+        extrinsics = np.repeat(np.eye(4)[None], 2, axis=0)
+        extrinsics[0, :3, 3] = [0.1, 0.2, 4.0]
+        extrinsics[1, :3, 3] = [-2.5, 0.0, 1.0]
+        bboxes = project_object_bboxes(self.points, point_indices, object_labels, extrinsics, \
+            intrinsics, self.fov_x, self.fov_y, num_objects=5, max_chunk_points=1000)
+        self.assertEqual(bboxes.shape, (2, 5, 4))
+        for view, matrix in enumerate(extrinsics):
+            camera_points = self.points @ matrix[:3, :3].T + matrix[:3, 3]
+            mask = frustum_mask(camera_points, self.fov_x, self.fov_y)
+            for label in range(5):
+                indices = object_indices[label]
+                selected = camera_points[indices[mask[indices]]]
+                if len(selected) == 0:
+                    np.testing.assert_array_equal(bboxes[view, label], [-1, -1, -1, -1])
+                    continue
+                u, v = project_to_2d(selected, intrinsics.homogenous_matrix(), \
+                    intrinsics.distortion_coeffs(), 640, 480)
+                np.testing.assert_array_equal(bboxes[view, label], [u.min(), v.min(), u.max(), v.max()])
+
+    def test_project_object_bboxes_keep_baseline_culling_behind_camera(self):
+        intrinsics = Intrinsic(320, 240, 500, 640, 480)
+        # the second point is behind the camera but inside the z symmetric frustum, the baseline
+        # frustum_culling kept it for the bbox and so does project_object_bboxes
+        points = np.array([[0.2, 0.1, 2.0], [0.3, -0.2, -1.5], [5.0, 0.0, 1.0]])
+        bboxes = project_object_bboxes(points, np.arange(3), np.zeros(3, dtype=np.int64), \
+            np.eye(4)[None], intrinsics, self.fov_x, self.fov_y)
+        selected = points[frustum_culling(points, self.fov_x, self.fov_y)]
+        self.assertEqual(len(selected), 2)
+        u, v = project_to_2d(selected, intrinsics.homogenous_matrix(), \
+            intrinsics.distortion_coeffs(), 640, 480)
+        np.testing.assert_array_equal(bboxes[0, 0], [u.min(), v.min(), u.max(), v.max()])